@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import yaml
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Import the module
+from modules import mqtt_functions as mqttf
+from modules import transport_functions as tf
+from modules import ingest_functions as ingf
+from modules import aggregator_functions as aggf
+from modules import feature_schema_functions as fsf
+
+def topology(n_clients, n_aggregators, levels):
+    """
+    Function that creates an aggregation tree: clients are spread round robin over n_aggregators
+    aggregators, and with two levels every aggregator forwards to a root aggregator.
+
+    Parameters:
+        n_clients (int): Number of simulated clients.
+        n_aggregators (int): Number of first level aggregators. 0 sends directly to the server.
+        levels (int): Levels of aggregators (1 or 2).
+
+    Returns:
+        dict: AGGREGATOR_TREE (node -> parent aggregator).
+    """
+    if not n_aggregators:
+        return {}
+    tree = {f"Client_{idx}": f"Aggregator_{idx % n_aggregators + 1}" for idx in range(n_clients)}
+    if levels > 1:
+        tree.update({f"Aggregator_{idx + 1}": "Aggregator_0" for idx in range(n_aggregators)})
+    return tree
+
+def write_client_files(folder, client_idx, n_files, rows, seed):
+    """
+    Function that writes the zip files of a simulated client, with the message schema the clients send.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    for file_idx in range(n_files):
+        df = pd.DataFrame({
+            "msg_id": [f"{client_idx}{file_idx:05d}{row:05d}" for row in range(rows)],
+            "msg_hour": rng.integers(0, 24, rows), "retweets": rng.integers(0, 100, rows),
+            "favourites": rng.integers(0, 100, rows), "is_rumour": rng.random(rows) < 0.5,
+            "emotion": rng.choice(fsf.CATEGORIES["emotion"], rows),
+            "author": [f"user{value}" for value in rng.integers(0, 500, rows)],
+            "text": [" ".join(f"word{value}" for value in rng.integers(0, 2000, 15)) for _ in range(rows)]})
+        with open(os.path.join(folder, f"bench{client_idx}_{file_idx}.zip"), "wb") as file:
+            file.write(ingf.write_zip_payload(fsf.to_arrow(df), f"bench{client_idx}_{file_idx}.arrow"))
+
+def run_case(conf, files_path, n_clients, n_aggregators, levels, timeout):
+    """
+    Function that runs the simulated clients, aggregators and server of a topology in this process,
+    with the memory transport, and measures what the server receives.
+
+    Returns:
+        dict: Benchmark result with the messages and MB received by the server and the seconds to ingest every row.
+    """
+    conf = dict(conf, AGGREGATOR_TREE=topology(n_clients, n_aggregators, levels))
+    total_rows = sum(ingf.read_zip_payload(os.path.join(root, file)).num_rows
+                     for root, _, files in os.walk(files_path) for file in files)
+
+    # server side
+    pipeline = ingf.create_ingest_pipeline(conf, tempfile.mkdtemp(prefix="aggregator_bench_"))
+    server = tf.create_transport(conf)
+    tf.transport_listen(server, mqttf.subscription_topic(conf, 1), lambda payload: ingf.submit_payload(pipeline, payload))
+
+    # every aggregator listens before the clients send
+    aggregators = sorted({parent for parent in conf["AGGREGATOR_TREE"].values()})
+    aggregators = {node_id: aggf.create_aggregator(conf, node_id) for node_id in aggregators}
+
+    def simulated_client(idx):
+        transport = tf.create_transport(conf)
+        mqttf.find_and_send_msg(conf, os.path.join(files_path, f"Client_{idx}"), f"Client_{idx}",
+                                lambda topic, message: tf.transport_publish(transport, topic, message))
+        tf.transport_stop(transport)
+
+    start_time = time.perf_counter()
+    clients = [threading.Thread(target=simulated_client, args=(idx,)) for idx in range(n_clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+
+    # aggregators are closed from the leaves to the root, each forwarding its pending rows
+    for node_id, aggregator in sorted(aggregators.items(), reverse=True):
+        aggf.close_aggregator(aggregator)
+    deadline = time.time() + timeout
+    rows = lambda: sum(metrics["rows"] for metrics in pipeline["shard_metrics"].values())
+    while rows() < total_rows and time.time() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start_time
+    tf.transport_stop(server)
+    metrics = list(pipeline["shard_metrics"].values())
+    ingf.close_ingest_pipeline(pipeline)
+
+    return {"clients": n_clients, "aggregators": n_aggregators, "levels": levels if n_aggregators else 0,
+            "server_messages": sum(m["messages"] for m in metrics), "server_mb": sum(m["bytes"] for m in metrics) / 1e6,
+            "rows": rows(), "expected_rows": total_rows, "seconds": elapsed}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fan-in of the server with and without aggregators.")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--files", type=int, default=20, help="Files sent by each client.")
+    parser.add_argument("--rows", type=int, default=100, help="Rows of each file.")
+    parser.add_argument("--aggregators", nargs="+", type=int, default=[0, 2, 4], help="First level aggregators of each case.")
+    parser.add_argument("--levels", type=int, default=1, help="Levels of aggregators (1 or 2).")
+    parser.add_argument("--batch-rows", type=int, default=5000, help="AGGREGATOR_BATCH_ROWS.")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml"))
+    parser.add_argument("--output", default=None, help="JSON file where results are saved.")
+    args = parser.parse_args()
+
+    conf = yaml.safe_load(Path(args.config).read_text())
+    conf.update({"TRANSPORT_BACKEND": "memory", "SEND_INTERVAL": 0, "INGEST_SPILL_TO_DISK": 0,
+                 "AGGREGATOR_BATCH_ROWS": args.batch_rows, "AGGREGATOR_FLUSH_SECS": 1})
+
+    files_path = tempfile.mkdtemp(prefix="aggregator_bench_files_")
+    for idx in range(args.clients):
+        write_client_files(os.path.join(files_path, f"Client_{idx}"), idx, args.files, args.rows, seed=idx)
+
+    results = []
+    print(f"{'aggregators':>11} {'levels':>6} {'messages':>9} {'MB':>8} {'rows':>8} {'seconds':>8}")
+    for n_aggregators in args.aggregators:
+        result = run_case(conf, files_path, args.clients, n_aggregators, args.levels, args.timeout)
+        results.append(result)
+        print(f"{n_aggregators:>11} {result['levels']:>6} {result['server_messages']:>9} {result['server_mb']:>8.2f} "
+              f"{result['rows']:>8} {result['seconds']:>8.3f}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+from pathlib import Path
+import yaml
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Import the module
+from modules import synthetic_data_functions as sdf
+from modules import data_preparation_functions as dpf
+from modules import graph_creation_analysis_functions as gcaf
+from modules import random_forest_train_functions as rftf
+from modules import resource_functions as rsf
+
+STAGES = ["preprocess_data", "complete_structure_json", "create_and_save_graph", "create_graph_from_tables", "get_msg_information",
+          "split_and_zip_files", "join_all_data", "tune_random_forest"]
+
+def peak_rss_mb():
+    """
+    Function that obtains the peak resident memory of the process since the last reset_peak_rss call.
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is the peak of the whole run (kB in Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def reset_peak_rss():
+    """
+    Function that resets the peak resident memory of the process, so each stage reports its own peak.
+    Returns whether the reset is supported (Linux only), otherwise peaks accumulate over the run.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+def run_stage(name, func, trace_memory):
+    """
+    Function that runs a stage and measures its wall and CPU time and its peak memory.
+
+    Parameters:
+        name (str): Stage name.
+        func (callable): Stage to run, without arguments. It returns the number of items it produced.
+        trace_memory (bool): Whether python allocations are traced with tracemalloc (slows the stage).
+
+    Returns:
+        dict: Stage measures.
+    """
+    rss_reset = reset_peak_rss()
+    if trace_memory:
+        tracemalloc.start()
+    start_cpu = time.process_time()
+    start_time = time.perf_counter()
+    items = func()
+    seconds = time.perf_counter() - start_time
+    record = {"stage": name, "seconds": seconds, "cpu_seconds": time.process_time() - start_cpu,
+              "items": items, "peak_rss_mb": peak_rss_mb(), "peak_rss_is_stage_peak": rss_reset}
+    if trace_memory:
+        record["python_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return record
+
+def run_scale(conf, args, threads, work_dir):
+    """
+    Function that generates a synthetic theme of the given number of threads and runs every
+    selected stage on it, as a client and the server would.
+
+    Parameters:
+        conf (dict): config.yaml's information, used by the analysis and tuning stages.
+        args (argparse.Namespace): Benchmark arguments.
+        threads (int): Threads of the synthetic theme.
+        work_dir (str): Folder where the data of this scale is written.
+
+    Returns:
+        list: Measures of each stage.
+    """
+    theme = "synthetic-all-rnr-threads"
+    stats = sdf.generate_pheme_data(work_dir, [theme], threads, args.rumour_ratio, args.reply_depth, args.fanout,
+                                    args.mention_density, args.text_length, args.seed)
+    print(f"Scale {threads} threads: {stats['messages']} messages, {stats['bytes'] / 1e6:.1f} MB of json.")
+
+    # same folders as the client
+    theme_path = os.path.join(work_dir, "all-rnr-annotated-threads", theme)
+    out_folder = os.path.join(theme_path, "preprocess")
+    json_out_folder = os.path.join(out_folder, "jsons")
+    graph_folder = os.path.join(out_folder, "graph")
+    send_folder = os.path.join(work_dir, "send_folder")
+    for folder in (json_out_folder, graph_folder, send_folder):
+        os.makedirs(folder, exist_ok=True)
+    state = {}
+
+    def preprocess():
+        state["tables_folder"] = dpf.preprocess_data(theme_path, out_folder, False)
+        return stats["messages"]
+
+    def structure():
+        dpf.complete_structure_json(out_folder, json_out_folder)
+        return len(os.listdir(json_out_folder))
+
+    def graph():
+        gcaf.create_and_save_graph(json_out_folder, graph_folder, False)
+        with open(os.path.join(graph_folder, "graph.pkl"), "rb") as file:
+            state["graph"] = pickle.load(file)
+        return state["graph"].number_of_nodes()
+
+    def graph_from_tables():
+        # the graph the client uses: integer nodes joined from the normalized tables
+        state["graph"] = gcaf.create_graph_from_tables(state["tables_folder"])
+        return state["graph"].number_of_nodes()
+
+    def msg_information():
+        state["summary"] = gcaf.get_msg_information(state["graph"], work_dir, conf)
+        return stats["messages"]
+
+    def split_and_zip():
+        dpf.split_and_zip_files(state["summary"], send_folder, theme)
+        return len(os.listdir(send_folder))
+
+    def join():
+        state["table"] = rftf.join_all_data(send_folder)
+        return state["table"].num_rows
+
+    def tune():
+        df = rftf.select_and_transform_data(state["table"].to_pandas(), rftf.SELECTED_COLUMNS)
+        rftf.tune_random_forest(df.drop("is_rumour", axis=1), df["is_rumour"], conf)
+        return len(df)
+
+    stage_funcs = dict(zip(STAGES, [preprocess, structure, graph, graph_from_tables, msg_information, split_and_zip,
+                                    join, tune]))
+    records = []
+    for name in STAGES:
+        if name not in args.stages:
+            # later stages need the output of the skipped ones
+            break
+        record = run_stage(name, stage_funcs[name], args.trace_memory)
+        record.update({"threads": threads, "messages": stats["messages"], "json_mb": stats["bytes"] / 1e6})
+        records.append(record)
+        print(f"\t{name:<24} {record['seconds']:>9.3f} s {record['cpu_seconds']:>9.3f} cpu s "
+              f"{record['peak_rss_mb']:>8.1f} MB {record['items']:>8} items")
+    return records
+
+def compare(results, baseline_path):
+    """
+    Function that prints the speedup of each stage and scale against a previous results file.
+    """
+    with open(baseline_path) as file:
+        baseline = {(record["threads"], record["stage"]): record for record in json.load(file)["results"]}
+    print(f"Comparison against {baseline_path}:")
+    for record in results:
+        previous = baseline.get((record["threads"], record["stage"]))
+        if previous:
+            print(f"\t{record['threads']:>6} {record['stage']:<24} {previous['seconds']:>9.3f} s -> "
+                  f"{record['seconds']:>9.3f} s ({previous['seconds'] / max(record['seconds'], 1e-9):.2f}x)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Client and server stages benchmark on synthetic PHEME-shaped data.")
+    parser.add_argument("--scales", nargs="+", type=int, default=[20, 100, 400], help="Threads of each run.")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--rumour-ratio", type=float, default=0.5)
+    parser.add_argument("--reply-depth", type=int, default=3)
+    parser.add_argument("--fanout", type=float, default=2.0)
+    parser.add_argument("--mention-density", type=float, default=0.5)
+    parser.add_argument("--text-length", type=int, default=15)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--tuning-max-fits", type=int, default=20)
+    parser.add_argument("--trace-memory", action="store_true", help="Also measure python allocations (slower).")
+    parser.add_argument("--work-dir", default=None, help="Folder for the synthetic data. Default: temporary folder.")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic data of each scale.")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml"))
+    parser.add_argument("--output", default=None, help="JSON file where results are saved.")
+    parser.add_argument("--baseline", default=None, help="Previous results JSON file to compare with.")
+    args = parser.parse_args()
+
+    # bounded tuning that does not read or write the results of real runs
+    conf = yaml.safe_load(Path(args.config).read_text())
+    conf.update({"TUNING_STRATEGY": "random", "TUNING_MAX_FITS": args.tuning_max_fits,
+                 "TUNING_RESULTS_PATH": None, "TUNING_WARM_START": 0})
+    rsf.configure_resources(conf)
+
+    work_root = args.work_dir or tempfile.mkdtemp(prefix="pipeline_bench_")
+    results = []
+    for threads in args.scales:
+        work_dir = os.path.join(work_root, f"threads_{threads}")
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+        results.extend(run_scale(conf, args, threads, work_dir))
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        environment = {"python": platform.python_version(), "platform": platform.platform(),
+                       "cpus": rsf.resources["cpus"]}
+        with open(args.output, "w") as file:
+            json.dump({"environment": environment, "parameters": vars(args), "results": results}, file, indent=4)
+
+    if args.baseline:
+        compare(results, args.baseline)
@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+
+# Root and src folders of the repository
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_PATH = os.path.join(ROOT_PATH, "src")
+
+# Role scripts imported by the dispatcher
+ROLES = ["client", "server", "aggregator"]
+
+# Heavy packages whose import is reported, to check each role only imports what it uses
+HEAVY_PACKAGES = ["pandas", "pyarrow", "networkx", "textblob", "nltk", "sklearn", "scipy", "matplotlib"]
+
+def run_python(code, importtime=False):
+    """
+    Function that runs python code in a new interpreter, from the src folder as the dispatcher does.
+
+    Parameters:
+        code (str): Code to run.
+        importtime (bool): Whether the import time of each module is written to stderr.
+
+    Returns:
+        tuple: Wall seconds of the interpreter, its stdout and its stderr.
+    """
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    # time measured by the parent, so interpreter start and exit are included
+    start_time = time.perf_counter()
+    result = subprocess.run(command, cwd=SRC_PATH, capture_output=True, text=True)
+    seconds = time.perf_counter() - start_time
+    if result.returncode != 0:
+        raise RuntimeError(f"{code} failed:\n{result.stderr}")
+    return seconds, result.stdout, result.stderr
+
+def import_code(role):
+    """
+    Function that obtains the code that imports a role script and prints the heavy packages loaded.
+    """
+    return (f"import sys, json; sys.path.insert(0, {SRC_PATH!r}); import {role}; "
+            f"print(json.dumps([name for name in {HEAVY_PACKAGES!r} if name in sys.modules]))")
+
+def slowest_imports(stderr, top):
+    """
+    Function that obtains the top-level packages with the largest cumulative import time from -X importtime output.
+
+    Parameters:
+        stderr (str): Output of the interpreter with -X importtime.
+        top (int): Number of packages.
+
+    Returns:
+        list: Package and milliseconds, slowest first.
+    """
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            package = name.strip().split(".")[0]
+            # nested imports are also counted in the cumulative time of their parent: keep the maximum
+            packages[package] = max(packages.get(package, 0), int(cumulative) / 1000)
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+def measure(code, repeats):
+    """
+    Function that runs code in repeats new interpreters and obtains the median wall seconds and the last stdout.
+    """
+    runs = [run_python(code) for _ in range(repeats)]
+    return statistics.median(seconds for seconds, _, _ in runs), runs[-1][1]
+
+def compare(results, baseline_path):
+    """
+    Function that prints the speedup of each measure against a previous results file.
+    """
+    with open(baseline_path) as file:
+        baseline = {record["measure"]: record for record in json.load(file)["results"]}
+    print(f"Comparison against {baseline_path}:")
+    for record in results:
+        previous = baseline.get(record["measure"])
+        if previous:
+            print(f"\t{record['measure']:<32} {previous['seconds']:>7.3f} s -> {record['seconds']:>7.3f} s "
+                  f"({previous['seconds'] / max(record['seconds'], 1e-9):.2f}x)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup time of the client and server roles.")
+    parser.add_argument("--repeats", type=int, default=5, help="New interpreters per measure (median is reported).")
+    parser.add_argument("--top", type=int, default=8, help="Slowest imported packages reported per role.")
+    parser.add_argument("--output", default=None, help="JSON file where results are saved.")
+    parser.add_argument("--baseline", default=None, help="Previous results JSON file to compare with.")
+    args = parser.parse_args()
+
+    # an empty interpreter is the cost the dispatcher paid again by running the role in a subprocess
+    seconds, _ = measure("pass", args.repeats)
+    results = [{"measure": "interpreter", "seconds": seconds}]
+    print(f"{'interpreter':<32} {seconds:>7.3f} s")
+
+    for role in ROLES:
+        seconds, stdout = measure(import_code(role), args.repeats)
+        loaded = json.loads(stdout.strip().splitlines()[-1])
+        _, _, stderr = run_python(import_code(role), importtime=True)
+        slowest = slowest_imports(stderr, args.top)
+        results.append({"measure": f"import_{role}", "seconds": seconds, "heavy_packages": loaded,
+                        "slowest_imports_ms": dict(slowest)})
+        print(f"{'import_' + role:<32} {seconds:>7.3f} s  heavy packages loaded: {', '.join(loaded) or '-'}")
+        for package, milliseconds in slowest:
+            print(f"\t{package:<24} {milliseconds:>9.1f} ms")
+
+    if args.output:
+        environment = {"python": platform.python_version(), "platform": platform.platform()}
+        with open(args.output, "w") as file:
+            json.dump({"environment": environment, "parameters": vars(args), "results": results}, file, indent=4)
+
+    if args.baseline:
+        compare(results, args.baseline)
@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import threading
+import tempfile
+from pathlib import Path
+import yaml
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Import the module
+from modules import mqtt_functions as mqttf
+from modules import transport_functions as tf
+
+def run_case(conf, backend, payload_size, n_clients, n_messages, timeout):
+    """
+    Function that runs n_clients simulated clients publishing n_messages each to a single
+    server listener of the same process and measures the end to end throughput.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        backend (str): Transport backend to benchmark.
+        payload_size (int): Size in bytes of the file sent in each message.
+        n_clients (int): Number of simulated clients.
+        n_messages (int): Messages sent by each client.
+        timeout (float): Maximum seconds to wait for every message.
+
+    Returns:
+        dict: Benchmark result with MB/s and messages/s.
+    """
+    total = n_clients * n_messages
+    received = {"messages": 0, "bytes": 0}
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def on_payload(payload):
+        with lock:
+            received["messages"] += 1
+            received["bytes"] += len(payload)
+            if received["messages"] == total:
+                done.set()
+
+    # server side
+    server = tf.create_transport(conf, backend)
+    tf.transport_listen(server, mqttf.subscription_topic(conf, 1), on_payload)
+
+    # same message as the clients send: base64 encoded file inside a json
+    base64_str = base64.b64encode(os.urandom(payload_size)).decode("utf-8")
+
+    def simulated_client(idx):
+        transport = tf.create_transport(conf, backend)
+        for msg_idx in range(n_messages):
+            topic, _ = mqttf.shard_topic(conf, f"Client_{idx}", msg_idx)
+            message = mqttf.prepare_mqtt_message(f"Client_{idx}", base64_str, f"bench_{idx}_{msg_idx}.zip")
+            tf.transport_publish(transport, topic, message)
+        transport["stop"].set()
+        if backend == "mqtt":
+            tf.transport_stop(transport)
+
+    start_time = time.perf_counter()
+    clients = [threading.Thread(target=simulated_client, args=(idx,)) for idx in range(n_clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    done.wait(timeout)
+    elapsed = time.perf_counter() - start_time
+    tf.transport_stop(server)
+
+    return {
+        "backend": backend, "payload_size": payload_size, "clients": n_clients,
+        "messages": received["messages"], "expected_messages": total,
+        "seconds": elapsed,
+        "mb_per_s": received["bytes"] / elapsed / 1e6,
+        "messages_per_s": received["messages"] / elapsed
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transport backends throughput benchmark.")
+    parser.add_argument("--backends", nargs="+", default=["memory", "spool"])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1024, 65536, 1048576])
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml"))
+    parser.add_argument("--output", default=None, help="JSON file where results are saved.")
+    args = parser.parse_args()
+
+    conf = yaml.safe_load(Path(args.config).read_text())
+    conf["SPOOL_PATH"] = tempfile.mkdtemp(prefix="spool_bench_")
+
+    results = []
+    print(f"{'backend':<8} {'payload':>9} {'msgs':>6} {'seconds':>8} {'MB/s':>9} {'msg/s':>9}")
+    for backend in args.backends:
+        for size in args.sizes:
+            result = run_case(conf, backend, size, args.clients, args.messages, args.timeout)
+            results.append(result)
+            print(f"{backend:<8} {size:>9} {result['messages']:>6} {result['seconds']:>8.3f} "
+                  f"{result['mb_per_s']:>9.2f} {result['messages_per_s']:>9.1f}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
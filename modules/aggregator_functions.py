@@ -0,0 +1,331 @@
+import json
+import time
+import queue
+import base64
+import hashlib
+import threading
+import numpy as np
+import pyarrow as pa
+from modules import mqtt_functions as mqttf
+from modules import transport_functions as tf
+from modules import ingest_functions as ingf
+
+# Messages of the histogram training mode pre-aggregated by the aggregators
+HISTOGRAM_KINDS = ("hist_ready", "hist", "hist_eval")
+
+def aggregator_id(role):
+    """
+    Function that obtains the node identification of an aggregator from its role (AGGREGATOR_<id> -> Aggregator_<id>).
+    """
+    return f"Aggregator_{role.split('_', 1)[1]}" if "_" in role else "Aggregator"
+
+def children(conf, node_id):
+    """
+    Function that obtains the clients and aggregators that publish to a node in AGGREGATOR_TREE.
+    """
+    return sorted(child for child, parent in (conf.get("AGGREGATOR_TREE") or {}).items() if parent == node_id)
+
+def subscription_topic(conf, node_id):
+    """
+    Function that obtains the topic an aggregator subscribes to in order to receive every shard of its children.
+    """
+    return f"{conf.get('AGGREGATOR_TOPIC', 'AGG')}/{node_id}/#"
+
+def create_aggregator(conf, node_id):
+    """
+    Function that creates an aggregator: it listens to the topic of its children and a worker thread
+    merges their batches and forwards them upstream (to its own parent aggregator or to the server).
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        node_id (str): Aggregator node identification.
+
+    Returns:
+        dict: Aggregator state shared between the listener and the worker.
+    """
+    aggregator = {
+        "id": node_id,
+        "conf": conf,
+        "queue": queue.Queue(maxsize=conf.get("INGEST_QUEUE_SIZE", 64)),
+        "children": children(conf, node_id),
+        "upstream": tf.create_transport(conf),
+        "listener": tf.create_transport(conf),
+        "runs": {},
+        "seen": set(),
+        "groups": {},
+        "participants": {},
+        "direct": set(),
+        "reported": set(),
+        "done": threading.Event(),
+        "received": {"messages": 0, "bytes": 0, "rows": 0},
+        "forwarded": {"messages": 0, "bytes": 0, "rows": 0},
+        "duplicates": 0,
+        "failed": 0
+    }
+    aggregator["worker"] = threading.Thread(target=aggregator_worker, args=(aggregator,), name="aggregator-worker", daemon=True)
+    aggregator["worker"].start()
+    tf.transport_listen(aggregator["listener"], subscription_topic(conf, node_id),
+                        lambda payload: aggregator["queue"].put((payload, time.time())))
+    print(f"{node_id}: Receiving from {aggregator['children'] or 'any child'}, "
+          f"forwarding to {mqttf.upstream_prefix(conf, node_id)}.")
+    return aggregator
+
+def aggregator_worker(aggregator):
+    """
+    Function executed by the aggregator worker thread. Relays payloads until a None sentinel arrives,
+    and flushes the batches of idle clients and the pre-aggregated messages that timed out.
+    Only this thread changes the runs and groups of the aggregator.
+    """
+    while True:
+        try:
+            item = aggregator["queue"].get(timeout=0.5)
+        except queue.Empty:
+            item = False
+        if item is None:
+            flush_all(aggregator)
+            return
+        if item:
+            try:
+                relay_payload(aggregator, *item)
+            except Exception as e:
+                print(f"{aggregator['id']}: An error occurred: {e}")
+                aggregator["failed"] += 1
+        flush_expired(aggregator)
+
+def relay_payload(aggregator, payload, received_at):
+    """
+    Function that handles a payload of a child. Data batches are merged per client, histogram
+    messages are pre-aggregated, and any other message (models, delta commits, scores) is relayed
+    after the pending rows of its client, so the server receives them in the order they were sent.
+
+    Parameters:
+        aggregator (dict): Aggregator created by create_aggregator.
+        payload (bytes): Raw message payload.
+        received_at (float): Time when the payload was received.
+    """
+    message = json.loads(payload.decode("utf-8"))
+    aggregator["received"]["messages"] += 1
+    aggregator["received"]["bytes"] += len(payload)
+    kind, client = message.get("kind"), message.get("client")
+
+    if kind in HISTOGRAM_KINDS and aggregator["conf"].get("AGGREGATOR_PREAGGREGATE", 1) == 1 \
+            and client not in aggregator["direct"]:
+        add_to_group(aggregator, message, received_at)
+        return
+    if kind is None and message.get("data"):
+        buffer_batch(aggregator, message)
+        return
+
+    run = client_run(aggregator, client, message.get("run_id"))
+    if run is not None:
+        flush_client(aggregator, client)
+        if kind == "delta_commit":
+            # the server compares the files of the delta with the merged files it receives
+            message["n_files"] = run["forwarded"] + max(message["n_files"] - run["received"], 0)
+    forward(aggregator, message)
+
+    # score reports are the last messages of the clients when the model is broadcast
+    if kind == "scores":
+        aggregator["reported"].add(client)
+        if aggregator["reported"] >= set(aggregator["runs"]):
+            aggregator["done"].set()
+
+def client_run(aggregator, client, run_id):
+    """
+    Function that obtains the pending batches of the run of a client. A newer run discards the
+    pending rows of the previous one, as the server would. Messages without run have no pending rows.
+
+    Returns:
+        dict: Run state, or None if the message has no run or belongs to an older run.
+    """
+    if run_id is None:
+        return None
+    run = aggregator["runs"].get(client)
+    if run is None or run_id > run["run_id"]:
+        if run is not None and run["rows"]:
+            print(f"{aggregator['id']}: New run of {client}. {run['rows']} pending rows discarded.")
+        run = {"run_id": run_id, "tables": [], "rows": 0, "received": 0, "forwarded": 0,
+               "name": client, "sent_at": None, "updated_at": time.time()}
+        aggregator["runs"][client] = run
+    elif run_id < run["run_id"]:
+        return None
+    return run
+
+def buffer_batch(aggregator, message):
+    """
+    Function that adds a data batch to the pending rows of its client, discarding redeliveries,
+    and forwards them once AGGREGATOR_BATCH_ROWS rows are pending.
+    """
+    client = message.get("client")
+    key = (client, message.get("run_id", 0), message.get("seq", message.get("filename")),
+           hashlib.sha256(message["data"].encode("utf-8")).hexdigest())
+    run = client_run(aggregator, client, message.get("run_id", 0))
+    if key in aggregator["seen"] or run is None:
+        aggregator["duplicates"] += 1
+        return
+    table = ingf.read_zip_payload(base64.b64decode(message["data"]))
+    if table is None:
+        raise ValueError(f"{message.get('filename')} does not contain any data file")
+    aggregator["seen"].add(key)
+
+    # merged files keep the theme prefix of the client files
+    run["name"] = message.get("filename", client).rsplit("_", 1)[0]
+    run["tables"].append(table)
+    run["rows"] += table.num_rows
+    run["received"] += 1
+    sent_at = message.get("sent_at")
+    run["sent_at"] = sent_at if run["sent_at"] is None or sent_at is None else min(run["sent_at"], sent_at)
+    run["updated_at"] = time.time()
+    aggregator["received"]["rows"] += table.num_rows
+    if run["rows"] >= aggregator["conf"].get("AGGREGATOR_BATCH_ROWS", 5000):
+        flush_client(aggregator, client)
+
+def flush_client(aggregator, client):
+    """
+    Function that forwards the pending rows of a client as a single compressed file,
+    with the client and run of the original files, so the server attributes and replaces them as usual.
+    """
+    run = aggregator["runs"].get(client)
+    if run is None or not run["tables"]:
+        return
+    table = pa.concat_tables(run["tables"], promote_options="default")
+    name = f"{run['name']}_{aggregator['id']}_{run['forwarded']}"
+    data = ingf.write_zip_payload(table, f"{name}.arrow")
+    message = {"client": client, "data": base64.b64encode(data).decode("utf-8"), "filename": f"{name}.zip",
+               "run_id": run["run_id"], "seq": f"{aggregator['id']}/{run['forwarded']}", "sent_at": run["sent_at"],
+               "merged_files": len(run["tables"]), "aggregator": aggregator["id"]}
+    forward(aggregator, message)
+    aggregator["forwarded"]["rows"] += table.num_rows
+    run.update({"tables": [], "rows": 0, "sent_at": None, "forwarded": run["forwarded"] + 1})
+
+def forward(aggregator, message):
+    """
+    Function that publishes a message upstream, on a shard of the aggregator topic.
+    """
+    topic, shard = mqttf.shard_topic(aggregator["conf"], aggregator["id"], aggregator["forwarded"]["messages"])
+    message["shard"] = shard
+    if message.get("sent_at") is None:
+        message["sent_at"] = time.time()
+    payload = json.dumps(message)
+    tf.transport_publish(aggregator["upstream"], topic, payload)
+    aggregator["forwarded"]["messages"] += 1
+    aggregator["forwarded"]["bytes"] += len(payload)
+
+def add_to_group(aggregator, message, received_at):
+    """
+    Function that adds a histogram message of a child to the group of its kind and round.
+    The group is combined and forwarded once every participating child has answered, or AGGREGATOR_WAIT
+    seconds after its first message. A child announced after its group was forwarded is relayed directly.
+    """
+    kind, client = message["kind"], message["client"]
+    key = (kind, message.get("round"))
+    if key in aggregator["groups"] and aggregator["groups"][key] is None:
+        if kind == "hist_ready":
+            aggregator["direct"].add(client)
+        forward(aggregator, message)
+        return
+    group = aggregator["groups"].setdefault(key, {"messages": {}, "first_at": received_at})
+    group["messages"][client] = message
+    expected = aggregator["children"] if kind == "hist_ready" else aggregator["participants"]
+    if expected and all(child in group["messages"] for child in expected):
+        forward_group(aggregator, key)
+
+def forward_group(aggregator, key):
+    """
+    Function that forwards the combination of the histogram messages of a group as a single message
+    that counts as every client below the aggregator: quantile sketches are averaged weighted by their
+    samples, and class counts, histograms and confusion matrices are summed.
+    """
+    from modules import federated_histogram_functions as histf
+    kind, round_idx = key
+    messages = list(aggregator["groups"][key]["messages"].values())
+    aggregator["groups"][key] = None
+    if not messages:
+        return
+    combined = {"kind": kind, "client": aggregator["id"], "n_clients": sum(m.get("n_clients", 1) for m in messages),
+                "sent_at": min(m.get("sent_at") or time.time() for m in messages)}
+    if kind == "hist_ready":
+        aggregator["participants"] = {m["client"]: m.get("n_clients", 1) for m in messages}
+        weights = [m["n_samples"] for m in messages]
+        combined.update({"n_samples": int(sum(weights)),
+                         "class_counts": np.sum([m["class_counts"] for m in messages], axis=0).tolist(),
+                         "sketch": np.average(np.array([m["sketch"] for m in messages], dtype=float), axis=0,
+                                              weights=weights if sum(weights) else None).tolist()})
+    elif kind == "hist":
+        combined["round"] = round_idx
+        combined["hist"] = histf.encode_array(histf.compact_counts(
+            sum(histf.decode_array(m["hist"]).astype(np.uint64) for m in messages)))
+    else:
+        combined["confusion"] = np.sum([m["confusion"] for m in messages], axis=0).tolist()
+        # the evaluation is the last message of the histogram mode
+        aggregator["done"].set()
+    forward(aggregator, combined)
+    print(f"{aggregator['id']}: {kind} of {len(messages)} children forwarded as one message.")
+
+def flush_expired(aggregator):
+    """
+    Function that forwards the pending rows of the clients idle for AGGREGATOR_FLUSH_SECS seconds,
+    and the histogram groups waiting for more than AGGREGATOR_WAIT seconds.
+    """
+    now = time.time()
+    for client, run in aggregator["runs"].items():
+        if run["tables"] and now - run["updated_at"] >= aggregator["conf"].get("AGGREGATOR_FLUSH_SECS", 5):
+            flush_client(aggregator, client)
+    for key, group in list(aggregator["groups"].items()):
+        if group is not None and now - group["first_at"] >= aggregator["conf"].get("AGGREGATOR_WAIT", 60):
+            forward_group(aggregator, key)
+
+def flush_all(aggregator):
+    """
+    Function that forwards every pending row and histogram group.
+    """
+    for client in list(aggregator["runs"]):
+        flush_client(aggregator, client)
+    for key, group in list(aggregator["groups"].items()):
+        if group is not None:
+            forward_group(aggregator, key)
+
+def run_aggregator(aggregator, seconds):
+    """
+    Function that relays messages for a number of seconds. The last messages of the clients are sent
+    after the server trains: in histogram mode, or when the model is broadcast, the aggregator keeps
+    relaying until the histogram evaluation or the score report of every client is forwarded.
+
+    Parameters:
+        aggregator (dict): Aggregator created by create_aggregator.
+        seconds (float): Seconds to receive the data of the clients.
+    """
+    conf = aggregator["conf"]
+    aggregator["done"].wait(seconds)
+    if conf.get("TRAINING_MODE", "central") == "histogram":
+        extra = conf.get("HIST_CLIENT_TIMEOUT", 3600)
+    elif conf.get("MODEL_BROADCAST", 0) == 1:
+        extra = conf.get("MODEL_WAIT_TIMEOUT", 7200) + conf.get("MODEL_REPORT_TIMEOUT", 600)
+    else:
+        extra = 0
+    if extra and not aggregator["done"].is_set():
+        print(f"{aggregator['id']}: Waiting for the last messages of the clients...")
+        aggregator["done"].wait(extra)
+
+def close_aggregator(aggregator):
+    """
+    Function that stops listening, forwards every pending message and reports the fan-in reduction.
+
+    Parameters:
+        aggregator (dict): Aggregator created by create_aggregator.
+
+    Returns:
+        dict: Received and forwarded messages, bytes and rows, duplicates and failures.
+    """
+    # received payloads are relayed before the worker stops
+    tf.transport_stop(aggregator["listener"])
+    aggregator["queue"].put(None)
+    aggregator["worker"].join()
+    tf.transport_stop(aggregator["upstream"])
+
+    received, forwarded = aggregator["received"], aggregator["forwarded"]
+    print(f"{aggregator['id']}: {received['messages']} messages ({received['bytes'] / 1e6:.2f} MB, {received['rows']} rows) "
+          f"received, {forwarded['messages']} messages ({forwarded['bytes'] / 1e6:.2f} MB, {forwarded['rows']} rows) "
+          f"forwarded, {aggregator['duplicates']} duplicates discarded, {aggregator['failed']} failed.")
+    return {"received": received, "forwarded": forwarded,
+            "duplicates": aggregator["duplicates"], "failed": aggregator["failed"]}
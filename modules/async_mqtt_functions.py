@@ -0,0 +1,213 @@
+import asyncio
+import os
+import time
+import paho.mqtt.client as mqtt
+from modules import mqtt_functions as mqttf
+
+def attach_asyncio_loop(aclient):
+    """
+    Function that drives the paho client socket from an asyncio event loop instead of
+    a network thread, using paho's socket hooks. The socket is opened by a worker thread while
+    connecting, so readers and writers are always registered from the event loop thread.
+
+    Parameters:
+        aclient (dict): Asyncio mqtt client state created by create_async_mqtt_client.
+
+    Returns:
+        None: registers the socket callbacks in the paho client.
+    """
+    mqttc = aclient["client"]
+    loop = aclient["loop"]
+
+    def open_socket(client, sock):
+        loop.add_reader(sock, client.loop_read)
+        aclient["misc"] = loop.create_task(misc_loop(client))
+
+    def on_socket_open(client, userdata, sock):
+        loop.call_soon_threadsafe(open_socket, client, sock)
+
+    def on_socket_close(client, userdata, sock):
+        loop.remove_reader(sock)
+        if aclient["misc"] is not None:
+            aclient["misc"].cancel()
+
+    def on_socket_register_write(client, userdata, sock):
+        loop.call_soon_threadsafe(loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(client, userdata, sock):
+        loop.remove_writer(sock)
+
+    mqttc.on_socket_open = on_socket_open
+    mqttc.on_socket_close = on_socket_close
+    mqttc.on_socket_register_write = on_socket_register_write
+    mqttc.on_socket_unregister_write = on_socket_unregister_write
+
+async def misc_loop(mqttc):
+    """
+    Coroutine that runs paho's periodic housekeeping (keepalive pings, retries) once per second.
+
+    Parameters:
+        mqttc (paho.mqtt.client.Client): Connected paho client.
+    """
+    while mqttc.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            break
+
+async def create_async_mqtt_client(conf):
+    """
+    Coroutine that creates an mqtt client driven by the running event loop and waits until
+    the broker accepts the connection.
+
+    Parameters:
+        conf (dict): config.yaml's information
+
+    Returns:
+        dict: Asyncio mqtt client state: paho client, event loop, pending acks, inbox and subscription qos.
+    """
+    loop = asyncio.get_running_loop()
+    aclient = {
+        "client": mqtt.Client(mqtt.CallbackAPIVersion.VERSION2),
+        "loop": loop,
+        "misc": None,
+        "connected": loop.create_future(),
+        "acks": {},
+        "early_acks": set(),
+        "inbox": asyncio.Queue(),
+        "qos": conf.get("MQTT_QOS", 1)
+    }
+    mqttc = aclient["client"]
+
+    def on_connect(client, userdata, flags, reason_code, properties):
+        if not aclient["connected"].done():
+            aclient["connected"].set_result(reason_code)
+
+    def on_publish(client, userdata, mid, reason_code, properties):
+        future = aclient["acks"].pop(mid, None)
+        if future is None:
+            # ack arrived before the publisher started waiting for it
+            aclient["early_acks"].add(mid)
+        elif not future.done():
+            future.set_result(mid)
+
+    def on_message(client, userdata, message):
+        aclient["inbox"].put_nowait(message.payload)
+
+    mqttc.on_connect = on_connect
+    mqttc.on_publish = on_publish
+    mqttc.on_message = on_message
+    attach_asyncio_loop(aclient)
+
+    # the TCP/TLS handshake blocks, so it runs in a worker thread and the event loop keeps running
+    await loop.run_in_executor(None, mqttc.connect, conf["MQTT_BROKER"], conf["MQTT_PORT"], conf["MQTT_KEEPALIVE"])
+    reason_code = await aclient["connected"]
+    if reason_code.is_failure:
+        raise ConnectionError(f"MQTT connection refused: {reason_code}")
+    return aclient
+
+async def close_async_mqtt_client(aclient):
+    """
+    Coroutine that disconnects the asyncio mqtt client.
+
+    Parameters:
+        aclient (dict): Asyncio mqtt client state created by create_async_mqtt_client.
+    """
+    aclient["client"].disconnect()
+    if aclient["misc"] is not None:
+        aclient["misc"].cancel()
+
+async def async_publish(aclient, topic, message, qos):
+    """
+    Coroutine that publishes a message and waits until it is acknowledged.
+    With qos 0 the message is acknowledged once it is written to the socket.
+
+    Parameters:
+        aclient (dict): Asyncio mqtt client state created by create_async_mqtt_client.
+        topic (str): Topic to publish in.
+        message (str): Message to be published.
+        qos (int): MQTT quality of service.
+
+    Returns:
+        int: Message id of the acknowledged message.
+    """
+    info = aclient["client"].publish(topic, message, qos=qos)
+    if info.rc != mqtt.MQTT_ERR_SUCCESS:
+        raise ConnectionError(f"MQTT publish failed: {mqtt.error_string(info.rc)}")
+
+    if info.mid in aclient["early_acks"]:
+        aclient["early_acks"].discard(info.mid)
+        return info.mid
+    future = aclient["loop"].create_future()
+    aclient["acks"][info.mid] = future
+    return await future
+
+async def receive_payloads(aclient, topic, duration):
+    """
+    Asynchronous iterator over the payloads received in a topic during a while, subscribed with
+    the MQTT_QOS of the client.
+
+    Parameters:
+        aclient (dict): Asyncio mqtt client state created by create_async_mqtt_client.
+        topic (str): Topic to subscribe to.
+        duration (float): Listening time in seconds.
+
+    Returns:
+        async generator: Yields each received payload (bytes) as soon as it arrives.
+    """
+    loop = aclient["loop"]
+    deadline = loop.time() + duration
+    aclient["client"].subscribe(topic, qos=aclient["qos"])
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return
+        try:
+            payload = await asyncio.wait_for(aclient["inbox"].get(), remaining)
+        except asyncio.TimeoutError:
+            return
+        yield payload
+
+async def send_file(aclient, conf, client_id, zip_path, idx, run_id, inflight):
+    """
+    Coroutine that encodes a zip file and publishes it, waiting for the broker ack.
+
+    Parameters:
+        aclient (dict): Asyncio mqtt client state created by create_async_mqtt_client.
+        conf (dict): config.yaml's information.
+        client_id (str): Client node identification.
+        zip_path (str): Path of the zip file to send.
+        idx (int): Position of the file among the client files, used to select its shard topic.
+        run_id (int): Identification of the client run.
+        inflight (asyncio.Semaphore): Limits the number of files waiting for an ack.
+    """
+    async with inflight:
+        # encode in a worker thread so the event loop keeps serving the socket
+        base64_str = await aclient["loop"].run_in_executor(None, mqttf.encode_zip_to_base64, zip_path)
+        zip_file = os.path.basename(zip_path)
+        topic, shard = mqttf.shard_topic(conf, client_id, idx)
+        message = mqttf.prepare_mqtt_message(client_id, base64_str, zip_file,
+                                             {"shard": shard, "sent_at": time.time(), "run_id": run_id, "seq": idx})
+        await async_publish(aclient, topic, message, conf.get("MQTT_QOS", 1))
+        print(f"\tFile {zip_file} published in {topic} topic.")
+
+async def async_find_and_send_msg(conf, aclient, file_queue, client_id):
+    """
+    Coroutine that sends the zip files put in a queue as soon as they are available.
+    Finishes when a None sentinel is received and every sent file has been acknowledged.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        aclient (dict): Asyncio mqtt client state created by create_async_mqtt_client.
+        file_queue (asyncio.Queue): Queue with the paths of the zip files to send.
+        client_id (str): Client node identification.
+    """
+    inflight = asyncio.Semaphore(conf.get("MQTT_MAX_INFLIGHT", 4))
+    run_id = time.time_ns()
+    tasks = []
+    while True:
+        zip_path = await file_queue.get()
+        if zip_path is None:
+            break
+        tasks.append(asyncio.create_task(send_file(aclient, conf, client_id, zip_path, len(tasks), run_id, inflight)))
+    await asyncio.gather(*tasks)
@@ -1,13 +1,33 @@
 import os
 import wget
-from pathlib import Path
 import zipfile
 import tarfile
 import json
-import chardet
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from datetime import datetime
 import re
+from modules import feature_schema_functions as fsf
+from modules import ingest_functions as ingf
+from modules import metrics_functions as mtf
+
+# Folder of the normalized tables of a theme, inside its preprocess folder
+TABLES_FOLDER = "tables"
+
+# Normalized storage: authors (and mentioned users) are interned once in a dimension table with int ids,
+# messages reference their author id, and mentions are a separate message -> author edge table
+AUTHORS_SCHEMA = pa.schema([("author_id", pa.int32()), ("user_id", pa.string()),
+                            ("name", pa.string()), ("screen_name", pa.string())])
+MESSAGES_SCHEMA = pa.schema([("thread_id", pa.int64()), ("msg_id", pa.int64()), ("is_rumour", pa.bool_()),
+                             ("text", pa.string()), ("in_reply_to_id", pa.int64()), ("author_id", pa.int32()),
+                             ("retweet_count", pa.uint32()), ("favorite_count", pa.uint32()),
+                             ("created_at", pa.string())])
+MENTIONS_SCHEMA = pa.schema([("msg_id", pa.int64()), ("author_id", pa.int32())])
+
+# Messages kept in memory before they are written as a row group of the messages table
+MESSAGES_ROW_GROUP = 10000
 
 def untar_specific_theme_data (file_url, tar_file_path, theme):
     """
@@ -17,11 +37,13 @@ def untar_specific_theme_data (file_url, tar_file_path, theme):
     Parameters:
         file_url (str): Url to download the files.
         tar_file_path (str): where to find data tar file and where to download the data.
-        theme (str): subfolder to untar. This name corresponds to client id position theme.
+        theme (str or list(str)): subfolder to untar. This name corresponds to client id position theme.
+                                  A list untars several themes from a single download.
 
     Returns:
        None: untar specified folder in specified folder.
     """  
+    themes = [theme] if isinstance(theme, str) else list(theme)
    
     # determine destination directory. Same as the tar file's directory
     destination_directory = tar_file_path
@@ -41,12 +63,12 @@ def untar_specific_theme_data (file_url, tar_file_path, theme):
 
     # Untar tar.gz file
     tar_gz_file_path = os.path.join(destination_directory, "PHEME_veracity.tar.bz2")
-    folder_to_extract = f"all-rnr-annotated-threads/{theme}"
+    folders_to_extract = tuple(f"all-rnr-annotated-threads/{theme}" for theme in themes)
     with tarfile.open(tar_gz_file_path, "r:gz") as tar:
         # Loop through all members in the tar file
         for member in tar.getmembers():
             # Check if the member starts with desired folder
-            if member.name.startswith(folder_to_extract):
+            if member.name.startswith(folders_to_extract):
                 # Extract it to the destination directory
                 tar.extract(member, path=destination_directory)
     
@@ -183,49 +205,108 @@ def clean_text (data):
     return mentions, cleaned_text
  
 
-def extract_data_and_add_to_table (df, data, msg_type):
+def extract_data_and_add_to_table (tables, data, msg_type, thread_id):
     """
-    Function that add to summary dataframe extracted features.
+    Function that adds the extracted features of a message to the normalized tables.
     From each message extracts:
         -id: Unique identifier of the message.
         -is_rumour: boolean whether is rumour or not.
         -text: Message text wihtout mentions in it.
         -in_reply_to_status_id: Relations between messages. (edges).
-        -user.screen_name, user.id and user.name: Author data (users node).
+        -user.screen_name, user.id and user.name: Author data (users node), interned in the authors table.
         -entities.user_mentions: id y name only. Relation between mentioned users (edges & nodes).
         -retweet_count & favorite_count: For node and relation ponderation.
         -created_at: For temporal analysis of diffusion.
     
     Parameters:
-        df: summary table with all messages data.
+        tables: normalized tables being written, created by create_normalized_tables.
         data: Message to be analized structure in json format.
         msg_type: Text whether indicates the message is "rumour" or not.
+        thread_id: Id of the source message of the thread.
 
     Returns:
-       df: New row is added to summary df.
+       None: New rows are added to the messages and mentions tables.
     """        
     # Remove from text other authors references
     mentions, cleaned_text = clean_text (data)       
             
-    # Create a new row dictionary
-    new_row = {
-        "id": str(data["id"]),
+    # Create a new row referencing its author by id
+    msg_id = int(data["id"])
+    tables["messages"].append({
+        "thread_id": thread_id,
+        "msg_id": msg_id,
         "is_rumour": msg_type == "rumours",
         "text": cleaned_text,        
-        "in_reply_to_id":str(data["in_reply_to_status_id"]),
-        "author": {"id": str(data["user"]["id"]), "name": data["user"]["name"],
-                "screen_name": data["user"]["screen_name"]
-            },
+        "in_reply_to_id": data["in_reply_to_status_id"],
+        "author_id": intern_author(tables, data["user"]),
         "retweet_count": data["retweet_count"],
         "favorite_count": data["favorite_count"],
-        "created_at": fomat_date(data["created_at"]),
-        "mentions": mentions
-        
-    }
-    # Add the new row to the DataFrame
-    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-    return df
-    
+        "created_at": fomat_date(data["created_at"])
+    })
+    for mention in mentions:
+        tables["mentions"].append({"msg_id": msg_id, "author_id": intern_author(tables, mention)})
+
+def intern_author(tables, user):
+    """
+    Function that obtains the int id of an author (or mentioned user), adding it to the authors table
+    the first time it is found. Authors are identified by their screen name, as graph nodes are.
+
+    Parameters:
+        tables: normalized tables being written, created by create_normalized_tables.
+        user: User structure in json format, with id, name and screen_name.
+
+    Returns:
+       int: Author id.
+    """
+    author_id = tables["author_ids"].get(user["screen_name"])
+    if author_id is None:
+        author_id = len(tables["authors"])
+        tables["author_ids"][user["screen_name"]] = author_id
+        tables["authors"].append({"author_id": author_id, "user_id": str(user["id"]),
+                                  "name": user["name"], "screen_name": user["screen_name"]})
+    return author_id
+
+def create_normalized_tables(save_path):
+    """
+    Function that creates the normalized tables of a theme. Messages and mentions are written to
+    their parquet files in row groups while the theme is traversed; authors are written at the end.
+
+    Parameters:
+      save_path (str): Directory where the tables folder is created.
+
+    Returns:
+      dict: Tables being written, with the rows not written yet and the parquet writers.
+    """
+    folder = os.path.join(save_path, TABLES_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    # every column is dictionary-encoded in the parquet files
+    writers = {name: pq.ParquetWriter(os.path.join(folder, f"{name}.parquet"), schema, use_dictionary=True)
+               for name, schema in (("messages", MESSAGES_SCHEMA), ("mentions", MENTIONS_SCHEMA))}
+    return {"folder": folder, "authors": [], "author_ids": {}, "messages": [], "mentions": [], "writers": writers}
+
+def flush_normalized_tables(tables):
+    """
+    Function that writes the pending messages and mentions as a row group of their parquet files.
+    """
+    for name, schema in (("messages", MESSAGES_SCHEMA), ("mentions", MENTIONS_SCHEMA)):
+        if tables[name]:
+            tables["writers"][name].write_table(pa.Table.from_pylist(tables[name], schema=schema))
+            tables[name] = []
+
+def close_normalized_tables(tables):
+    """
+    Function that writes the pending rows and the authors table and closes the parquet files.
+
+    Returns:
+      str: Path of the tables folder.
+    """
+    flush_normalized_tables(tables)
+    for writer in tables["writers"].values():
+        writer.close()
+    pq.write_table(pa.Table.from_pylist(tables["authors"], schema=AUTHORS_SCHEMA),
+                   os.path.join(tables["folder"], "authors.parquet"), use_dictionary=True)
+    return tables["folder"]
+
 def obtain_json_folders(path):
     """
     Function that finds only folders where jsons are in it.
@@ -277,12 +358,28 @@ def extract_type_and_threadId_from_path(path):
 def preprocess_data(path, save_path, verbose):
     """
     Recursively traverse the directory, process JSON files, and save summaries.
-    Data is saved in parquet files.
+    Data is saved in the normalized parquet tables (authors, messages and mentions) of save_path/tables.
 
     Parameters:
       path (str): Current directory path to process.
       save_path (str): Directory to save the processed parquet files.
       verbose (boolean): whether verbose log must be logged or not.
+
+    Returns:
+      str: Path of the tables folder.
+    """
+    tables = create_normalized_tables(save_path)
+    preprocess_folder(path, tables, verbose)
+    return close_normalized_tables(tables)
+
+def preprocess_folder(path, tables, verbose):
+    """
+    Recursively traverse the directory and add the messages of each thread to the normalized tables.
+
+    Parameters:
+      path (str): Current directory path to process.
+      tables (dict): Tables being written, created by create_normalized_tables.
+      verbose (boolean): whether verbose log must be logged or not.
     """
     folder_contents = os.listdir(path)  # List all items in the current directory
 
@@ -293,14 +390,9 @@ def preprocess_data(path, save_path, verbose):
             # Check if it contains `.json` files directly or process further
             if any(file.endswith(".json") for file in os.listdir(item_path)):
                 # Process this folder containing JSON files
-                msg_type, df_name = extract_type_and_threadId_from_path(item_path)
+                msg_type, thread_name = extract_type_and_threadId_from_path(item_path)
                 folders = obtain_json_folders(item_path)
-
-                # Initialize an empty DataFrame with defined columns
-                columns = ["id", "is_rumour", "text",  "in_reply_to_id", 
-                           "author", "retweet_count", "favorite_count", 
-                           "created_at", "mentions"]
-                df = pd.DataFrame(columns=columns)
+                n_messages = len(tables["messages"])
                                                 
                 # loop subfolders: reactions and source-tweets
                 for folder in folders:
@@ -310,19 +402,68 @@ def preprocess_data(path, save_path, verbose):
                     for js in jsons:
                         with open(os.path.join(folder_path, js), 'r') as file:                            
                             data = json.load(file)  # Load JSON data
-                            # Add JSON data to the DataFrame
-                            df = extract_data_and_add_to_table(df, data, msg_type)
+                            # Add JSON data to the tables
+                            extract_data_and_add_to_table(tables, data, msg_type, int(thread_name))
                 
-                # Save the DataFrame after processing the folder
-                filename = f"{df_name}.parquet"
-                full_path = os.path.join(save_path, filename)
-                df.to_parquet(full_path, engine="pyarrow")
                 if verbose:
-                    print("\tFile:", filename, "has shape:", df.shape)
+                    print("\tThread:", thread_name, "has", len(tables["messages"]) - n_messages, "messages")
+                # threads are never split between row groups being written
+                if len(tables["messages"]) >= MESSAGES_ROW_GROUP:
+                    flush_normalized_tables(tables)
             else:
                 # Recurse into subdirectories
-                preprocess_data(item_path, save_path, verbose)
-    
+                preprocess_folder(item_path, tables, verbose)
+
+def read_authors(tables_folder):
+    """
+    Function that reads the authors table of a theme.
+
+    Returns:
+      pyarrow.Table: Authors ordered by their id, so the row of an author is its id.
+    """
+    return pq.read_table(os.path.join(tables_folder, "authors.parquet")).sort_by("author_id")
+
+def read_mentions(tables_folder):
+    """
+    Function that reads the mentions table of a theme.
+
+    Returns:
+      dict: Message id -> ids of the authors it mentions, in mention order.
+    """
+    table = pq.read_table(os.path.join(tables_folder, "mentions.parquet"))
+    mentions = {}
+    for msg_id, author_id in zip(table["msg_id"].to_pylist(), table["author_id"].to_pylist()):
+        mentions.setdefault(msg_id, []).append(author_id)
+    return mentions
+
+def iterate_thread_messages(tables_folder, max_bytes=None):
+    """
+    Function that reads the messages table of a theme a row group at a time and yields complete threads.
+    The messages of a thread are contiguous in the table.
+
+    Parameters:
+      tables_folder (str): Folder of the normalized tables.
+      max_bytes (int): Bytes of messages of each yielded group of threads. None yields one thread at a time.
+
+    Returns:
+      generator: Yields pyarrow.Table with the messages of one or more complete threads, in table order.
+    """
+    pending = None
+    for batch in pq.ParquetFile(os.path.join(tables_folder, "messages.parquet")).iter_batches(batch_size=1000):
+        table = pa.Table.from_batches([batch])
+        pending = table if pending is None else pa.concat_tables([pending, table])
+        threads = pending["thread_id"].to_numpy()
+        # start row of every thread, the last one may continue in the next batch
+        starts = np.flatnonzero(threads[1:] != threads[:-1]) + 1
+        group_start, row_bytes = 0, pending.nbytes / pending.num_rows
+        for start in starts:
+            if max_bytes is None or (start - group_start) * row_bytes >= max_bytes:
+                yield pending.slice(group_start, start - group_start)
+                group_start = start
+        pending = pending.slice(group_start)
+    if pending is not None and pending.num_rows:
+        yield pending
+
 def save_as_json(data, file_path , filename, verbose):
     """
     Save the given data to a JSON file.
@@ -345,17 +486,17 @@ def save_as_json(data, file_path , filename, verbose):
     if verbose:
         print(f"\t{filename} succesfully saved.")
 
-def build_reply_structure(messages, df, message_id): 
+def build_reply_structure(messages, replies, message_id, authors, mentions): 
     """
     Recursively builds a hierarchical structure for a message and its replies.
 
     Parameters:
-        messages (dict): A dictionary where the keys are message IDs and the values are message data.
-                         Each message's data is expected to be a dictionary with attributes such as 
-                         'author', 'is_rumour', 'text', etc.
-        df (pandas.DataFrame): A DataFrame containing all messages, with at least the columns 
-                               'id' and 'in_reply_to_id'.
-        message_id (str): The ID of the message for which to build the structure.
+        messages (dict): A dictionary where the keys are message IDs and the values are message rows
+                         of the normalized messages table.
+        replies (dict): Message id -> ids of the messages of the thread that reply to it, in table order.
+        message_id (int): The ID of the message for which to build the structure.
+        authors (list(dict)): Id, name and screen name of each author, indexed by author id.
+        mentions (dict): Message id -> ids of the authors it mentions.
 
     Returns:
         dict: A nested dictionary representing the message and its replies. 
@@ -372,57 +513,113 @@ def build_reply_structure(messages, df, message_id):
     # Fetch the message from the 'messages' dictionary
     message = messages.get(message_id)   
    
-    # Get replies (messages that have this message's id as their in_reply_to_id)
-    replies = [row for _, row in df.iterrows() if row['in_reply_to_id'] == message_id]   
     # Recursively build the reply structure for each reply
     reply_structure = {}
-    for reply in replies:
+    for reply_id in replies.get(message_id, []):
         # Build structure for each reply recursively
-        reply_structure[reply['id']] = build_reply_structure(messages, df, reply['id'])
+        reply_structure[str(reply_id)] = build_reply_structure(messages, replies, reply_id, authors, mentions)
   
           
-    # Return the structure for this message with all its replies
+    # Return the structure for this message with all its replies, joining authors by id
     return {
-        "author": message['author'],
+        "author": authors[message['author_id']],
         "rumour": message['is_rumour'],
         "text": message['text'],
         "retweet_count": message['retweet_count'],
         "favorite_count": message['favorite_count'],
         "created_at": message['created_at'],
-        "mentions": message['mentions'].tolist() ,
+        "mentions": [authors[author_id] for author_id in mentions.get(message_id, [])],
         "replies": reply_structure
     }
 
 def complete_structure_json(prep_folder, save_folder):
    """
-    Converts message data from Parquet files into a structured JSON format, 
+    Converts message data from the normalized Parquet tables into a structured JSON format, 
     organizing each message and its replies hierarchically.
 
     Parameters:
-        prep_folder (str): Path to the folder containing the Parquet files. 
-                           Each file represents messages for a specific root message.
+        prep_folder (str): Path to the folder containing the tables folder. 
+                           Each thread is the source message of a thread and its replies.
         save_folder (str): Path to the folder where the structured JSON files will be saved.
 
     Returns:
         None: This function saves the structured data as JSON files in the specified save folder.
     """   
-   for file in os.listdir(prep_folder):       
-       if file.endswith(".parquet"):
-           # open table
-           df = pd.read_parquet(os.path.join(prep_folder, file), engine="pyarrow")
-            
-           # Build a dictionary of all messages indexed by their id
-           messages = {row['id']: row.drop('id') for _, row in df.iterrows()}
-            
-           # create json
-           root_message_id  = file.split(".parquet")[0]
-           structured_data = {root_message_id: build_reply_structure(messages, df, root_message_id)}
+   tables_folder = os.path.join(prep_folder, TABLES_FOLDER)
+   authors = [{"id": row["user_id"], "name": row["name"], "screen_name": row["screen_name"]}
+              for row in read_authors(tables_folder).to_pylist()]
+   mentions = read_mentions(tables_folder)
+   for thread in iterate_thread_messages(tables_folder):
+       rows = thread.to_pylist()
+       root_message_id = rows[0]["thread_id"]
+
+       # Build a dictionary of all messages indexed by their id, and of the replies of each message
+       messages = {row['msg_id']: row for row in rows}
+       replies = {}
+       for row in rows:
+           replies.setdefault(row['in_reply_to_id'], []).append(row['msg_id'])
+       if root_message_id not in messages:
+           continue
+
+       # create json
+       structured_data = {str(root_message_id): build_reply_structure(messages, replies, root_message_id,
+                                                                      authors, mentions)}
             
-           # save json
-           file_path = os.path.join(save_folder,f"{root_message_id}.json")
-           save_as_json(structured_data, file_path, f"{root_message_id}.json", False)   
+       # save json
+       file_path = os.path.join(save_folder,f"{root_message_id}.json")
+       save_as_json(structured_data, file_path, f"{root_message_id}.json", False)   
     
             
+def download_and_clean_data(data_conf, data_path, themes):
+    """
+    Function that downloads the data archive once, extracts the folders of the given themes
+    and removes not desirable files.
+
+    Parameters:
+        data_conf (dict): Configuration for downloading data, containing the key "DOWNLOAD_DATA_URL"
+                          for the URL of the data to be downloaded.
+        data_path (str): Path where the downloaded data will be extracted.
+        themes (list(str)): Themes to extract.
+
+    Returns:
+        tuple: Paths of the extracted theme folders.
+    """
+    # unzip corresponding data
+    untar_specific_theme_data(data_conf["DOWNLOAD_DATA_URL"], data_path, themes)
+    print(f"\tData downloaded: Folders {', '.join(themes)} and their subfolders extracted to {data_path}. Preparing...")
+
+    # prepare data for analysis
+    print("\tStep 1: Cleaning...")
+
+    # 1- clean not desirable files if exists. Recursively
+    root_path = os.path.join(data_path,"all-rnr-annotated-threads") # Entry point
+    clean_directory_recursively(root_path, False)
+    return tuple(os.path.join(root_path, theme) for theme in themes)
+
+def preprocess_and_structure(theme_path, out_folder, json_out_folder):
+    """
+    Function that selects the features of the messages of a downloaded theme, saved in its normalized
+    tables, and creates its message structure jsons.
+
+    Parameters:
+        theme_path (str): Path to the folder containing theme-specific data for preprocessing.
+        out_folder (str): Path to the folder where cleaned and processed data will be saved.
+        json_out_folder (str): Path to the folder where the structured JSON files will be saved.
+
+    Returns:
+        tuple: Paths of the folder with the structured JSON files and of the folder with the normalized tables.
+    """
+    # 2- Feature selection. Recursively
+    print(f"\tStep 2: Selecting and extracting features from messages of {os.path.basename(theme_path)}...")
+
+    # Start data selection
+    tables_folder = preprocess_data(theme_path, out_folder, False)
+    print(f"\tStep 3: Creating message structure jsons of {os.path.basename(theme_path)}...")
+
+    # 3- Msg structure relation json creation. Recursively.
+    complete_structure_json(out_folder, json_out_folder)
+    return json_out_folder, tables_folder
+
 def download_clean_preprocess_and_structure(data_conf, data_path, theme,
                                             theme_path, out_folder,json_out_folder):
     """
@@ -441,28 +638,33 @@ def download_clean_preprocess_and_structure(data_conf, data_path, theme,
     Returns:
         None: The function performs processing and saves outputs to the specified directories.
     """
+    download_and_clean_data(data_conf, data_path, [theme])
+    preprocess_and_structure(theme_path, out_folder, json_out_folder)
 
-    # unzip corresponding data
-    untar_specific_theme_data(data_conf["DOWNLOAD_DATA_URL"], data_path, theme)
-    print(f"\tData downloaded: Folder: {theme} and its subfolders extracted to {data_path}. Preparing...")
-            
-    # prepare data for analysis
-    print("\tStep 1: Cleaning...")
+@mtf.instrument("zip_chunk")
+def zip_chunk(chunk, save_path, theme, idx):
+    """
+    Function that saves a data chunk as an Arrow IPC stream, with the declared message schema,
+    in its own zip file. The server reads it back without parsing or inferring types.
 
-    # 1- clean not desirable files if exists. Recursively        
-    root_path = os.path.join(data_path,"all-rnr-annotated-threads") # Entry point
-    clean_directory_recursively(root_path, False)
-    
-    # 2- Feature selection. Recursively  
-    print(f"\tStep 2: Selecting and extracting features from messages ...")
+    Parameters:
+      chunk (pandas.DataFrame): Rows to be saved.
+      save_path (str): Directory to save the zipped file.
+      theme (str): Theme where data belongs to use as filename.
+      idx (int): Chunk index used in the filename.
 
-    # Start data selection
-    preprocess_data(theme_path, out_folder, False)
-    print(f"\tStep 3: Creating message structure jsons...")
+    Returns:
+      str: Path of the created zip file.
+    """
+    # compose filenames
+    file_name = f'{theme.split("-")[0]}_{idx}.arrow'
+    zip_name = f'{theme.split("-")[0]}_{idx}.zip'
+
+    # serialize the typed chunk in memory, with compressed buffers, into its own ZIP archive
+    with open(os.path.join(save_path, zip_name), "wb") as zip_file:
+        zip_file.write(ingf.write_zip_payload(fsf.to_arrow(chunk), file_name))
+    return os.path.join(save_path,zip_name)
 
-    # 3- Msg structure relation json creation. Recursively.
-    complete_structure_json(out_folder, json_out_folder)
-   
 def split_and_zip_files (file_path, save_path, theme):
     """
     Function that chunks data into smaller pieces and zips each chunk to be sent.
@@ -476,29 +678,35 @@ def split_and_zip_files (file_path, save_path, theme):
       The files are saved in zip form.
     """
 
-    # recover saved data
-    df = pd.read_parquet(file_path, engine = "pyarrow")
-    
-    # create file chunks
-    chunks = [df.iloc[i:i + 100] for i in range(0, len(df), 100)]
-    
-    # zip file chunks
-    for idx, chunk in enumerate(chunks):
-        # compose filenames
-        file_name = f'{theme.split("-")[0]}_{idx}.csv'
-        zip_name = f'{theme.split("-")[0]}_{idx}.zip'
-
-        # Save each chunk as CSV file
-        chunk.to_csv(os.path.join(save_path,file_name), index=False) 
-
-        # Compress each file into its own ZIP archive
-        with zipfile.ZipFile(os.path.join(save_path,zip_name), 'w') as zipf:
-            zipf.write(os.path.join(save_path,file_name), arcname=file_name) # csv file without path
-
-        # remove csv file
-        os.remove(os.path.join(save_path,file_name)) 
-
-
+    # recover saved data in chunks, so the whole summary is never in memory, and zip them
+    for idx, chunk in enumerate(iterate_parquet_chunks(file_path, 100)):
+        zip_chunk(chunk, save_path, theme, idx)
 
+def iterate_parquet_chunks(path, chunk_size, columns=None):
+    """
+    Function that reads a parquet file, or a folder of parquet files read as a single table,
+    in chunks of chunk_size rows, reading a record batch at a time.
 
+    Parameters:
+      path (str): Path of the parquet file or folder.
+      chunk_size (int): Rows of each chunk (the last one may be smaller).
+      columns (list(str)): Columns to read. None reads every column.
 
+    Returns:
+      generator: Yields pandas.DataFrame chunks in file and row order.
+    """
+    pending = None
+    for batch in ds.dataset(path, format="parquet").to_batches(columns=columns, batch_size=chunk_size):
+        table = pa.Table.from_batches([batch])
+        pending = table if pending is None else pa.concat_tables([pending, table], promote_options="default")
+        while pending.num_rows >= chunk_size:
+            yield pending.slice(0, chunk_size).to_pandas()
+            pending = pending.slice(chunk_size)
+    if pending is not None and pending.num_rows:
+        yield pending.to_pandas()
+
+def parquet_rows(path):
+    """
+    Function that obtains the number of rows of a parquet file or folder from its metadata, without reading it.
+    """
+    return ds.dataset(path, format="parquet").count_rows()
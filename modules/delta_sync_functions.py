@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import queue
+import pandas as pd
+from modules import mqtt_functions as mqttf
+from modules import transport_functions as tf
+from modules import data_preparation_functions as dpf
+
+# Rows of the summary fingerprinted at a time
+FINGERPRINT_CHUNK_ROWS = 10000
+
+# Rows of each zip file of changed rows, as split_and_zip_files does
+ZIP_ROWS = 100
+
+def manifest_paths(sync_path):
+    """
+    Function that obtains the paths of the acknowledged manifest, its version and the pending manifest.
+    """
+    return (os.path.join(sync_path, "manifest.parquet"), os.path.join(sync_path, "manifest.json"),
+            os.path.join(sync_path, "pending.parquet"))
+
+def load_manifest(sync_path):
+    """
+    Function that reads the manifest of the rows acknowledged by the server.
+
+    Parameters:
+        sync_path (str): Folder of the synchronization state of the client.
+
+    Returns:
+        tuple: pandas.DataFrame with the msg_id and fingerprint of every acknowledged row, and version of
+               the server partition they form (0 and no rows if nothing was acknowledged yet).
+    """
+    manifest_path, version_path, _ = manifest_paths(sync_path)
+    if not (os.path.exists(manifest_path) and os.path.exists(version_path)):
+        return pd.DataFrame({"msg_id": pd.Series(dtype=object), "fingerprint": pd.Series(dtype="uint64")}), 0
+    with open(version_path) as file:
+        version = json.load(file)["version"]
+    return pd.read_parquet(manifest_path, engine="pyarrow"), version
+
+def row_fingerprints(df):
+    """
+    Function that obtains a fingerprint of every row of message information from every column but msg_id.
+    Lists are fingerprinted through their text representation.
+
+    Parameters:
+        df (pandas.DataFrame): Message information.
+
+    Returns:
+        numpy.ndarray: uint64 fingerprint of each row.
+    """
+    values = df.drop(columns=["msg_id"])
+    for col in values.columns:
+        if values[col].dtype == object:
+            values[col] = values[col].map(str)
+    return pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+def prepare_delta(summary_path, send_folder, theme, sync_path):
+    """
+    Function that compares the message information with the manifest of acknowledged rows and zips only
+    the inserted and updated rows to be sent. Deleted rows become tombstones. The summary is read in
+    chunks, and the fingerprints of the current rows are saved as the pending manifest.
+
+    Parameters:
+        summary_path (str): Path of the msg_summary parquet file or folder.
+        send_folder (str): Folder where the zip files of changed rows are saved.
+        theme (str): Theme where data belongs to use as filename.
+        sync_path (str): Folder of the synchronization state of the client.
+
+    Returns:
+        dict: Delta with the base version, the tombstones and the number of upserted rows and files.
+    """
+    os.makedirs(sync_path, exist_ok=True)
+    manifest, version = load_manifest(sync_path)
+
+    # fingerprints of the current rows
+    parts = [pd.DataFrame({"msg_id": chunk["msg_id"].astype(str).to_numpy(), "fingerprint": row_fingerprints(chunk)})
+             for chunk in dpf.iterate_parquet_chunks(summary_path, FINGERPRINT_CHUNK_ROWS)]
+    current = pd.concat(parts, ignore_index=True).drop_duplicates("msg_id", keep="last") if parts else manifest.iloc[:0]
+    merged = current.merge(manifest, on="msg_id", how="outer", suffixes=("", "_acked"), indicator=True)
+    inserts = merged["_merge"] == "left_only"
+    updates = (merged["_merge"] == "both") & (merged["fingerprint"] != merged["fingerprint_acked"])
+    changed = set(merged.loc[inserts | updates, "msg_id"])
+    tombstones = merged.loc[merged["_merge"] == "right_only", "msg_id"].tolist()
+
+    # zip the changed rows, ZIP_ROWS rows per file
+    n_files, pending = 0, []
+    chunks = dpf.iterate_parquet_chunks(summary_path, ZIP_ROWS) if changed else []
+    for chunk in chunks:
+        pending.append(chunk[chunk["msg_id"].astype(str).isin(changed)])
+        rows = pd.concat(pending, ignore_index=True)
+        while len(rows) >= ZIP_ROWS:
+            dpf.zip_chunk(rows.iloc[:ZIP_ROWS], send_folder, theme, n_files)
+            rows, n_files = rows.iloc[ZIP_ROWS:], n_files + 1
+        pending = [rows]
+    if pending and len(pending[0]):
+        dpf.zip_chunk(pending[0], send_folder, theme, n_files)
+        n_files += 1
+
+    # the current rows become the manifest once the server acknowledges them
+    current.to_parquet(manifest_paths(sync_path)[2], engine="pyarrow", index=False)
+    print(f"\tDelta: {int(inserts.sum())} inserts, {int(updates.sum())} updates and {len(tombstones)} tombstones "
+          f"of {len(current)} rows (base version {version}), {n_files} files to send.")
+    return {"base_version": version, "tombstones": tombstones, "n_upserts": len(changed), "n_files": n_files}
+
+def send_delta_commit(conf, delta, client_id, run_id, transport=None):
+    """
+    Function that sends the commit of a delta after its files: the base version it applies to,
+    the number of files of changed rows and the tombstones.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        delta (dict): Delta created by prepare_delta.
+        client_id (str): Client node identification.
+        run_id (int): Identification of the client run that sent the files of the delta.
+        transport (dict): Transport to use. None creates one from the configuration.
+    """
+    topic, shard = mqttf.shard_topic(conf, client_id, 0)
+    message = {"kind": "delta_commit", "client": client_id, "run_id": run_id, "seq": "delta_commit",
+               "shard": shard, "sent_at": time.time(), "base_version": delta["base_version"],
+               "n_files": delta["n_files"], "tombstones": delta["tombstones"]}
+    own_transport = transport is None
+    if own_transport:
+        transport = tf.create_transport(conf)
+    tf.transport_publish(transport, topic, json.dumps(message))
+    if own_transport:
+        tf.transport_stop(transport)
+    print(f"\tDelta commit published in {topic} topic.")
+
+def start_ack_listener(conf, client_id):
+    """
+    Function that starts listening to the delta acknowledgements of a client. Clients start
+    listening before sending their delta, so no acknowledgement is missed.
+
+    Returns:
+        dict: Listener with its transport and the queue of received acknowledgements.
+    """
+    inbox = queue.Queue()
+    transport = tf.create_transport(conf)
+    tf.transport_listen(transport, mqttf.delta_ack_topic(conf, client_id), lambda payload: inbox.put(json.loads(payload)))
+    return {"transport": transport, "inbox": inbox}
+
+def wait_delta_ack(conf, listener, run_id, sync_path):
+    """
+    Function that waits for the server acknowledgement of a delta and updates the manifest:
+    an applied delta makes the pending manifest the acknowledged one, and a resync request removes
+    the manifest, so the next run sends every row. Otherwise the manifest is kept, and the next run
+    sends its delta from the same base.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        listener (dict): Listener created by start_ack_listener.
+        run_id (int): Identification of the client run that sent the delta.
+        sync_path (str): Folder of the synchronization state of the client.
+
+    Returns:
+        dict: Acknowledgement, or None if it is not received in DELTA_ACK_TIMEOUT seconds.
+    """
+    manifest_path, version_path, pending_path = manifest_paths(sync_path)
+    ack = None
+    deadline = time.time() + conf.get("DELTA_ACK_TIMEOUT", 900)
+    while ack is None and time.time() < deadline:
+        try:
+            message = listener["inbox"].get(timeout=min(1.0, max(deadline - time.time(), 0.01)))
+        except queue.Empty:
+            continue
+        # acknowledgements of previous runs may still be pending in the topic
+        if message.get("kind") == "delta_ack" and message.get("run_id") == run_id:
+            ack = message
+    tf.transport_stop(listener["transport"])
+
+    if ack is None:
+        print("\tDelta not acknowledged, the next run sends it again.")
+    elif ack["status"] == "applied":
+        os.replace(pending_path, manifest_path)
+        with open(version_path, "w") as file:
+            json.dump({"version": ack["version"]}, file)
+        print(f"\tDelta applied by the server: partition version {ack['version']} with {ack['rows']} rows.")
+    elif ack["status"] == "resync":
+        for path in (manifest_path, version_path):
+            if os.path.exists(path):
+                os.remove(path)
+        print("\tThe server does not have the base of the delta, the next run sends every row.")
+    else:
+        print(f"\tDelta {ack['status']}, the next run sends it again.")
+    return ack
@@ -0,0 +1,106 @@
+import ast
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Categories of string columns, encoded equally by every node and run. Codes follow the sorted order,
+# the one used by the label encoders of training and by the model artifacts
+CATEGORIES = {col: sorted(categories) for col, categories in {'emotion': ['Negative', 'Neutral', 'Positive']}.items()}
+
+# Declared message information schema: column -> (pandas dtype, arrow type)
+MSG_SCHEMA = {
+    "msg_id": ("object", pa.string()),
+    "msg_hour": ("int8", pa.int8()),
+    "propagate_to_msg": ("uint16", pa.uint16()),
+    "has_mentions": ("bool", pa.bool_()),
+    "mentions": ("uint8", pa.uint8()),
+    "is_reply_message": ("bool", pa.bool_()),
+    "retweets": ("uint32", pa.uint32()),
+    "favourites": ("uint32", pa.uint32()),
+    "text": ("object", pa.string()),
+    "tokens": ("object", pa.list_(pa.string())),
+    "has_link": ("bool", pa.bool_()),
+    "has_hashtag": ("bool", pa.bool_()),
+    "hashtags": ("object", pa.list_(pa.string())),
+    "emotion": (pd.CategoricalDtype(CATEGORIES['emotion']), pa.dictionary(pa.int8(), pa.string())),
+    "author": ("category", pa.dictionary(pa.int32(), pa.string())),
+    "is_rumour": ("bool", pa.bool_()),
+    "text_hash_idx": ("object", pa.list_(pa.uint16())),
+    "text_hash_val": ("object", pa.list_(pa.uint8()))
+}
+
+def apply_schema(df):
+    """
+    Function that converts the message information columns to their declared compact dtypes.
+    Integer values out of the range of their dtype are clipped to it. Columns not declared in MSG_SCHEMA
+    are kept as they are.
+
+    Parameters:
+        df (pandas.DataFrame): Message information, as extracted or as read from CSV files.
+
+    Returns:
+        pandas.DataFrame: Message information with declared dtypes.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if col not in MSG_SCHEMA:
+            continue
+        dtype, arrow_type = MSG_SCHEMA[col]
+        if pa.types.is_list(arrow_type):
+            # lists read from CSV files are their text representation
+            df[col] = df[col].map(lambda value: ast.literal_eval(value) if isinstance(value, str) else value)
+        elif arrow_type == pa.string():
+            # identifiers read from CSV files may be inferred as numbers
+            df[col] = df[col].map(lambda value: value if value is None or isinstance(value, str) else str(value))
+        elif isinstance(dtype, str) and dtype.startswith(("int", "uint")):
+            # counts beyond the range of the compact dtype saturate at its limits
+            limits = np.iinfo(dtype)
+            df[col] = np.clip(pd.to_numeric(df[col]), limits.min, limits.max).astype(dtype)
+        elif dtype == "bool" and df[col].dtype == object:
+            # booleans read from CSV files may be text
+            df[col] = df[col].map(lambda value: value in (True, "True", "true", 1)).astype(bool)
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+def arrow_schema(df):
+    """
+    Function that obtains the arrow schema of message information.
+
+    Parameters:
+        df (pandas.DataFrame): Message information.
+
+    Returns:
+        pyarrow.Schema: Declared arrow type of each column (inferred type for undeclared columns).
+    """
+    inferred = pa.Schema.from_pandas(df, preserve_index=False)
+    return pa.schema([pa.field(col, MSG_SCHEMA[col][1]) if col in MSG_SCHEMA else inferred.field(col)
+                      for col in df.columns])
+
+def to_arrow(df):
+    """
+    Function that converts message information into an arrow table with the declared types.
+
+    Parameters:
+        df (pandas.DataFrame): Message information.
+
+    Returns:
+        pyarrow.Table: Typed message information.
+    """
+    df = apply_schema(df)
+    return pa.Table.from_pandas(df, schema=arrow_schema(df), preserve_index=False)
+
+def conform_table(table):
+    """
+    Function that converts an arrow table with inferred types (e.g. read from CSV) to the declared types.
+    Tables already using them are returned as they are.
+
+    Parameters:
+        table (pyarrow.Table): Message information.
+
+    Returns:
+        pyarrow.Table: Typed message information.
+    """
+    if all(table.schema.field(col).type == MSG_SCHEMA[col][1] for col in table.column_names if col in MSG_SCHEMA):
+        return table
+    return to_arrow(table.to_pandas())
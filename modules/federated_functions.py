@@ -0,0 +1,215 @@
+import io
+import time
+import base64
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import train_test_split
+from modules import mqtt_functions as mqttf
+from modules import transport_functions as tf
+from modules import random_forest_train_functions as rftf
+from modules import resource_functions as rsf
+
+def train_local_forest(summary_path, conf):
+    """
+    Function that trains a Random Forest on the client's own message summary and
+    keeps apart a held-out set for the server to evaluate the merged ensemble.
+
+    Parameters:
+        summary_path (str): Path of the msg_summary.parquet file.
+        conf (dict): config.yaml's information.
+
+    Returns:
+        tuple: Trained model (None if the client data has a single class), number of training
+               samples and pandas.DataFrame with the held-out rows of the selected columns.
+    """
+    df = rftf.read_training_data(summary_path, rftf.SELECTED_COLUMNS)
+    train_df, holdout_df = train_test_split(df, test_size=conf.get("FEDERATED_HOLDOUT", 0.2), random_state=42)
+
+    # transform data as the server does
+    train_df = rftf.select_and_transform_data(train_df.copy(), rftf.SELECTED_COLUMNS)
+    X_train = train_df.drop('is_rumour', axis=1)
+    y_train = train_df['is_rumour']
+    if y_train.nunique() < 2:
+        print("\tLocal data has a single class, no model can be trained.")
+        return None, len(train_df), holdout_df
+
+    model = RandomForestClassifier(n_estimators=conf.get("FEDERATED_CLIENT_TREES", 100),
+                                   max_depth=conf.get("FEDERATED_MAX_DEPTH"), random_state=42,
+                                   n_jobs=rsf.stage_jobs("local_training"))
+    model.fit(X_train, y_train)
+    return model, len(train_df), holdout_df
+
+# node fields of the client trees, sent as flat arrays of every tree one after the other
+FOREST_NODE_FIELDS = ("left", "right", "feature", "threshold", "impurity", "n_node_samples", "weighted_n_node_samples")
+
+def serialize_forest(model):
+    """
+    Function that serializes only the trees of a forest as flat node arrays (compressed npz, no pickle),
+    with the information needed to merge them kept apart as JSON metadata.
+
+    Parameters:
+        model (RandomForestClassifier): Trained model.
+
+    Returns:
+        tuple: Compressed npz bytes with the node arrays and dict with the classes and feature names.
+    """
+    node_counts, nodes, values = [], {field: [] for field in FOREST_NODE_FIELDS}, []
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        node_counts.append(tree.node_count)
+        for field, array in zip(FOREST_NODE_FIELDS, (tree.children_left, tree.children_right, tree.feature,
+                                                     tree.threshold, tree.impurity, tree.n_node_samples,
+                                                     tree.weighted_n_node_samples)):
+            nodes[field].append(array)
+        values.append(tree.value[:, 0, :])
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, node_counts=np.asarray(node_counts, dtype=np.int64), value=np.concatenate(values),
+                        **{field: np.concatenate(arrays) for field, arrays in nodes.items()})
+    metadata = {"classes": [int(c) if isinstance(c, (bool, np.bool_, np.integer)) else c for c in model.classes_],
+                "feature_names": list(model.feature_names_in_)}
+    return buffer.getvalue(), metadata
+
+def deserialize_forest(data, metadata):
+    """
+    Function that rebuilds the trees serialized by serialize_forest. The arrays are checked before
+    building the trees, as they come from the clients.
+
+    Parameters:
+        data (bytes): Compressed npz bytes with the node arrays.
+        metadata (dict): Classes and feature names of the client forest.
+
+    Returns:
+        dict: Trees, classes and feature names of the client forest.
+
+    Raises:
+        ValueError: If the arrays do not describe valid trees.
+    """
+    from sklearn.tree import DecisionTreeClassifier
+    from sklearn.tree._tree import Tree, NODE_DTYPE
+
+    classes = np.asarray(metadata["classes"])
+    feature_names = list(metadata["feature_names"])
+    with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+        node_counts = arrays["node_counts"].astype(np.int64)
+        nodes = {field: arrays[field] for field in FOREST_NODE_FIELDS}
+        values = arrays["value"].astype(np.float64)
+    n_nodes = int(node_counts.sum())
+    if (node_counts < 1).any() or any(len(array) != n_nodes for array in nodes.values()) \
+            or values.shape != (n_nodes, len(classes)):
+        raise ValueError("forest arrays do not match the number of nodes or classes")
+
+    trees, offset = [], 0
+    for node_count in node_counts:
+        end = offset + int(node_count)
+        left, right = nodes["left"][offset:end].astype(np.int64), nodes["right"][offset:end].astype(np.int64)
+        feature = nodes["feature"][offset:end].astype(np.int64)
+        node_ids = np.arange(node_count)
+        is_leaf = left < 0
+        # children are always stored after their parent, so every path ends in a leaf
+        if (is_leaf != (right < 0)).any() or (is_leaf & ((left != -1) | (right != -1))).any() \
+                or (~is_leaf & ((left <= node_ids) | (right <= node_ids) | (left >= node_count)
+                                | (right >= node_count) | (feature < 0) | (feature >= len(feature_names)))).any():
+            raise ValueError("forest arrays do not describe valid trees")
+
+        state = np.zeros(node_count, dtype=NODE_DTYPE)
+        state["left_child"], state["right_child"], state["feature"] = left, right, np.where(is_leaf, -2, feature)
+        state["threshold"] = np.where(is_leaf, -2, nodes["threshold"][offset:end])
+        for field in ("impurity", "n_node_samples", "weighted_n_node_samples"):
+            state[field] = nodes[field][offset:end]
+        depth = np.zeros(node_count, dtype=np.int64)
+        for node in np.nonzero(~is_leaf)[0]:
+            depth[left[node]] = depth[right[node]] = depth[node] + 1
+
+        tree = Tree(len(feature_names), np.array([len(classes)], dtype=np.intp), 1)
+        tree.__setstate__({"max_depth": int(depth.max()), "node_count": int(node_count), "nodes": state,
+                           "values": np.ascontiguousarray(values[offset:end].reshape(node_count, 1, -1))})
+        estimator = DecisionTreeClassifier()
+        estimator.tree_ = tree
+        estimator.classes_ = classes
+        estimator.n_classes_ = len(classes)
+        estimator.n_outputs_ = 1
+        estimator.n_features_in_ = len(feature_names)
+        estimator.max_features_ = len(feature_names)
+        trees.append(estimator)
+        offset = end
+    return {"trees": trees, "classes": classes, "feature_names": feature_names}
+
+def send_local_forest(conf, model, n_samples, client_id, theme, run_id, transport=None):
+    """
+    Function that sends the serialized trees of the client forest to the server.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        model (RandomForestClassifier): Trained model.
+        n_samples (int): Number of samples used to train the model, used to weight the client in the merge.
+        client_id (str): Client node identification.
+        theme (str): Theme where data belongs to use as filename.
+        run_id (int): Identification of the client run, shared with its held-out data files.
+        transport (dict): Transport to use. None creates one from the configuration.
+    """
+    data, metadata = serialize_forest(model)
+    filename = f'{theme.split("-")[0]}_forest.npz'
+    topic, shard = mqttf.shard_topic(conf, client_id, 0)
+    message = mqttf.prepare_mqtt_message(client_id, base64.b64encode(data).decode("utf-8"), filename,
+                                         {"kind": "model", "n_samples": n_samples, "forest": metadata, "shard": shard,
+                                          "sent_at": time.time(), "run_id": run_id, "seq": "model"})
+    own_transport = transport is None
+    if own_transport:
+        transport = tf.create_transport(conf)
+    tf.transport_publish(transport, topic, message)
+    if own_transport:
+        tf.transport_stop(transport)
+    print(f"\tForest {filename} ({len(data)} bytes) published in {topic} topic.")
+
+def merge_client_forests(models, total_trees, seed=42):
+    """
+    Function that merges client forests into a single Random Forest. Each client contributes a
+    number of trees proportional to its training samples, so clients are weighted by their data size.
+
+    Parameters:
+        models (list(dict)): Received models with client, serialized data, forest metadata and n_samples.
+        total_trees (int): Number of trees of the merged forest.
+        seed (int): Seed to select the trees of each client.
+
+    Returns:
+        RandomForestClassifier: Merged forest ready to predict. None if no received forest is valid.
+    """
+    rng = np.random.default_rng(seed)
+    forests = []
+    for model in models:
+        try:
+            forest = deserialize_forest(model["data"], model["metadata"])
+        except (ValueError, KeyError) as e:
+            print(f"\t{model['client']}: forest discarded, {e}.")
+            continue
+        forests.append(dict(forest, n_samples=model["n_samples"], client=model["client"]))
+    if not forests:
+        return None
+    classes = forests[0]["classes"]
+    feature_names = forests[0]["feature_names"]
+    compatible = [forest for forest in forests
+                  if np.array_equal(forest["classes"], classes) and forest["feature_names"] == feature_names]
+    total_samples = sum(forest["n_samples"] for forest in compatible)
+
+    # shrink the merged forest if a client has fewer trees than its share, to keep proportions
+    weights = [forest["n_samples"] / total_samples for forest in compatible]
+    total_trees = min([total_trees] + [len(forest["trees"]) / weight
+                                       for forest, weight in zip(compatible, weights) if weight > 0])
+
+    trees = []
+    for forest, weight in zip(compatible, weights):
+        n_trees = min(len(forest["trees"]), max(1, round(total_trees * weight)))
+        selected = rng.choice(len(forest["trees"]), size=n_trees, replace=False)
+        trees.extend(forest["trees"][idx] for idx in selected)
+        print(f"\t{forest['client']}: {n_trees} trees ({forest['n_samples']} samples).")
+
+    # build a fitted forest from the selected trees
+    merged = RandomForestClassifier(n_estimators=len(trees), random_state=seed)
+    merged.estimators_ = trees
+    merged.estimator_ = trees[0]
+    merged.classes_ = classes
+    merged.n_classes_ = len(classes)
+    merged.n_outputs_ = 1
+    merged.n_features_in_ = len(feature_names)
+    merged.feature_names_in_ = np.array(feature_names, dtype=object)
+    return merged
@@ -0,0 +1,478 @@
+import json
+import math
+import time
+import zlib
+import queue
+import base64
+import numpy as np
+from sklearn.model_selection import train_test_split
+from modules import mqtt_functions as mqttf
+from modules import transport_functions as tf
+from modules import random_forest_train_functions as rftf
+
+# HISTOGRAM TREE FUNCTIONS
+
+def histogram_bins(conf):
+    """
+    Function that obtains the number of bins of each feature (HIST_BINS), which must fit the uint16 bins of quantize.
+    """
+    n_bins = conf.get("HIST_BINS", 32)
+    if not 2 <= n_bins <= 65536:
+        raise ValueError(f"HIST_BINS must be between 2 and 65536, got {n_bins}")
+    return n_bins
+
+def compute_quantile_sketch(X, n_bins):
+    """
+    Function that summarizes the distribution of each feature with n_bins + 1 quantiles.
+
+    Parameters:
+        X (numpy.ndarray): Feature matrix.
+        n_bins (int): Number of bins.
+
+    Returns:
+        list: One list of quantiles per feature.
+    """
+    levels = np.linspace(0, 1, n_bins + 1)
+    return np.quantile(X, levels, axis=0).T.tolist()
+
+def merge_quantile_sketches(sketches, weights):
+    """
+    Function that obtains the bin edges of each feature by averaging the client quantiles
+    weighted by their number of samples.
+
+    Parameters:
+        sketches (list): Quantile sketch of each client.
+        weights (list): Number of samples of each client.
+
+    Returns:
+        list(numpy.ndarray): Sorted inner bin edges of each feature.
+    """
+    merged = np.average(np.array(sketches, dtype=float), axis=0, weights=weights)
+    # first and last quantiles are the extremes: only inner quantiles are edges
+    return [np.unique(feature_quantiles[1:-1]) for feature_quantiles in merged]
+
+def quantize(X, bin_edges):
+    """
+    Function that replaces each feature value by its bin. A value x falls in bin b when
+    edges[b - 1] < x <= edges[b], so x <= edges[b] is equivalent to bin <= b.
+
+    Parameters:
+        X (numpy.ndarray): Feature matrix.
+        bin_edges (list): Inner bin edges of each feature.
+
+    Returns:
+        numpy.ndarray: Matrix of bins, uint8 up to 256 bins and uint16 above.
+    """
+    # the highest bin of a feature is its number of edges
+    binned = np.empty(X.shape, dtype=np.min_scalar_type(max((len(edges) for edges in bin_edges), default=0)))
+    for feature, edges in enumerate(bin_edges):
+        binned[:, feature] = np.searchsorted(np.asarray(edges), X[:, feature], side="left")
+    return binned
+
+def new_tree(class_counts):
+    """
+    Function that creates a tree with a single leaf (the root) in flat array form.
+
+    Parameters:
+        class_counts (list): Class counts of the root.
+
+    Returns:
+        dict: Tree with feature, threshold_bin, threshold, left, right, value, depth and gain lists.
+              Leaves have feature -1.
+    """
+    return {"feature": [-1], "threshold_bin": [-1], "threshold": [0.0], "left": [-1], "right": [-1],
+            "value": [list(class_counts)], "depth": [0], "gain": [0.0]}
+
+def apply_splits(binned, routes, splits):
+    """
+    Function that moves the rows of each split node to its children, so the node where each row
+    ends in each tree is updated with the splits of a round instead of routing every row again.
+
+    Parameters:
+        binned (numpy.ndarray): Matrix of bins.
+        routes (dict): Node index of each row, per tree index. Updated in place.
+        splits (list): [tree index, node index, feature, threshold bin, left child, right child] of each split.
+    """
+    for tree_idx, node, feature, threshold_bin, left, right in splits:
+        rows = np.nonzero(routes[tree_idx] == node)[0]
+        go_left = binned[rows, feature] <= threshold_bin
+        routes[tree_idx][rows] = np.where(go_left, left, right)
+
+def bootstrap_weights(n_rows, tree_idx, seed):
+    """
+    Function that obtains Poisson bootstrap weights of the rows for a tree, equal in every round.
+
+    Parameters:
+        n_rows (int): Number of rows.
+        tree_idx (int): Tree index.
+        seed (int): Client seed.
+
+    Returns:
+        numpy.ndarray: Weight of each row.
+    """
+    return np.random.default_rng([seed, tree_idx]).poisson(1.0, n_rows)
+
+def compute_histograms(binned, y, routes, weights, frontier, n_bins, n_classes):
+    """
+    Function that computes the class histogram of the requested features of each frontier node.
+
+    Parameters:
+        binned (numpy.ndarray): Matrix of bins.
+        y (numpy.ndarray): Class of each row (0 to n_classes - 1).
+        routes (dict): Node index of each row, per tree index.
+        weights (dict): Bootstrap weight of each row, per tree index.
+        frontier (list): [tree index, node index, feature list] of each node to split.
+        n_bins (int): Maximum number of bins.
+        n_classes (int): Number of classes.
+
+    Returns:
+        numpy.ndarray: uint32 array (frontier nodes, features, bins, classes).
+    """
+    n_features = len(frontier[0][2]) if frontier else 0
+    hist = np.zeros((len(frontier), n_features, n_bins, n_classes), dtype=np.uint32)
+    for idx, (tree_idx, node, features) in enumerate(frontier):
+        rows = np.nonzero(routes[tree_idx] == node)[0]
+        for pos, feature in enumerate(features):
+            flat = binned[rows, feature].astype(np.int64) * n_classes + y[rows]
+            hist[idx, pos] = np.bincount(flat, weights=weights[tree_idx][rows],
+                                         minlength=n_bins * n_classes).reshape(n_bins, n_classes)
+    return hist
+
+def gini(counts):
+    """
+    Function that calculates the gini impurity of class counts (last axis).
+    """
+    total = counts.sum(axis=-1)
+    proportions = counts / np.maximum(total, 1)[..., None]
+    return 1.0 - (proportions ** 2).sum(axis=-1)
+
+def find_best_split(node_hist, min_samples_leaf):
+    """
+    Function that finds the split with the highest weighted gini decrease of a node.
+
+    Parameters:
+        node_hist (numpy.ndarray): Histogram (features, bins, classes) of the node.
+        min_samples_leaf (int): Minimum samples of each child.
+
+    Returns:
+        tuple: Feature position, bin, gain, left counts and right counts. None if no valid split exists.
+    """
+    node_hist = node_hist.astype(np.float64)
+    left = np.cumsum(node_hist, axis=1)
+    total = left[:, -1:, :]
+    right = total - left
+    n_left = left.sum(axis=-1)
+    n_right = right.sum(axis=-1)
+    n_total = n_left + n_right
+    gain = gini(total) - (n_left * gini(left) + n_right * gini(right)) / np.maximum(n_total, 1)
+    gain[(n_left < min_samples_leaf) | (n_right < min_samples_leaf)] = -np.inf
+    position, bin_idx = np.unravel_index(np.argmax(gain), gain.shape)
+    if not gain[position, bin_idx] > 0:
+        return None
+    return position, bin_idx, float(gain[position, bin_idx] * n_total[position, bin_idx]), \
+        left[position, bin_idx].tolist(), right[position, bin_idx].tolist()
+
+def grow_trees(trees, frontier, hist, bin_edges, params):
+    """
+    Function that splits the frontier nodes with the aggregated histograms and obtains the next frontier.
+
+    Parameters:
+        trees (list(dict)): Trees in flat array form. Updated in place.
+        frontier (list): [tree index, node index, feature list] of each node to split.
+        hist (numpy.ndarray): Aggregated histograms of the frontier nodes.
+        bin_edges (list): Inner bin edges of each feature.
+        params (dict): max_depth, min_samples_split, min_samples_leaf and max_features.
+
+    Returns:
+        tuple: Nodes to split in the next round, and [tree index, node index, feature, threshold bin,
+               left child, right child] of each split made.
+    """
+    candidates = []
+    splits = []
+    for idx, (tree_idx, node, features) in enumerate(frontier):
+        split = find_best_split(hist[idx], params["min_samples_leaf"])
+        if split is None:
+            continue
+        position, bin_idx, gain, left_counts, right_counts = split
+        feature = features[position]
+        if bin_idx >= len(bin_edges[feature]):
+            continue
+
+        # the node becomes a split and its children new leaves
+        tree = trees[tree_idx]
+        tree["feature"][node] = int(feature)
+        tree["threshold_bin"][node] = int(bin_idx)
+        tree["threshold"][node] = float(bin_edges[feature][bin_idx])
+        tree["gain"][node] = gain
+        for side, counts in (("left", left_counts), ("right", right_counts)):
+            child = len(tree["feature"])
+            tree[side][node] = child
+            for key, value in (("feature", -1), ("threshold_bin", -1), ("threshold", 0.0), ("left", -1),
+                               ("right", -1), ("value", counts), ("depth", tree["depth"][node] + 1), ("gain", 0.0)):
+                tree[key].append(value)
+            candidates.append((tree_idx, child, counts))
+        splits.append([tree_idx, node, int(feature), int(bin_idx), tree["left"][node], tree["right"][node]])
+
+    return select_frontier(trees, candidates, len(bin_edges), params), splits
+
+def select_frontier(trees, candidates, n_features, params, seed=0):
+    """
+    Function that keeps the leaves that can still be split and draws the random features of each one.
+
+    Parameters:
+        trees (list(dict)): Trees in flat array form.
+        candidates (list): (tree index, node index, class counts) of the new leaves.
+        n_features (int): Number of features.
+        params (dict): max_depth, min_samples_split, min_samples_leaf and max_features.
+        seed (int): Seed to draw the features.
+
+    Returns:
+        list: [tree index, node index, feature list] of each node to split.
+    """
+    frontier = []
+    for tree_idx, node, counts in candidates:
+        counts = np.asarray(counts)
+        if (trees[tree_idx]["depth"][node] < params["max_depth"]
+                and counts.sum() >= params["min_samples_split"] and np.count_nonzero(counts) > 1):
+            frontier.append([tree_idx, node, node_features(tree_idx, node, n_features, params["max_features"], seed)])
+    return frontier
+
+def node_features(tree_idx, node, n_features, max_features, seed=0):
+    """
+    Function that draws the random features of a node. The draw only depends on the node, so clients
+    obtain the same features as the server from the node ids.
+
+    Returns:
+        list: Sorted feature indices.
+    """
+    rng = np.random.default_rng([seed, tree_idx, node])
+    return sorted(rng.choice(n_features, size=max_features, replace=False).tolist())
+
+def predict_histogram_forest_proba(trees, X):
+    """
+    Function that predicts class probabilities with trees grown from histograms, on raw features.
+
+    Parameters:
+        trees (list(dict)): Trees in flat array form.
+        X (numpy.ndarray): Feature matrix.
+
+    Returns:
+        numpy.ndarray: Average class probabilities of the trees.
+    """
+    proba = None
+    for tree in trees:
+        feature = np.asarray(tree["feature"])
+        threshold = np.asarray(tree["threshold"])
+        nodes = np.zeros(X.shape[0], dtype=np.int64)
+        active = feature[nodes] >= 0
+        while active.any():
+            rows = np.nonzero(active)[0]
+            current = nodes[rows]
+            go_left = X[rows, feature[current]] <= threshold[current]
+            nodes[rows] = np.where(go_left, np.asarray(tree["left"])[current], np.asarray(tree["right"])[current])
+            active[rows] = feature[nodes[rows]] >= 0
+        values = np.asarray(tree["value"], dtype=np.float64)
+        values = values / np.maximum(values.sum(axis=1, keepdims=True), 1)
+        proba = values[nodes] if proba is None else proba + values[nodes]
+    return proba / len(trees)
+
+def histogram_feature_importance(trees, n_features):
+    """
+    Function that calculates the normalized total gini decrease of each feature.
+    """
+    importance = np.zeros(n_features)
+    for tree in trees:
+        for feature, gain in zip(tree["feature"], tree["gain"]):
+            if feature >= 0:
+                importance[feature] += gain
+    return importance / max(importance.sum(), 1e-12)
+
+# PROTOCOL FUNCTIONS
+
+def encode_array(array):
+    """
+    Function that encodes a numpy array as compressed base64 text to be sent.
+    """
+    return {"dtype": str(array.dtype), "shape": list(array.shape),
+            "data": base64.b64encode(zlib.compress(array.tobytes())).decode("utf-8")}
+
+def compact_counts(counts):
+    """
+    Function that converts non-negative counts to the smallest unsigned dtype that holds them, so they are sent in fewer bytes.
+    """
+    return counts.astype(np.min_scalar_type(int(counts.max()) if counts.size else 0))
+
+def decode_array(encoded):
+    """
+    Function that decodes a numpy array encoded by encode_array.
+    """
+    data = zlib.decompress(base64.b64decode(encoded["data"]))
+    return np.frombuffer(data, dtype=encoded["dtype"]).reshape(encoded["shape"])
+
+def control_topic(conf):
+    """
+    Function that obtains the topic where the server sends requests to the clients.
+    """
+    return conf.get("CONTROL_TOPIC", "CONTROL")
+
+def load_client_features(summary_path, conf):
+    """
+    Function that loads and transforms the selected columns of the client summary,
+    keeping apart a held-out set for evaluation.
+
+    Returns:
+        tuple: X_train, y_train, X_holdout, y_holdout numpy arrays.
+    """
+    df = rftf.read_training_data(summary_path, rftf.SELECTED_COLUMNS)
+    df = rftf.select_and_transform_data(df, rftf.SELECTED_COLUMNS)
+    X = df.drop('is_rumour', axis=1).to_numpy(dtype=np.float64)
+    y = df['is_rumour'].to_numpy(dtype=np.int64)
+    X_train, X_holdout, y_train, y_holdout = train_test_split(X, y, test_size=conf.get("FEDERATED_HOLDOUT", 0.2),
+                                                              random_state=42)
+    return X_train, y_train, X_holdout, y_holdout
+
+def run_histogram_client(conf, summary_path, client_id):
+    """
+    Function that takes part in histogram-based federated tree building. The client sends the quantile
+    sketch of its features, answers each round with the class histograms of the requested nodes, and
+    finally evaluates the received forest on its held-out rows. No row leaves the client.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        summary_path (str): Path of the msg_summary.parquet file.
+        client_id (str): Client node identification.
+    """
+    n_bins = histogram_bins(conf)
+    X_train, y_train, X_holdout, y_holdout = load_client_features(summary_path, conf)
+    seed = zlib.crc32(client_id.encode("utf-8"))
+    topic, shard = mqttf.shard_topic(conf, client_id, 0)
+
+    # listen to server requests before announcing the client
+    inbox = queue.Queue()
+    transport = tf.create_transport(conf)
+    tf.transport_listen(transport, control_topic(conf), lambda payload: inbox.put(json.loads(payload)))
+
+    def send(message):
+        message.update({"client": client_id, "shard": shard, "sent_at": time.time()})
+        tf.transport_publish(transport, topic, json.dumps(message))
+
+    send({"kind": "hist_ready", "n_samples": int(len(y_train)),
+          "class_counts": np.bincount(y_train, minlength=2).tolist(),
+          "sketch": compute_quantile_sketch(X_train, n_bins)})
+
+    # the first request sends the bin edges, the next ones only the splits made and the nodes to split
+    binned, routes, weights, max_features = None, {}, {}, None
+    next_round = 1
+    timeout = conf.get("HIST_CLIENT_TIMEOUT", 3600)
+    while True:
+        try:
+            request = inbox.get(timeout=timeout)
+        except queue.Empty:
+            print(f"\tNo request from the server in {timeout} seconds. Leaving.")
+            break
+
+        if request["kind"] == "hist_request":
+            # the trees of the client are only complete with the splits of every round
+            if request["round"] != next_round:
+                print(f"\tRound {request['round']} received while waiting for round {next_round}. Leaving.")
+                break
+            if request["round"] == 1:
+                binned = quantize(X_train, request["bin_edges"])
+                max_features = request["max_features"]
+                for tree_idx in range(request["n_trees"]):
+                    routes[tree_idx] = np.zeros(len(y_train), dtype=np.int64)
+                    weights[tree_idx] = bootstrap_weights(len(y_train), tree_idx, seed)
+            apply_splits(binned, routes, request["splits"])
+            frontier = [[tree_idx, node, node_features(tree_idx, node, binned.shape[1], max_features)]
+                        for tree_idx, node in request["frontier"]]
+            hist = compute_histograms(binned, y_train, routes, weights, frontier, n_bins, 2)
+            send({"kind": "hist", "round": request["round"], "hist": encode_array(compact_counts(hist))})
+            print(f"\tRound {request['round']}: histograms of {len(frontier)} nodes sent.")
+            next_round += 1
+        elif request["kind"] == "hist_done":
+            # evaluate the final forest on local held-out rows and send only the confusion matrix
+            y_pred = np.argmax(predict_histogram_forest_proba(request["trees"], X_holdout), axis=1)
+            confusion = np.zeros((2, 2), dtype=np.int64)
+            np.add.at(confusion, (y_holdout, y_pred), 1)
+            send({"kind": "hist_eval", "confusion": confusion.tolist()})
+            print("\tForest received and evaluated on held-out rows.")
+            break
+    tf.transport_stop(transport)
+
+def run_histogram_server(conf):
+    """
+    Function that grows a forest from the aggregated client histograms, round by round.
+    Round 0 waits for HIST_CLIENTS clients (or TIME_LISTENING_MESSAGES) and merges their quantile
+    sketches into common bin edges. Each next round sends the splits of the previous round and the ids
+    of the nodes to split (the first one also the bin edges), and splits them with the sum of the client
+    histograms, until HIST_MAX_DEPTH is reached.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+
+    Returns:
+        tuple: Trees in flat array form and aggregated confusion matrix of the client held-out rows.
+    """
+    n_bins = histogram_bins(conf)
+    expected = conf.get("HIST_CLIENTS")
+    round_timeout = conf.get("HIST_ROUND_TIMEOUT", 300)
+    n_features = len(rftf.SELECTED_COLUMNS) - 1
+    params = {"max_depth": conf.get("HIST_MAX_DEPTH", 8), "min_samples_split": conf.get("HIST_MIN_SAMPLES_SPLIT", 10),
+              "min_samples_leaf": conf.get("HIST_MIN_SAMPLES_LEAF", 5),
+              "max_features": max(1, int(math.sqrt(n_features)))}
+
+    inbox = queue.Queue()
+    transport = tf.create_transport(conf)
+    tf.transport_listen(transport, mqttf.subscription_topic(conf, 1), lambda payload: inbox.put(json.loads(payload)))
+
+    # ROUND 0: common bin edges and root nodes
+    ready = tf.wait_messages(inbox, "hist_ready", expected, conf["TIME_LISTENING_MESSAGES"])
+    clients = sorted(ready)
+    if not clients:
+        tf.transport_stop(transport)
+        return [], None
+    # aggregators answer for every client below them
+    n_clients = sum(ready[client].get("n_clients", 1) for client in clients)
+    print(f"Server: {n_clients} clients take part: {clients}")
+    bin_edges = merge_quantile_sketches([ready[client]["sketch"] for client in clients],
+                                        [ready[client]["n_samples"] for client in clients])
+    root_counts = np.sum([ready[client]["class_counts"] for client in clients], axis=0).tolist()
+    trees = [new_tree(root_counts) for _ in range(conf.get("HIST_TREES", 10))]
+    frontier = select_frontier(trees, [(idx, 0, root_counts) for idx in range(len(trees))], n_features, params)
+
+    # ROUNDS: one tree level per round
+    round_idx = 1
+    bytes_received = 0
+    splits = []
+    while frontier:
+        request = {"kind": "hist_request", "round": round_idx, "splits": splits,
+                   "frontier": [[tree_idx, node] for tree_idx, node, _ in frontier]}
+        if round_idx == 1:
+            request.update({"n_trees": len(trees), "max_features": params["max_features"],
+                            "bin_edges": [edges.tolist() for edges in bin_edges]})
+        request = json.dumps(request)
+        tf.transport_publish(transport, control_topic(conf), request)
+        responses = tf.wait_messages(inbox, "hist", n_clients, round_timeout, round_idx)
+        if len(responses) < len(clients):
+            print(f"Server: Round {round_idx}: only {len(responses)} of {len(clients)} senders answered.")
+        if not responses:
+            break
+
+        hist = sum(decode_array(response["hist"]).astype(np.uint64) for response in responses.values())
+        round_bytes = sum(len(response["hist"]["data"]) for response in responses.values())
+        bytes_received += round_bytes
+        print(f"Server: Round {round_idx}: {len(frontier)} nodes, {len(request) / 1024:.1f} KB request, "
+              f"{round_bytes / len(responses) / 1024:.1f} KB per sender.")
+        frontier, splits = grow_trees(trees, frontier, hist, bin_edges, params)
+        round_idx += 1
+
+    # send final forest and collect held-out evaluations
+    tf.transport_publish(transport, control_topic(conf), json.dumps({"kind": "hist_done", "trees": trees}))
+    evaluations = tf.wait_messages(inbox, "hist_eval", n_clients, round_timeout)
+    tf.transport_stop(transport)
+    print(f"Server: Forest of {len(trees)} trees grown in {round_idx - 1} rounds, "
+          f"{bytes_received / 1024:.1f} KB of histograms received.")
+
+    confusion = np.sum([evaluation["confusion"] for evaluation in evaluations.values()], axis=0) \
+        if evaluations else None
+    return trees, confusion
@@ -5,8 +5,16 @@ import networkx as nx
 import pickle
 from datetime import datetime
 import re
-from textblob import TextBlob
 import pandas as pd
+import pyarrow.parquet as pq
+from modules import feature_schema_functions as fsf
+from modules import text_feature_functions as tff
+from modules import data_preparation_functions as dpf
+
+# Bytes of graph and message information in memory per byte of the messages table in Arrow, used to size
+# the groups of threads of the out-of-core mode. The peak of the python heap is about 22 times the Arrow
+# size on synthetic PHEME-like threads, the rest is left for native (Arrow, NumPy) buffers
+GRAPH_MEMORY_FACTOR = 40
 
 def add_to_graph (graph, msg_id , msg, verbose):
     """
@@ -121,6 +129,103 @@ def create_and_save_graph(json_folder, graph_folder, verbose):
         # Save the graph to a file
         with open(os.path.join(graph_folder,'graph.pkl'), 'wb') as f:
             pickle.dump(graph, f)  
+
+def author_node(author_id):
+    """
+    Function that obtains the graph node of an author of the normalized tables. Authors are negative
+    integers, so they never collide with message ids.
+    """
+    return -1 - author_id
+
+def graph_from_threads(threads, authors, mentions):
+    """
+    Function that creates the message relation graph of complete threads of the normalized tables.
+    Nodes, relations and their order are the ones add_to_graph creates from the structure jsons, but
+    nodes are integers (message ids and author_node ids), so the graph is built with integer joins
+    instead of hashing screen names.
+
+    Parameters:
+        threads (pyarrow.Table): Messages of one or more complete threads.
+        authors (pyarrow.Table): Authors table, ordered by author id.
+        mentions (dict): Message id -> ids of the authors it mentions.
+
+    Returns:
+        networkx.DiGraph: The graph of the threads.
+    """
+    user_ids, names, screen_names = (authors[col].to_pylist() for col in ("user_id", "name", "screen_name"))
+    rows = threads.to_pylist()
+    messages = {(row["thread_id"], row["msg_id"]): row for row in rows}
+    replies = {}
+    for row in rows:
+        replies.setdefault((row["thread_id"], row["in_reply_to_id"]), []).append(row["msg_id"])
+
+    nodes, edges = {}, []
+    def add_author(author_id):
+        nodes.setdefault(author_node(author_id), {"node_type": "author", "author_id": user_ids[author_id],
+                                                  "name": names[author_id], "screen_name": screen_names[author_id],
+                                                  "color": "skyblue"})
+
+    for thread_id in dict.fromkeys(row["thread_id"] for row in rows):
+        if (thread_id, thread_id) not in messages:
+            continue
+        # depth first from the source message, as the structure jsons are traversed
+        stack = [thread_id]
+        while stack:
+            msg_id = stack.pop()
+            msg = messages[(thread_id, msg_id)]
+            nodes.setdefault(msg_id, {"node_type": "msg", "text": msg["text"], "date": msg["created_at"],
+                                      "rumour": msg["is_rumour"], "color": "lightgreen"})
+            add_author(msg["author_id"])
+            edges.append((author_node(msg["author_id"]), msg_id, {"relation": "posted"}))
+            for author_id in mentions.get(msg_id, []):
+                add_author(author_id)
+                edges.append((msg_id, author_node(author_id), {"relation": "mention"}))
+            for reply_id in replies.get((thread_id, msg_id), []):
+                reply = messages[(thread_id, reply_id)]
+                edges.append((reply_id, msg_id, {"relation": "replies", "retweet": reply["retweet_count"],
+                                                 "favourite": reply["favorite_count"]}))
+            stack.extend(reversed(replies.get((thread_id, msg_id), [])))
+
+    graph = nx.DiGraph()
+    graph.add_nodes_from(nodes.items())
+    graph.add_edges_from(edges)
+    return graph
+
+def create_graph_from_tables(tables_folder):
+    """
+    Function that creates the message relation graph of a theme from its normalized tables.
+
+    Parameters:
+        tables_folder (str): Folder of the normalized tables.
+
+    Returns:
+        networkx.DiGraph: The graph of every thread of the theme.
+    """
+    threads = pq.read_table(os.path.join(tables_folder, "messages.parquet"))
+    return graph_from_threads(threads, dpf.read_authors(tables_folder), dpf.read_mentions(tables_folder))
+
+def iterate_thread_graphs(tables_folder, max_bytes):
+    """
+    Function that creates the message relation graph in groups of threads, so the graph of a whole
+    theme is never in memory. Threads are added to a group until it is expected to use max_bytes.
+    Every message feature only depends on the messages of its own thread and their authors, so the
+    information extracted from the groups is the same as from the whole graph.
+
+    Parameters:
+        tables_folder (str): Folder of the normalized tables.
+        max_bytes (int): Memory the graph of a group and its message information may use.
+
+    Returns:
+        generator: Yields the networkx.DiGraph of each group of threads.
+    """
+    authors, mentions = dpf.read_authors(tables_folder), dpf.read_mentions(tables_folder)
+    groups = 0
+    for threads in dpf.iterate_thread_messages(tables_folder, max(1, max_bytes // GRAPH_MEMORY_FACTOR)):
+        groups += 1
+        yield graph_from_threads(threads, authors, mentions)
+    if not groups:
+        yield nx.DiGraph()
+
 def extract_hour_from_date(date_string):
     """
     Function that extracts the hour from a date_string.
@@ -260,6 +365,8 @@ def detect_emotion(text):
     Returns:
         str: returns Positive, Negative or Neutral emotion of the text
     """
+    # textblob (and nltk under it) takes more than a second to import: only nodes analysing messages pay it
+    from textblob import TextBlob
     blob = TextBlob(text)
     polarity = blob.sentiment.polarity
     return "Positive" if polarity > 0 else "Negative" if polarity < 0 else "Neutral"
@@ -330,6 +437,9 @@ def extract_msg_information(df, graph, msg_id, retweets_dict, favourites_dict, p
     msg_hour = extract_hour_from_date(graph.nodes[msg_id]["date"])
     is_rumour = graph.nodes[msg_id]["rumour"]
     author = determine_message_author(msg_id, graph, {})  # Corrected call with required arguments
+    if author is not None:
+        # authors of graphs created from the normalized tables are integer nodes
+        author = graph.nodes[author].get("screen_name", author)
     mentions = message_has_mentions(msg_id, graph, {})  # Corrected call with required arguments
     is_reply_message = bool(graph.neighbors(msg_id))
     retweets = retweets_dict[msg_id]
@@ -344,7 +454,7 @@ def extract_msg_information(df, graph, msg_id, retweets_dict, favourites_dict, p
 
     # Create a new row dictionary
     new_row = {
-        "msg_id": msg_id, "msg_hour": msg_hour, "propagate_to_msg": propagate_to_msg,
+        "msg_id": str(msg_id), "msg_hour": msg_hour, "propagate_to_msg": propagate_to_msg,
         "has_mentions": len(mentions) > 0, "mentions": len(mentions),
         "is_reply_message": is_reply_message, "retweets": retweets, "favourites": favourites,
         "text": text, "tokens": tokens, "has_link": has_link,
@@ -355,9 +465,18 @@ def extract_msg_information(df, graph, msg_id, retweets_dict, favourites_dict, p
     df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
     return df
 
-def get_msg_information(graph, save_path):
+def iterate_msg_information(graph, chunk_size, conf):
     """
-    Extracts message information from the graph and returns a DataFrame.
+    Function that extracts message information from the graph in chunks, so that later
+    stages can start with the first messages while the rest are still being analyzed.
+
+    Parameters:
+        graph (networkx.DiGraph): The directed graph containing message data and relationships.
+        chunk_size (int): Maximum number of messages of each yielded chunk.
+        conf (dict): config.yaml's information. Text is only hashed when TEXT_FEATURES is 1.
+
+    Returns:
+        generator: Yields pandas.DataFrame chunks with the information of each message.
     """
     propagation_dict = {}
     visited = set()
@@ -372,6 +491,7 @@ def get_msg_information(graph, save_path):
     
     retweets_dict = {}
     favourites_dict = {}
+    text_features = conf.get("TEXT_FEATURES", 0) == 1
 
     for msg_id in total_msg:
         # Calculate retweets and favourites for each message
@@ -384,8 +504,71 @@ def get_msg_information(graph, save_path):
         # Extract message information
         df = extract_msg_information(df, graph, msg_id, retweets_dict, favourites_dict, propagation_dict)
 
+        # yield full chunk with the declared dtypes (and hashed text features if used), and start a new one
+        if len(df) >= chunk_size:
+            yield fsf.apply_schema(tff.add_text_features(df) if text_features else df)
+            df = pd.DataFrame(columns=columns)
+
+    # last chunk, or the empty table when the graph has no messages
+    if len(df) > 0 or not total_msg:
+        yield fsf.apply_schema(tff.add_text_features(df) if text_features else df)
+
+def save_msg_summary(df, save_path):
+    """
+    Function that saves the message information table as msg_summary.parquet, with the declared
+    types (authors are dictionary-encoded).
+
+    Parameters:
+        df (pandas.DataFrame): Message information table.
+        save_path (str): Folder where the summary is saved.
+
+    Returns:
+        str: Path of the saved summary.
+    """
     filename = "msg_summary.parquet"
-    df.to_parquet(os.path.join(save_path, filename), engine ="pyarrow")
+    pq.write_table(fsf.to_arrow(df), os.path.join(save_path, filename))
     print(f"\tMsg summary saved in : {os.path.join(save_path, filename)}")
     return os.path.join(save_path, filename)
 
+def get_msg_information(graph, save_path, conf):
+    """
+    Extracts message information from the graph and returns a DataFrame.
+    """
+    df = pd.concat(list(iterate_msg_information(graph, 1000, conf)), ignore_index=True)
+    return save_msg_summary(df, save_path)
+
+def stream_msg_information(tables_folder, save_path, max_bytes, conf):
+    """
+    Function that extracts the message information of a theme in the out-of-core mode: the graph is
+    created in groups of threads and the information of each group is spilled to a partition of the
+    msg_summary Parquet dataset, so neither the whole graph nor the whole table are in memory.
+
+    Parameters:
+        tables_folder (str): Folder of the normalized tables.
+        save_path (str): Folder where the msg_summary dataset folder is created.
+        max_bytes (int): Memory the graph of a group and its message information may use.
+        conf (dict): config.yaml's information.
+
+    Returns:
+        str: Path of the msg_summary dataset folder, readable as a single table by pandas and pyarrow.
+    """
+    dataset_path = os.path.join(save_path, "msg_summary")
+    os.makedirs(dataset_path, exist_ok=True)
+    for file in os.listdir(dataset_path):
+        os.remove(os.path.join(dataset_path, file))
+
+    part, groups, empty = 0, 0, None
+    for graph in iterate_thread_graphs(tables_folder, max_bytes):
+        groups += 1
+        for chunk in iterate_msg_information(graph, 1000, conf):
+            if len(chunk) == 0:
+                empty = chunk
+                continue
+            pq.write_table(fsf.to_arrow(chunk), os.path.join(dataset_path, f"part-{part:05d}.parquet"))
+            part += 1
+
+    # the empty table keeps the columns of the summary when there is no message at all
+    if part == 0:
+        pq.write_table(fsf.to_arrow(empty), os.path.join(dataset_path, "part-00000.parquet"))
+    print(f"\tMsg summary of {groups} thread groups saved in : {dataset_path}")
+    return dataset_path
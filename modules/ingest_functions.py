@@ -0,0 +1,572 @@
+import os
+import io
+import json
+import base64
+import queue
+import threading
+import time
+import hashlib
+import zipfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+from natsort import natsorted
+from modules import feature_schema_functions as fsf
+from modules import resource_functions as rsf
+from modules import metrics_functions as mtf
+
+def create_ingest_pipeline(conf, save_path, required_columns=None, on_table=None):
+    """
+    Function that creates the server ingest pipeline: a bounded queue fed by the mqtt callback
+    and a pool of worker threads that decode, validate and append each batch into memory.
+    In the out-of-core mode received zip files are always spilled and only their paths are kept in memory.
+    With DELTA_SYNC the pipeline has its own transport to acknowledge each delta as soon as it is applied.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        save_path (str): Directory where received zip files are spilled when spilling is enabled.
+        required_columns (list(str)): Columns every received batch must contain. None skips the check.
+        on_table (function): Function called with the client, filename and table of each ingested batch.
+
+    Returns:
+        dict: Pipeline state shared between the mqtt callback and the workers.
+    """
+    pipeline = {
+        "queue": queue.Queue(maxsize=conf.get("INGEST_QUEUE_SIZE", 64)),
+        "lock": threading.Lock(),
+        "tables": {},
+        "models": {},
+        "deltas": {},
+        "acks": {},
+        "ack_transport": None,
+        "conf": conf,
+        "workers": [],
+        "save_path": save_path,
+        "spill": conf.get("INGEST_SPILL_TO_DISK", 0) == 1 or rsf.resources["out_of_core"],
+        "out_of_core": rsf.resources["out_of_core"],
+        "required_columns": required_columns,
+        "on_table": on_table,
+        "ledger": {},
+        "received": 0,
+        "failed": 0,
+        "duplicates": 0,
+        "shard_metrics": {}
+    }
+
+    # create folder to spill received files
+    if pipeline["spill"]:
+        os.makedirs(save_path, exist_ok=True)
+
+    # clients wait for the acknowledgement of their delta, sent by the workers once it is applied
+    if conf.get("DELTA_SYNC", 0) == 1:
+        from modules import transport_functions as tf
+        pipeline["ack_transport"] = tf.create_transport(conf)
+
+    # start decoding workers, no more than the CPU budget of the ingest stage
+    for idx in range(max(1, min(conf.get("INGEST_WORKERS", 2), rsf.stage_jobs("ingest")))):
+        worker = threading.Thread(target=ingest_worker, args=(pipeline,),
+                                  name=f"ingest-worker-{idx}", daemon=True)
+        worker.start()
+        pipeline["workers"].append(worker)
+    return pipeline
+
+def submit_payload(pipeline, payload):
+    """
+    Function that hands a raw mqtt payload to the ingest workers.
+    Only blocks when every worker is busy and the queue is full, applying backpressure to the broker.
+
+    Parameters:
+        pipeline (dict): Ingest pipeline created by create_ingest_pipeline.
+        payload (bytes): Raw mqtt message payload.
+    """
+    pipeline["queue"].put((payload, time.time()))
+
+@mtf.instrument("read_zip_payload", items=lambda table: 0 if table is None else table.num_rows)
+def read_zip_payload(zip_file):
+    """
+    Function that reads the Arrow IPC (or CSV) members of a zip file into a single Arrow table
+    with the declared message schema, without extracting them.
+
+    Parameters:
+        zip_file (bytes or str): Zip file content, or path of the zip file.
+
+    Returns:
+        pyarrow.Table: Table with the rows of every member, or None if the zip has no data member.
+    """
+    if isinstance(zip_file, bytes):
+        zip_file = io.BytesIO(zip_file)
+    tables = []
+    with zipfile.ZipFile(zip_file, "r") as zip_ref:
+        for member in zip_ref.namelist():
+            if member.endswith(".arrow"):
+                # typed columns are used as they are, without parsing
+                with pa.ipc.open_stream(zip_ref.read(member)) as reader:
+                    tables.append(reader.read_all())
+            elif member.endswith(".csv"):
+                # files of previous versions: inferred types are converted to the declared ones
+                with zip_ref.open(member) as csv_file:
+                    tables.append(fsf.conform_table(pv.read_csv(csv_file)))
+    if not tables:
+        return None
+    return pa.concat_tables(tables, promote_options="default")
+
+def write_zip_payload(table, member):
+    """
+    Function that serializes an Arrow table as a compressed Arrow IPC stream inside a zip file in memory,
+    the form read_zip_payload reads.
+
+    Parameters:
+        table (pyarrow.Table): Rows to serialize.
+        member (str): Name of the .arrow member of the zip file.
+
+    Returns:
+        bytes: Zip file content.
+    """
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema, options=pa.ipc.IpcWriteOptions(compression="zstd")) as writer:
+        writer.write_table(table)
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "w") as zip_ref:
+        zip_ref.writestr(member, sink.getvalue().to_pybytes())
+    return zip_buffer.getvalue()
+
+def decode_payload(pipeline, payload, received_at):
+    """
+    Function that decodes and validates a received payload and appends its rows to the pipeline.
+
+    Parameters:
+        pipeline (dict): Ingest pipeline created by create_ingest_pipeline.
+        payload (bytes): Raw mqtt message payload with client, filename and base64 data fields.
+        received_at (float): Time when the payload was received.
+
+    Returns:
+        None: the decoded table is stored in the pipeline under its client and filename.
+    """
+    # Parse the JSON data
+    json_msg = json.loads(payload.decode("utf-8"))
+
+    # delta commits are applied to the client partition once every file is received
+    if json_msg.get("kind") == "delta_commit":
+        client = json_msg.get("client")
+        content_hash = hashlib.sha256(payload).hexdigest()
+        if register_in_ledger(pipeline, client, json_msg.get("run_id", 0), "delta_commit", content_hash, "delta_commit"):
+            with pipeline["lock"]:
+                pipeline["deltas"][client] = json_msg
+            print(f"Server: Delta commit received from {client} with {json_msg.get('n_files')} files "
+                  f"and {len(json_msg.get('tombstones', []))} tombstones.")
+            apply_client_delta(pipeline, client)
+        return
+
+    # Extract the Base64 encoded data
+    base64_str = json_msg.get("data")
+    filename = json_msg.get("filename")
+    client = json_msg.get("client")
+    if not base64_str or not filename:
+        raise ValueError("message without 'data' or 'filename' field")
+
+    # discard duplicates before decoding or writing anything
+    content_hash = hashlib.sha256(base64_str.encode("utf-8")).hexdigest()
+    if not register_in_ledger(pipeline, client, json_msg.get("run_id", 0),
+                              json_msg.get("seq", filename), content_hash, filename):
+        return
+
+    # Decode the Base64 string to binary
+    zip_bytes = base64.b64decode(base64_str)
+
+    # trained models are kept serialized with their metadata
+    if json_msg.get("kind") == "model":
+        with pipeline["lock"]:
+            if pipeline["ledger"][client]["files"].get(filename) == content_hash:
+                pipeline["models"][(client, filename)] = {"client": client, "data": zip_bytes,
+                                                          "metadata": json_msg.get("forest") or {},
+                                                          "n_samples": json_msg.get("n_samples", 0)}
+        print(f"Server: Model received from {client}. {filename} trained with {json_msg.get('n_samples')} samples.")
+        return
+
+    # Decode the zip to a table
+    table = read_zip_payload(zip_bytes)
+    if table is None:
+        raise ValueError(f"{filename} does not contain any data file")
+
+    # validate columns
+    required = pipeline["required_columns"] or []
+    missing = [col for col in required if col not in table.column_names]
+    if missing:
+        raise ValueError(f"{filename} is missing columns: {missing}")
+
+    # spill original file to disk if required
+    if pipeline["spill"]:
+        os.makedirs(os.path.dirname(spill_path(pipeline, client, filename)), exist_ok=True)
+        with open(spill_path(pipeline, client, filename), "wb") as file:
+            file.write(zip_bytes)
+
+    with pipeline["lock"]:
+        # a newer run of the client may have replaced this one while decoding
+        if pipeline["ledger"][client]["files"].get(filename) != content_hash:
+            return
+        if (client, filename) not in pipeline["tables"]:
+            pipeline["received"] += 1
+        # out-of-core: the rows wait in the spilled file until they are joined
+        pipeline["tables"][(client, filename)] = spill_path(pipeline, client, filename) \
+            if pipeline["out_of_core"] else table
+        update_shard_metrics(pipeline, json_msg.get("shard", client), len(payload), table.num_rows,
+                             json_msg.get("sent_at"), received_at)
+    print(f"Server: Message received from {client}. {filename} ingested with {table.num_rows} rows.")
+    if pipeline["on_table"] is not None:
+        pipeline["on_table"](client, filename, table)
+    # the last file of a delta completes it
+    if client in pipeline["deltas"]:
+        apply_client_delta(pipeline, client)
+
+def spill_path(pipeline, client, filename):
+    """
+    Function that obtains the path where a received file of a client is spilled: save_path/<client>/<filename>.
+    Clients name their files by theme, so each client has its own folder. Only the last component of
+    the received names is used, so no path taken from a message leaves the folder.
+    """
+    client_folder = os.path.basename(str(client)) or "unknown"
+    return os.path.join(pipeline["save_path"], client_folder, os.path.basename(filename))
+
+def register_in_ledger(pipeline, client, run_id, seq, content_hash, filename):
+    """
+    Function that registers a received payload in the ingest ledger, keyed by client, sequence and
+    content hash, and decides whether it must be ingested.
+    Retransmissions and redeliveries of an already registered payload are discarded. A payload of
+    a newer run of the client discards every earlier payload of that client, so reruns replace
+    previous data instead of adding to it. Payloads of older runs are discarded.
+
+    Parameters:
+        pipeline (dict): Ingest pipeline created by create_ingest_pipeline.
+        client (str): Client node identification.
+        run_id (int): Identification of the client run that sent the payload. Increases between runs.
+        seq (int): Position of the payload among the files sent in the run.
+        content_hash (str): Hash of the payload data.
+        filename (str): Filename of the payload data.
+
+    Returns:
+        bool: True if the payload must be ingested, False if it is discarded.
+    """
+    with pipeline["lock"]:
+        entry = pipeline["ledger"].get(client)
+        if entry is None or run_id > entry["run_id"]:
+            if entry is not None:
+                drop_client_data(pipeline, client)
+                print(f"Server: New run of {client}. Its previous data is replaced.")
+            entry = {"run_id": run_id, "seqs": {}, "files": {}}
+            pipeline["ledger"][client] = entry
+        elif run_id < entry["run_id"] or entry["seqs"].get(seq) == content_hash:
+            pipeline["duplicates"] += 1
+            return False
+
+        entry["seqs"][seq] = content_hash
+        entry["files"][filename] = content_hash
+        return True
+
+def drop_client_data(pipeline, client):
+    """
+    Function that removes every ingested table, model, delta commit, merged partition and spilled file of a client.
+    Must be called holding the pipeline lock.
+
+    Parameters:
+        pipeline (dict): Ingest pipeline created by create_ingest_pipeline.
+        client (str): Client node identification.
+    """
+    pipeline["deltas"].pop(client, None)
+    pipeline["acks"].pop(client, None)
+    pipeline["tables"].pop((client, "partition"), None)
+    for filename in pipeline["ledger"][client]["files"]:
+        if pipeline["tables"].pop((client, filename), None) is not None:
+            pipeline["received"] -= 1
+        pipeline["models"].pop((client, filename), None)
+        spilled_path = spill_path(pipeline, client, filename)
+        if pipeline["spill"] and os.path.exists(spilled_path):
+            os.remove(spilled_path)
+
+def update_shard_metrics(pipeline, shard, n_bytes, n_rows, sent_at, received_at):
+    """
+    Function that accumulates ingestion metrics of a shard. Must be called holding the pipeline lock.
+
+    Parameters:
+        pipeline (dict): Ingest pipeline created by create_ingest_pipeline.
+        shard (str): Shard identification (<client>/<shard>).
+        n_bytes (int): Payload size.
+        n_rows (int): Decoded rows.
+        sent_at (float): Time when the client sent the message. None if unknown.
+        received_at (float): Time when the server received the message.
+    """
+    decoded_at = time.time()
+    metrics = pipeline["shard_metrics"].setdefault(shard, {
+        "messages": 0, "bytes": 0, "rows": 0, "lag_total": 0.0, "lag_max": 0.0,
+        "queue_wait_total": 0.0, "first_at": received_at, "last_at": decoded_at
+    })
+    lag = decoded_at - (sent_at if sent_at is not None else received_at)
+    metrics["messages"] += 1
+    metrics["bytes"] += n_bytes
+    metrics["rows"] += n_rows
+    metrics["lag_total"] += lag
+    metrics["lag_max"] = max(metrics["lag_max"], lag)
+    metrics["queue_wait_total"] += decoded_at - received_at
+    metrics["first_at"] = min(metrics["first_at"], received_at)
+    metrics["last_at"] = max(metrics["last_at"], decoded_at)
+
+def shard_metrics_summary(pipeline):
+    """
+    Function that summarizes the ingestion metrics of every shard.
+
+    Parameters:
+        pipeline (dict): Ingest pipeline created by create_ingest_pipeline.
+
+    Returns:
+        pandas.DataFrame: One row per shard with messages, rows, average and maximum lag
+                          (seconds from send to decoded), average queue wait and throughput.
+    """
+    rows = []
+    with pipeline["lock"]:
+        for shard, metrics in natsorted(pipeline["shard_metrics"].items()):
+            elapsed = max(metrics["last_at"] - metrics["first_at"], 1e-6)
+            rows.append({
+                "shard": shard, "messages": metrics["messages"], "rows": metrics["rows"],
+                "lag_avg_s": metrics["lag_total"] / metrics["messages"], "lag_max_s": metrics["lag_max"],
+                "queue_wait_avg_s": metrics["queue_wait_total"] / metrics["messages"],
+                "mb_per_s": metrics["bytes"] / elapsed / 1e6,
+                "messages_per_s": metrics["messages"] / elapsed
+            })
+    return pd.DataFrame(rows)
+
+def ingest_worker(pipeline):
+    """
+    Function executed by each ingest worker thread. Consumes payloads until a None sentinel arrives.
+
+    Parameters:
+        pipeline (dict): Ingest pipeline created by create_ingest_pipeline.
+    """
+    while True:
+        item = pipeline["queue"].get()
+        if item is None:
+            pipeline["queue"].task_done()
+            return
+        try:
+            decode_payload(pipeline, *item)
+            error = None
+        except json.JSONDecodeError:
+            error = "Failed to parse JSON from message payload."
+        except base64.binascii.Error:
+            error = "Failed to decode Base64 string."
+        except Exception as e:
+            error = f"An error occurred: {e}"
+        finally:
+            pipeline["queue"].task_done()
+
+        if error:
+            print(f"Server: {error}")
+            with pipeline["lock"]:
+                pipeline["failed"] += 1
+
+def ingested_tables(pipeline):
+    """
+    Function that yields the ingested tables in natural client and filename order. In the out-of-core
+    mode they are read one at a time from the spilled files, and client partitions a row group at a time.
+
+    Parameters:
+        pipeline (dict): Ingest pipeline created by create_ingest_pipeline.
+
+    Returns:
+        generator: Yields a pyarrow.Table per ingested file or partition row group.
+    """
+    for key in natsorted(pipeline["tables"]):
+        table = pipeline["tables"][key]
+        if isinstance(table, str) and table.endswith(".parquet"):
+            partition = pq.ParquetFile(table)
+            for idx in range(partition.num_row_groups):
+                yield partition.read_row_group(idx)
+        else:
+            yield read_zip_payload(table) if isinstance(table, str) else table
+
+def sample_tables(tables, max_bytes, columns=None, seed=42):
+    """
+    Function that keeps a uniform random sample of the rows of a stream of tables that fits in max_bytes,
+    with one table of the stream in memory at a time. Every row gets a random key and the rows with the
+    smallest keys are kept (bottom-k sampling), so the sample does not depend on how rows are split in tables.
+
+    Parameters:
+        tables (iterable(pyarrow.Table)): Tables to sample. None items are skipped.
+        max_bytes (int): Memory the sample may use.
+        columns (list(str)): Columns kept in the sample. None keeps every column.
+        seed (int): Seed of the random keys.
+
+    Returns:
+        tuple: pyarrow.Table with the sampled rows in stream order (None if there is no table)
+               and number of rows of the stream.
+    """
+    rng = np.random.default_rng(seed)
+    sample, total = None, 0
+    for table in tables:
+        if table is None:
+            continue
+        if columns is not None:
+            table = table.select([col for col in columns if col in table.column_names])
+        table = table.append_column("_sample_key", pa.array(rng.random(table.num_rows)))
+        total += table.num_rows
+        sample = table if sample is None else pa.concat_tables([sample, table], promote_options="default")
+
+        # keep the rows with the smallest keys that fit, in their stream order
+        max_rows = max(1, int(max_bytes * sample.num_rows / max(sample.nbytes, 1)))
+        if sample.num_rows > max_rows:
+            keys = sample["_sample_key"].to_numpy()
+            sample = sample.take(np.sort(np.argpartition(keys, max_rows - 1)[:max_rows]))
+    if sample is None:
+        return None, 0
+    return sample.select([col for col in sample.column_names if col != "_sample_key"]), total
+
+def partition_paths(pipeline, client):
+    """
+    Function that obtains the paths of the partition of a client and of its version.
+    """
+    folder = os.path.join(pipeline["save_path"], "partitions")
+    return os.path.join(folder, f"{client}.parquet"), os.path.join(folder, f"{client}.json")
+
+def apply_client_delta(pipeline, client, final=False):
+    """
+    Function that applies the delta of a client to its partition once its commit and every file are received:
+    rows of the partition that were deleted or updated are dropped and the received rows are appended.
+    The partition is read and written a row group at a time. Only complete deltas based on the current
+    version of the partition are persisted, as a new version. A delta with another base version is
+    answered with a resync request. The received files of the client are replaced by its merged rows,
+    and the acknowledgement is published right away and stored in pipeline["acks"].
+    Called by the ingest workers, without holding the pipeline lock.
+
+    Parameters:
+        pipeline (dict): Ingest pipeline created by create_ingest_pipeline.
+        client (str): Client node identification.
+        final (bool): If True, an incomplete delta is applied too, only for this run (the server stopped receiving).
+
+    Returns:
+        dict: Acknowledgement of the delta, or None if it is not ready to be applied.
+    """
+    with pipeline["lock"]:
+        delta = pipeline["deltas"].get(client)
+        keys = natsorted(key for key in pipeline["tables"] if key[0] == client and key[1] != "partition")
+        if delta is None or (len(keys) != delta["n_files"] and not final):
+            return None
+        # only one worker applies the delta
+        pipeline["deltas"].pop(client)
+        upserts = [pipeline["tables"][key] for key in keys]
+        run_id = pipeline["ledger"][client]["run_id"]
+
+    partition_path, version_path = partition_paths(pipeline, client)
+    os.makedirs(os.path.dirname(partition_path), exist_ok=True)
+    version = 0
+    if os.path.exists(version_path):
+        with open(version_path) as file:
+            version = json.load(file)["version"]
+
+    if delta["base_version"] == 0:
+        # full snapshot: replaces the partition
+        status, base = "applied", None
+    elif delta["base_version"] != version:
+        status, base = "resync", None
+    else:
+        # a partition without rows has no file
+        status, base = "applied", partition_path if os.path.exists(partition_path) else None
+    if len(keys) != delta["n_files"]:
+        status = "incomplete" if status == "applied" else status
+
+    # rows of the base that are kept, and received rows
+    upserts = [read_zip_payload(table) if isinstance(table, str) else table for table in upserts]
+    upserts = [table for table in upserts if table is not None]
+    removed = pa.array(delta["tombstones"] + [msg_id for table in upserts for msg_id in table["msg_id"].to_pylist()],
+                       type=pa.string())
+    kept = pq.ParquetFile(base).iter_batches() if base is not None else []
+
+    # merged rows are written next to the partition, which is only replaced by an applied delta
+    merged_path = os.path.join(os.path.dirname(partition_path), f"{client}.merged.parquet")
+    writer, rows = None, 0
+    for batch in kept:
+        table = pa.Table.from_batches([batch])
+        table = table.filter(pc.invert(pc.is_in(table["msg_id"], value_set=removed)))
+        if pipeline["on_table"] is not None and table.num_rows:
+            # received rows were already handed over while receiving
+            pipeline["on_table"](client, "partition", table)
+        writer = writer or pq.ParquetWriter(merged_path, table.schema)
+        writer.write_table(table)
+        rows += table.num_rows
+    for table in upserts:
+        writer = writer or pq.ParquetWriter(merged_path, table.schema)
+        writer.write_table(table.cast(writer.schema))
+        rows += table.num_rows
+    if writer is not None:
+        writer.close()
+
+    if status == "applied":
+        version += 1
+        if writer is not None:
+            os.replace(merged_path, partition_path)
+        elif os.path.exists(partition_path):
+            os.remove(partition_path)
+        with open(version_path, "w") as file:
+            json.dump({"version": version}, file)
+        merged_path = partition_path
+    merged = None
+    if writer is not None:
+        merged = merged_path if pipeline["out_of_core"] else pq.read_table(merged_path)
+
+    ack = {"kind": "delta_ack", "client": client, "run_id": run_id, "status": status, "version": version, "rows": rows}
+    with pipeline["lock"]:
+        # a newer run of the client may have replaced this one while merging
+        if pipeline["ledger"][client]["run_id"] != run_id:
+            return None
+        # the merged rows replace the received files of the client
+        for key in keys:
+            pipeline["tables"].pop(key, None)
+        if merged is not None:
+            pipeline["tables"][(client, "partition")] = merged
+        pipeline["acks"][client] = ack
+    print(f"Server: Delta of {client} {status}: {len(upserts)} of {delta['n_files']} files and "
+          f"{len(delta['tombstones'])} tombstones, partition version {version} with {rows} rows.")
+
+    if pipeline["ack_transport"] is not None:
+        from modules import transport_functions as tf
+        from modules import mqtt_functions as mqttf
+        tf.transport_publish(pipeline["ack_transport"], mqttf.delta_ack_topic(pipeline["conf"], client), json.dumps(ack))
+    return ack
+
+def close_ingest_pipeline(pipeline, columns=None):
+    """
+    Function that drains the queue, stops the workers and returns every received row.
+    In the out-of-core mode a uniform sample of the received rows that fits the memory budget is returned.
+
+    Parameters:
+        pipeline (dict): Ingest pipeline created by create_ingest_pipeline.
+        columns (list(str)): Columns kept in the sample of the out-of-core mode. None keeps every column.
+
+    Returns:
+        pyarrow.Table: All received batches in natural client and filename order, or None if nothing was received.
+    """
+    # stop workers once pending payloads are processed
+    for _ in pipeline["workers"]:
+        pipeline["queue"].put(None)
+    for worker in pipeline["workers"]:
+        worker.join()
+
+    print(f"Server: {pipeline['received']} files ingested, {pipeline['duplicates']} duplicates discarded, "
+          f"{pipeline['failed']} failed.")
+    if pipeline["shard_metrics"]:
+        print("Server: Ingestion metrics per shard:")
+        print(shard_metrics_summary(pipeline).to_string(index=False))
+    # deltas still missing files are only used in this run, and acknowledged as incomplete
+    for client in natsorted(list(pipeline["deltas"])):
+        apply_client_delta(pipeline, client, final=True)
+    if pipeline["ack_transport"] is not None:
+        from modules import transport_functions as tf
+        tf.transport_stop(pipeline["ack_transport"])
+        print(f"Server: {len(pipeline['acks'])} delta(s) acknowledged.")
+    if not pipeline["tables"]:
+        return None
+    if pipeline["out_of_core"]:
+        table, total = sample_tables(ingested_tables(pipeline), rsf.memory_budget(), columns)
+        print(f"Server: {table.num_rows} of {total} received rows sampled to fit the memory ceiling.")
+        return table
+    return pa.concat_tables(list(ingested_tables(pipeline)), promote_options="default")
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import functools
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from modules import profiling_functions as pf
+
+# Spans of this process: tags of the node, span totals by stage and exporters. Stage process workers
+# keep their spans in "collected" instead, for the parent process to export them
+metrics = {"tags": {}, "totals": {}, "jsonl_path": None, "prom_path": None, "server": None,
+           "lock": threading.Lock(), "local": threading.local(), "collected": None}
+
+# Exported metrics: name -> (span total, Prometheus type, help text)
+PROM_METRICS = {
+    "pipeline_stage_runs_total": ("runs", "counter", "Number of times the stage ran."),
+    "pipeline_stage_seconds_total": ("seconds", "counter", "Wall seconds spent in the stage."),
+    "pipeline_stage_cpu_seconds_total": ("cpu_seconds", "counter", "CPU seconds of the process while in the stage."),
+    "pipeline_stage_items_total": ("items", "counter", "Items (messages, files, rows) processed by the stage."),
+    "pipeline_stage_read_bytes_total": ("bytes_read", "counter", "Bytes read by the process while in the stage."),
+    "pipeline_stage_written_bytes_total": ("bytes_written", "counter", "Bytes written by the process while in the stage."),
+    "pipeline_stage_peak_rss_bytes": ("peak_rss", "gauge", "Peak resident memory of the process at the end of the stage.")
+}
+
+def configure_metrics(conf, node, theme=None):
+    """
+    Function that sets the tags of the spans of this process and where they are exported:
+    a JSON-lines log of every span and a Prometheus text file with the totals of each stage,
+    both in METRICS_PATH. With METRICS_PORT the totals are also served for scraping.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        node (str): Node name, e.g. Server or Client_1.
+        theme (str): Theme of the client, None for the server.
+    """
+    metrics["tags"] = {"node": node, "theme": theme or ""}
+    metrics_path = conf.get("METRICS_PATH")
+    if metrics_path:
+        os.makedirs(metrics_path, exist_ok=True)
+        metrics["jsonl_path"] = os.path.join(metrics_path, f"metrics_{node}.jsonl")
+        metrics["prom_path"] = os.path.join(metrics_path, f"metrics_{node}.prom")
+    if conf.get("METRICS_PORT") and metrics["server"] is None:
+        metrics["server"] = start_metrics_server(conf["METRICS_PORT"])
+
+def process_memory_and_io():
+    """
+    Function that reads the peak resident memory (bytes) and the bytes read and written by the process.
+    Values are 0 where /proc is not available.
+    """
+    peak_rss, bytes_read, bytes_written = 0, 0, 0
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    peak_rss = int(line.split()[1]) * 1024
+                    break
+        with open("/proc/self/io") as file:
+            io = dict(line.split(":") for line in file.read().splitlines())
+        # rchar and wchar count files and sockets, cached or not
+        bytes_read, bytes_written = int(io["rchar"]), int(io["wchar"])
+    except (OSError, KeyError, ValueError):
+        pass
+    return peak_rss, bytes_read, bytes_written
+
+@contextlib.contextmanager
+def span(stage, **tags):
+    """
+    Context manager that measures a pipeline stage: wall and CPU time, peak resident memory, and
+    bytes read and written by the process. The stage may set record["items"] to the number of
+    items it processed. CPU time and bytes are of the whole process, so they include the threads
+    running at the same time. Stages selected in PROFILE_STAGES are also profiled.
+
+    Parameters:
+        stage (str): Stage name.
+        tags: Extra tags of the span (node and theme are added). Items known in advance may be given here.
+
+    Returns:
+        dict: Span record, exported when the stage ends (also if it fails).
+    """
+    local = metrics["local"]
+    local.depth = getattr(local, "depth", 0) + 1
+    record = {"stage": stage, "items": 0, **metrics["tags"], **tags}
+    _, start_read, start_written = process_memory_and_io()
+    profile = pf.start_stage_profile(stage) if pf.profiling["stages"] else None
+    start_cpu = time.process_time()
+    start_time = time.perf_counter()
+    record["start"] = time.time()
+    try:
+        yield record
+        record["status"] = "ok"
+    except BaseException:
+        record["status"] = "error"
+        raise
+    finally:
+        if profile is not None:
+            pf.stop_stage_profile(profile)
+        record["seconds"] = time.perf_counter() - start_time
+        record["cpu_seconds"] = time.process_time() - start_cpu
+        record["peak_rss"], end_read, end_written = process_memory_and_io()
+        record["bytes_read"] = end_read - start_read
+        record["bytes_written"] = end_written - start_written
+        local.depth -= 1
+        export_span(record, write_totals=local.depth == 0)
+
+def instrument(stage, items=None):
+    """
+    Decorator that runs every call of a function inside a span.
+
+    Parameters:
+        stage (str): Stage name.
+        items (callable): Obtains the number of processed items from the result of the function.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage) as record:
+                result = func(*args, **kwargs)
+                if items is not None:
+                    record["items"] = items(result)
+                return result
+        return wrapper
+    return decorator
+
+def export_span(record, write_totals=True):
+    """
+    Function that adds a finished span to the totals of its stage and appends it to the JSON-lines log.
+    In a stage process worker the span is only collected, to be returned to the parent process.
+
+    Parameters:
+        record (dict): Span record.
+        write_totals (bool): Whether the Prometheus file is rewritten (outermost spans only).
+    """
+    if metrics["collected"] is not None:
+        metrics["collected"].append(record)
+        return
+    key = (record["stage"], record.get("node", ""), record.get("theme", ""))
+    with metrics["lock"]:
+        totals = metrics["totals"].setdefault(key, {"runs": 0, "seconds": 0.0, "cpu_seconds": 0.0, "items": 0,
+                                                    "bytes_read": 0, "bytes_written": 0, "peak_rss": 0})
+        totals["runs"] += 1
+        for name in ("seconds", "cpu_seconds", "items", "bytes_read", "bytes_written"):
+            totals[name] += record[name]
+        totals["peak_rss"] = max(totals["peak_rss"], record["peak_rss"])
+
+        if metrics["jsonl_path"]:
+            with open(metrics["jsonl_path"], "a") as file:
+                file.write(json.dumps(record, default=str) + "\n")
+    if write_totals:
+        write_prometheus()
+
+def prometheus_text():
+    """
+    Function that obtains the totals of every stage in the Prometheus text format.
+
+    Returns:
+        str: Metrics labelled by stage, node and theme.
+    """
+    lines = []
+    with metrics["lock"]:
+        totals = dict(metrics["totals"])
+    for name, (total, prom_type, help_text) in PROM_METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {prom_type}")
+        for (stage, node, theme), values in totals.items():
+            lines.append(f'{name}{{stage="{stage}",node="{node}",theme="{theme}"}} {values[total]}')
+    return "\n".join(lines) + "\n"
+
+def write_prometheus():
+    """
+    Function that rewrites the Prometheus text file of the node, so a reader never sees a partial file.
+    """
+    if not metrics["prom_path"]:
+        return
+    tmp_path = f"{metrics['prom_path']}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(prometheus_text())
+    os.replace(tmp_path, metrics["prom_path"])
+
+def start_metrics_server(port):
+    """
+    Function that serves the Prometheus text of the node at http://<node>:<port>/metrics in a background thread.
+
+    Parameters:
+        port (int): Port to listen to.
+
+    Returns:
+        http.server.ThreadingHTTPServer: Running server.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = prometheus_text().encode("utf-8")
+            self.send_response(200 if self.path.startswith("/metrics") else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics: serving stage metrics at port {port}/metrics.")
+    return server
@@ -0,0 +1,305 @@
+import os
+import io
+import json
+import time
+import uuid
+import shutil
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from modules import feature_schema_functions as fsf
+from modules import text_feature_functions as tff
+from modules import metrics_functions as mtf
+
+# version of the artifact layout, increased when the stored arrays change
+ARTIFACT_FORMAT = 1
+
+# tree levels descended by the scoring engine between removals of the (row, tree) pairs already in a leaf
+COMPACT_STEPS = 4
+
+def create_artifact(trees, classes, feature_names, training_mode, metrics=None):
+    """
+    Function that flattens a list of trees into a model artifact: every node of every tree is a
+    position in the same arrays, so a forest is scored with array operations only.
+
+    Parameters:
+        trees (list(dict)): Trees with feature, threshold, left, right (node positions inside the tree,
+                            -1 for leaves) and value (class counts or probabilities of each node) lists.
+        classes (list): Classes of the model, in the order of the values.
+        feature_names (list(str)): Names of the features, in the order used by the trees. Hashed text
+                                   features, if used, follow the scalar features.
+        training_mode (str): Training mode that produced the model.
+        metrics (dict): Evaluation metrics to keep with the model. None keeps none.
+
+    Returns:
+        dict: Artifact with arrays (roots, feature, threshold, left, right, proba) and metadata
+              (feature schema, label encodings, classes...).
+    """
+    roots, features, thresholds, lefts, rights, probas = [], [], [], [], [], []
+    offset = 0
+    for tree in trees:
+        feature = np.asarray(tree["feature"], dtype=np.int32)
+        left = np.asarray(tree["left"], dtype=np.int32)
+        right = np.asarray(tree["right"], dtype=np.int32)
+        is_leaf = feature < 0
+
+        # leaves point to themselves, so finished rows stay in place while others go down
+        node_ids = np.arange(len(feature), dtype=np.int32) + offset
+        roots.append(offset)
+        features.append(np.where(is_leaf, 0, feature))
+        thresholds.append(np.where(is_leaf, np.inf, np.asarray(tree["threshold"], dtype=np.float64)))
+        lefts.append(np.where(is_leaf, node_ids, left + offset))
+        rights.append(np.where(is_leaf, node_ids, right + offset))
+        value = np.asarray(tree["value"], dtype=np.float64).reshape(len(feature), -1)
+        probas.append(value / np.maximum(value.sum(axis=1, keepdims=True), 1e-12))
+        offset += len(feature)
+
+    depth = max((tree_depth(tree) for tree in trees), default=0)
+    text_names = set(tff.text_feature_names())
+    scalar_names = [name for name in feature_names if name not in text_names]
+    return {
+        "arrays": {
+            "roots": np.asarray(roots, dtype=np.int32),
+            "feature": np.concatenate(features),
+            "threshold": np.concatenate(thresholds),
+            "left": np.concatenate(lefts),
+            "right": np.concatenate(rights),
+            "proba": np.concatenate(probas).astype(np.float32)
+        },
+        "metadata": {
+            "format": ARTIFACT_FORMAT,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "training_mode": training_mode,
+            "n_trees": len(trees),
+            "n_nodes": offset,
+            "max_depth": depth,
+            "classes": [int(c) if isinstance(c, (bool, np.bool_, np.integer)) else c for c in classes],
+            "features": scalar_names,
+            "text_features": len(feature_names) - len(scalar_names),
+            "target": "is_rumour",
+            "encodings": {col: list(categories) for col, categories in fsf.CATEGORIES.items()
+                          if col in feature_names},
+            "metrics": metrics or {}
+        }
+    }
+
+def tree_depth(tree):
+    """
+    Function that obtains the depth of a tree in flat array form.
+    """
+    depth = {0: 0}
+    for node, (left, right) in enumerate(zip(tree["left"], tree["right"])):
+        if left >= 0:
+            depth[left] = depth[right] = depth[node] + 1
+    return max(depth.values())
+
+def forest_artifact(model, training_mode, metrics=None, feature_names=None):
+    """
+    Function that creates the model artifact of a trained RandomForestClassifier.
+
+    Parameters:
+        model (RandomForestClassifier): Trained model.
+        training_mode (str): Training mode that produced the model.
+        metrics (dict): Evaluation metrics to keep with the model.
+        feature_names (list(str)): Names of the features. None uses the names seen in training
+                                   (not available for models trained with sparse matrices).
+
+    Returns:
+        dict: Model artifact.
+    """
+    trees = []
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        trees.append({"feature": tree.feature, "threshold": tree.threshold, "left": tree.children_left,
+                      "right": tree.children_right, "value": tree.value[:, 0, :]})
+    feature_names = feature_names or list(model.feature_names_in_)
+    return create_artifact(trees, list(model.classes_), feature_names, training_mode, metrics)
+
+def save_model_artifact(artifact, model_path, version=None):
+    """
+    Function that saves a model artifact as the next version: arrays in model.npz and metadata in
+    metadata.json inside <model_path>/v<version>.
+
+    Parameters:
+        artifact (dict): Model artifact.
+        model_path (str): Folder with every model version.
+        version (int): Version to save the artifact as. None uses the next version.
+
+    Returns:
+        int: Saved version.
+    """
+    os.makedirs(model_path, exist_ok=True)
+    if version is None:
+        versions = list_model_versions(model_path)
+        version = versions[-1] + 1 if versions else 1
+    artifact["metadata"]["version"] = version
+
+    # write in a temporary folder and rename, so readers never see partial versions
+    version_path = os.path.join(model_path, f"v{version}")
+    tmp_path = f"{version_path}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_path)
+    np.savez_compressed(os.path.join(tmp_path, "model.npz"), **artifact["arrays"])
+    with open(os.path.join(tmp_path, "metadata.json"), "w") as file:
+        json.dump(artifact["metadata"], file, indent=2)
+    try:
+        os.rename(tmp_path, version_path)
+    except OSError:
+        # the version was saved meanwhile by another process
+        shutil.rmtree(tmp_path)
+        if not os.path.isdir(version_path):
+            raise
+    return version
+
+def artifact_to_bytes(artifact):
+    """
+    Function that serializes the arrays of a model artifact as compressed npz bytes, to be sent.
+    """
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **artifact["arrays"])
+    return buffer.getvalue()
+
+def artifact_from_bytes(data, metadata):
+    """
+    Function that recovers a model artifact from the bytes created by artifact_to_bytes and its metadata.
+    """
+    with np.load(io.BytesIO(data)) as arrays:
+        return {"arrays": {name: arrays[name] for name in arrays.files}, "metadata": metadata}
+
+def list_model_versions(model_path):
+    """
+    Function that lists the saved model versions in increasing order.
+    """
+    if not os.path.isdir(model_path):
+        return []
+    return sorted(int(name[1:]) for name in os.listdir(model_path)
+                  if name.startswith("v") and name[1:].isdigit())
+
+def load_model_artifact(model_path, version=None):
+    """
+    Function that loads a saved model artifact.
+
+    Parameters:
+        model_path (str): Folder with every model version.
+        version (int): Version to load. None loads the latest one.
+
+    Returns:
+        dict: Model artifact.
+    """
+    versions = list_model_versions(model_path)
+    if not versions:
+        raise FileNotFoundError(f"No model saved in {model_path}")
+    version_path = os.path.join(model_path, f"v{version or versions[-1]}")
+    with open(os.path.join(version_path, "metadata.json")) as file:
+        metadata = json.load(file)
+    if metadata["format"] != ARTIFACT_FORMAT:
+        raise ValueError(f"Unsupported model artifact format: {metadata['format']}")
+    with np.load(os.path.join(version_path, "model.npz")) as arrays:
+        return {"arrays": {name: arrays[name] for name in arrays.files}, "metadata": metadata}
+
+def prepare_features(df, artifact):
+    """
+    Function that transforms message information into the feature matrix of a model, with the
+    feature schema and label encodings stored in the artifact.
+
+    Parameters:
+        df (pandas.DataFrame): Message information with (at least) the model features.
+        artifact (dict): Model artifact.
+
+    Returns:
+        numpy.ndarray: float32 feature matrix, as used by the trees. Unknown categories are encoded as -1.
+                       scipy.sparse.csr_matrix if the model uses hashed text features.
+    """
+    metadata = artifact["metadata"]
+    missing = [col for col in metadata["features"] if col not in df.columns]
+    if missing:
+        raise ValueError(f"Missing model features: {missing}")
+
+    X = np.empty((len(df), len(metadata["features"])), dtype=np.float32)
+    for idx, col in enumerate(metadata["features"]):
+        if col in metadata["encodings"]:
+            codes = {category: code for code, category in enumerate(metadata["encodings"][col])}
+            X[:, idx] = df[col].astype(object).map(codes).fillna(-1).to_numpy(dtype=np.float32)
+        else:
+            X[:, idx] = df[col].to_numpy(dtype=np.float32)
+
+    if metadata.get("text_features", 0):
+        # messages of summaries without hashed text features have no tokens
+        text_columns = list(tff.TEXT_HASH_COLUMNS)
+        text = tff.text_matrix(fsf.to_arrow(df[text_columns])) if all(col in df.columns for col in text_columns) \
+            else sp.csr_matrix((len(df), tff.TEXT_HASH_FEATURES), dtype=np.float32)
+        X = sp.hstack([sp.csr_matrix(X), text], format="csr")
+    return X
+
+def score_batch(artifact, X, block_size=8192):
+    """
+    Function that obtains the class probabilities of every row, traversing all the trees at once
+    for a block of rows. Each step moves every (row, tree) pair not yet in a leaf one level down,
+    so deep branches only cost for the few pairs that reach them.
+
+    Parameters:
+        artifact (dict): Model artifact.
+        X (numpy.ndarray or scipy.sparse matrix): Feature matrix created by prepare_features. Of sparse
+                                                   matrices only the columns used by the trees are densified.
+        block_size (int): Rows scored together, which bounds the memory used.
+
+    Returns:
+        numpy.ndarray: Average class probabilities of the trees for each row.
+    """
+    arrays = artifact["arrays"]
+    feature, threshold, roots = arrays["feature"], arrays["threshold"], arrays["roots"]
+    # children interleaved: child of node n is children[2 * n] (left) or children[2 * n + 1] (right)
+    children = np.stack([arrays["left"], arrays["right"]], axis=1).ravel().astype(np.int32)
+    is_leaf = arrays["left"] == np.arange(len(feature))
+    if sp.issparse(X):
+        # keep only the columns used by some split, renumbering the features of the nodes
+        used = np.unique(feature[~is_leaf])
+        position = np.zeros(X.shape[1], dtype=feature.dtype)
+        position[used] = np.arange(len(used))
+        X = sp.csc_matrix(X)[:, used].toarray()
+        feature = position[feature]
+    n_features = X.shape[1]
+    proba = np.empty((X.shape[0], arrays["proba"].shape[1]), dtype=np.float32)
+    for start in range(0, X.shape[0], block_size):
+        block = np.ascontiguousarray(X[start:start + block_size]).ravel()
+        n_rows = len(block) // max(n_features, 1)
+
+        # one position per (row, tree) pair; only pairs not in a leaf are kept in the active arrays
+        nodes = np.tile(roots, n_rows).astype(np.int32)
+        positions = np.nonzero(~is_leaf[nodes])[0].astype(np.int32)
+        current = nodes[positions]
+        row_offsets = (positions // len(roots) * n_features).astype(np.int32)
+        step = 0
+        while len(positions):
+            go_right = block[row_offsets + feature[current]] > threshold[current]
+            current = children[2 * current + go_right]
+            step += 1
+
+            # leaves point to themselves, so finished pairs are only removed every few steps
+            if step % COMPACT_STEPS == 0:
+                finished = is_leaf[current]
+                nodes[positions[finished]] = current[finished]
+                keep = ~finished
+                positions, current, row_offsets = positions[keep], current[keep], row_offsets[keep]
+        nodes[positions] = current
+        proba[start:start + n_rows] = arrays["proba"][nodes].reshape(n_rows, len(roots), -1).mean(axis=1)
+    return proba
+
+@mtf.instrument("score_messages", items=len)
+def score_messages(df, artifact):
+    """
+    Function that scores message information with a model artifact.
+
+    Parameters:
+        df (pandas.DataFrame): Message information with msg_id and the model features.
+        artifact (dict): Model artifact.
+
+    Returns:
+        pandas.DataFrame: msg_id, probability of each class and predicted class of each message.
+    """
+    proba = score_batch(artifact, prepare_features(df, artifact))
+    classes = artifact["metadata"]["classes"]
+    scores = pd.DataFrame({"msg_id": df["msg_id"].to_numpy()})
+    for idx, label in enumerate(classes):
+        scores[f"proba_{label}"] = proba[:, idx]
+    scores["prediction"] = np.asarray(classes)[np.argmax(proba, axis=1)]
+    return scores
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import queue
+import base64
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from modules import mqtt_functions as mqttf
+from modules import transport_functions as tf
+from modules import model_artifact_functions as maf
+from modules import resource_functions as rsf
+
+# Messages scored at a time in the out-of-core mode
+SCORE_BATCH_ROWS = 50000
+
+def model_topic(conf):
+    """
+    Function that obtains the topic where the server broadcasts trained models.
+    """
+    return conf.get("MODEL_TOPIC", "MODEL")
+
+def broadcast_model(conf, artifact, expected):
+    """
+    Function that publishes a model artifact for the clients to score their own messages,
+    and collects the score reports they send back.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        artifact (dict): Saved model artifact (with its version).
+        expected (int): Number of client reports to wait for.
+
+    Returns:
+        pandas.DataFrame: One row per reporting client with its scored and flagged messages
+                          and, when its messages are labelled, its accuracy.
+    """
+    inbox = queue.Queue()
+    transport = tf.create_transport(conf)
+    tf.transport_listen(transport, mqttf.subscription_topic(conf, 1), lambda payload: inbox.put(json.loads(payload)))
+
+    data = maf.artifact_to_bytes(artifact)
+    message = {"kind": "model_broadcast", "version": artifact["metadata"]["version"],
+               "metadata": artifact["metadata"], "data": base64.b64encode(data).decode("utf-8")}
+    tf.transport_publish(transport, model_topic(conf), json.dumps(message))
+    print(f"Server: Model version {message['version']} broadcast ({len(data) / 1024:.1f} KB).")
+
+    reports = tf.wait_messages(inbox, "scores", expected, conf.get("MODEL_REPORT_TIMEOUT", 600))
+    tf.transport_stop(transport)
+    rows = []
+    for client, report in sorted(reports.items()):
+        confusion = np.asarray(report["confusion"]) if report.get("confusion") else None
+        rows.append({"client": client, "version": report["version"], "messages": report["n_messages"],
+                     "flagged": report["n_flagged"], "mean_proba": report["mean_proba"],
+                     "accuracy": confusion.trace() / max(confusion.sum(), 1) if confusion is not None else np.nan})
+        if report["flagged_ids"]:
+            print(f"Server: {client} flagged messages: {report['flagged_ids']}")
+    return pd.DataFrame(rows)
+
+def start_model_listener(conf):
+    """
+    Function that starts listening to the model topic. Clients start listening before sending their
+    data, so no broadcast is missed.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+
+    Returns:
+        dict: Model listener with its transport and the queue of received broadcasts.
+    """
+    inbox = queue.Queue()
+    transport = tf.create_transport(conf)
+    tf.transport_listen(transport, model_topic(conf), lambda payload: inbox.put(json.loads(payload)))
+    return {"transport": transport, "inbox": inbox}
+
+def receive_model(conf, listener):
+    """
+    Function that waits for a broadcast model. Models already in the client cache (by version)
+    are loaded from it instead of being decoded again.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        listener (dict): Model listener created by start_model_listener.
+
+    Returns:
+        dict: Model artifact, or None if no model is received in MODEL_WAIT_TIMEOUT seconds.
+    """
+    timeout = conf.get("MODEL_WAIT_TIMEOUT", 7200)
+    try:
+        message = listener["inbox"].get(timeout=timeout)
+    except queue.Empty:
+        return None
+    finally:
+        tf.transport_stop(listener["transport"])
+
+    cache_path = conf.get("MODEL_CACHE_PATH", "/usr/local/app/model_cache")
+    version = message["version"]
+    if version in maf.list_model_versions(cache_path):
+        print(f"\tModel version {version} found in cache.")
+        return maf.load_model_artifact(cache_path, version)
+
+    artifact = maf.artifact_from_bytes(base64.b64decode(message["data"]), message["metadata"])
+    maf.save_model_artifact(artifact, cache_path, version)
+    print(f"\tModel version {version} received and cached.")
+    return artifact
+
+def score_and_report(conf, artifact, summary_path, client_id, transport=None):
+    """
+    Function that scores the client messages with a model and sends to the server only aggregate
+    metrics and the ids of the messages flagged as rumour with high probability.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        artifact (dict): Model artifact.
+        summary_path (str): Path of the msg_summary.parquet file.
+        client_id (str): Client node identification.
+        transport (dict): Transport to use. None creates one from the configuration.
+
+    Returns:
+        pandas.DataFrame: Scores of every client message.
+    """
+    # only the columns used to score are read, a batch at a time in the out-of-core mode
+    metadata = artifact["metadata"]
+    target = metadata["target"]
+    dataset = ds.dataset(summary_path, format="parquet")
+    columns = ["msg_id", target] + metadata["features"]
+    if metadata.get("text_features", 0):
+        columns += ["text_hash_idx", "text_hash_val"]
+    columns = [col for col in columns if col in dataset.schema.names]
+    if rsf.resources["out_of_core"]:
+        chunks = (batch.to_pandas() for batch in dataset.to_batches(columns=columns, batch_size=SCORE_BATCH_ROWS))
+    else:
+        chunks = [dataset.to_table(columns=columns).to_pandas()]
+
+    # annotated messages allow to evaluate the model with client data that never left the client
+    confusion = np.zeros((2, 2), dtype=np.int64) if target in columns else None
+    parts = []
+    for df in chunks:
+        part = maf.score_messages(df, artifact)
+        if confusion is not None:
+            np.add.at(confusion, (df[target].astype(int).to_numpy(), part["prediction"].astype(int).to_numpy()), 1)
+        parts.append(part)
+    scores = pd.concat(parts, ignore_index=True) if parts else maf.score_messages(dataset.to_table(columns=columns).to_pandas(), artifact)
+    scores.to_parquet(os.path.join(os.path.dirname(summary_path), "msg_scores.parquet"), engine="pyarrow", index=False)
+
+    threshold = conf.get("MODEL_FLAG_THRESHOLD", 0.9)
+    proba = scores["proba_1"].to_numpy()
+    flagged = scores.loc[proba >= threshold, "msg_id"].astype(str).tolist()
+    report = {"kind": "scores", "client": client_id, "version": metadata["version"],
+              "n_messages": len(scores), "n_flagged": len(flagged), "mean_proba": float(proba.mean()) if len(proba) else 0.0,
+              "flagged_ids": flagged[:conf.get("MODEL_MAX_FLAGGED_IDS", 100)],
+              "confusion": confusion.tolist() if confusion is not None else None}
+
+    topic, shard = mqttf.shard_topic(conf, client_id, 0)
+    report.update({"shard": shard, "sent_at": time.time()})
+    own_transport = transport is None
+    if own_transport:
+        transport = tf.create_transport(conf)
+    tf.transport_publish(transport, topic, json.dumps(report))
+    if own_transport:
+        tf.transport_stop(transport)
+    return scores
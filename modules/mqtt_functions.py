@@ -22,8 +22,14 @@ def create_mqtt_client (conf):
 
 def on_message (client, userdatata, message):
     """
-    Function that saves received mqtt message payload in files for future handling.  
+    Function that handles received mqtt message payloads.
+    When the client user data is a payload handler (for example the ingest pipeline's),
+    the raw payload is handed to it. Otherwise the payload is saved in files for future handling.
     """  
+    if userdatata is not None:
+        userdatata(message.payload)
+        return
+
     try:
         # Decode the MQTT message payload
         decoded_message = message.payload.decode("utf-8")
@@ -76,7 +82,7 @@ def encode_zip_to_base64(zip_file_path):
 
 
 
-def prepare_mqtt_message(client_id, base64_str, file_name):   
+def prepare_mqtt_message(client_id, base64_str, file_name, extra=None):   
     """
     Function that prepare the message to be send by mqtt
 
@@ -84,35 +90,136 @@ def prepare_mqtt_message(client_id, base64_str, file_name):
       client_id (str): Client node identification.
       base64_str (base64 string): zip file encoded in base64.
       file_name (str) : filename of the data
+      extra (dict): Additional metadata fields added to the message.
 
     Returns:
       json: Json message to be send by mqtt
     """ 
     json_msg =  {"client": client_id, "data": base64_str, "filename": file_name}
+    json_msg.update(extra or {})
     message = json.dumps(json_msg)
     return message
 
-def find_and_send_msg(conf, send_folder, client_id):
+def upstream_prefix(conf, node_id):
+    """
+    Function that obtains the topic prefix where a node publishes to its parent in the aggregation tree:
+    AGGREGATOR_TOPIC/<aggregator> when AGGREGATOR_TREE assigns it an aggregator, MQTT_TOPIC (the server) otherwise.
+
+    Parameters:
+      conf (dict): config.yaml's information.
+      node_id (str): Client or aggregator node identification.
+
+    Returns:
+      str: Topic prefix.
+    """
+    parent = (conf.get("AGGREGATOR_TREE") or {}).get(node_id)
+    return f"{conf.get('AGGREGATOR_TOPIC', 'AGG')}/{parent}" if parent else conf["MQTT_TOPIC"]
+
+def shard_topic(conf, client_id, idx):
+    """
+    Function that obtains the topic where a client publishes its idx-th file.
+    Files are spread over TOPIC_SHARDS topics with MQTT_TOPIC/<client>/<shard> form,
+    or under the topic of its aggregator when the client has one.
+
+    Parameters:
+      conf (dict): config.yaml's information.
+      client_id (str): Client node identification.
+      idx (int): Position of the file among the client files.
 
-    # obtain mqtt client
-    mqttc = create_mqtt_client(conf)
+    Returns:
+      tuple: Topic to publish in and shard identification (<client>/<shard>).
+    """
+    shard = f"{client_id}/{idx % conf.get('TOPIC_SHARDS', 1)}"
+    return f"{upstream_prefix(conf, client_id)}/{shard}", shard
+
+def subscription_topic(conf, consumers):
+    """
+    Function that obtains the topic the server subscribes to in order to receive every shard.
+    With several consumers a shared subscription is used so each message reaches only one of them.
+
+    Parameters:
+      conf (dict): config.yaml's information.
+      consumers (int): Number of server consumers.
+
+    Returns:
+      str: Subscription topic.
+    """
+    topic = f"{conf['MQTT_TOPIC']}/#"
+    if consumers > 1:
+        topic = f"$share/{conf.get('SHARE_GROUP', 'server')}/{topic}"
+    return topic
+
+def delta_ack_topic(conf, client_id):
+    """
+    Function that obtains the topic where the server acknowledges the deltas of a client.
+    Each client has its own topic, so acknowledgements never compete between clients.
+
+    Parameters:
+      conf (dict): config.yaml's information.
+      client_id (str): Client node identification.
+
+    Returns:
+      str: Topic with <DELTA_ACK_TOPIC>/<client> form.
+    """
+    return f"{conf.get('DELTA_ACK_TOPIC', 'DELTA_ACK')}/{client_id}"
+
+def split_shared_topic(topic):
+    """
+    Function that splits a shared subscription topic ($share/<group>/<filter>) in its group and filter.
+
+    Parameters:
+      topic (str): Subscription topic.
+
+    Returns:
+      tuple: Share group (None when it is not a shared subscription) and topic filter.
+    """
+    if topic.startswith("$share/"):
+        _, group, topic_filter = topic.split("/", 2)
+        return group, topic_filter
+    return None, topic
+
+def find_and_send_msg(conf, send_folder, client_id, publish=None, run_id=None):
+    """
+    Function that sends every zip file of a folder in natural order.
+
+    Parameters:
+      conf (dict): config.yaml's information.
+      send_folder (str): Folder with the zip files to send.
+      client_id (str): Client node identification.
+      publish (function): Function called with topic and message to send each file.
+                          None publishes with a new mqtt client.
+      run_id (int): Identification of the client run. None creates a new one.
+
+    Returns:
+      int: Identification of the client run, to send further messages of the same run.
+    """
+    if publish is None:
+        # obtain mqtt client
+        mqttc = create_mqtt_client(conf)
+        publish = mqttc.publish
 
     # obtain files from send folder and order in natural order
     file_list = os.listdir(send_folder)  
     sorted_files = natsorted(file_list)
 
-    for zip_file in sorted_files:
+    # identify this run, so the server replaces data of previous runs
+    run_id = run_id or time.time_ns()
+
+    for idx, zip_file in enumerate(sorted_files):
 
         # convert file in base64 string
         base64_str = encode_zip_to_base64(os.path.join(send_folder,zip_file))
 
         # obtain msg to be send from mqtt
-        message = prepare_mqtt_message(client_id, base64_str, zip_file)
+        topic, shard = shard_topic(conf, client_id, idx)
+        message = prepare_mqtt_message(client_id, base64_str, zip_file,
+                                       {"shard": shard, "sent_at": time.time(), "run_id": run_id, "seq": idx})
 
         # send message
-        mqttc.publish(conf["MQTT_TOPIC"], message)
-        print(f"\tFile {zip_file} published in {conf['MQTT_TOPIC']} topic.")
+        publish(topic, message)
+        print(f"\tFile {zip_file} published in {topic} topic.")
 
         # wait before send a new message
-        time.sleep(30)
+        time.sleep(conf.get("SEND_INTERVAL", 30))
 
+    return run_id
@@ -0,0 +1,189 @@
+import queue
+import threading
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from modules import random_forest_train_functions as rftf
+from modules import resource_functions as rsf
+
+def create_online_trainer(conf):
+    """
+    Function that creates the online trainer: a thread that receives the tables ingested by the
+    server pipeline, keeps reservoir samples of training and validation rows, and grows a
+    warm-started forest with a few new trees after each batch.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+
+    Returns:
+        dict: Online trainer state.
+    """
+    capacity = conf.get("ONLINE_RESERVOIR_SIZE", 20000)
+    validation = conf.get("ONLINE_VALIDATION", 0.2)
+    trainer = {
+        "queue": queue.Queue(),
+        "model": RandomForestClassifier(n_estimators=0, max_depth=conf.get("ONLINE_MAX_DEPTH"),
+                                        warm_start=True, random_state=42,
+                                        n_jobs=rsf.stage_jobs("online_training")),
+        "trees_per_batch": conf.get("ONLINE_TREES_PER_BATCH", 10),
+        "max_trees": conf.get("ONLINE_MAX_TREES", 500),
+        "min_rows": conf.get("ONLINE_MIN_ROWS", 200),
+        "validation": validation,
+        "rng": np.random.default_rng(42),
+        "train": create_reservoir(int(capacity * (1 - validation))),
+        "holdout": create_reservoir(int(capacity * validation)),
+        "pending_rows": 0,
+        "thread": None
+    }
+    trainer["thread"] = threading.Thread(target=online_training_worker, args=(trainer,),
+                                         name="online-trainer", daemon=True)
+    trainer["thread"].start()
+    return trainer
+
+def create_reservoir(capacity):
+    """
+    Function that creates an empty reservoir sample of rows.
+
+    Parameters:
+        capacity (int): Maximum number of rows kept.
+
+    Returns:
+        dict: Reservoir with its capacity, number of rows seen and kept rows (None until the first batch).
+    """
+    return {"capacity": max(1, capacity), "seen": 0, "X": None, "y": None}
+
+def add_to_reservoir(reservoir, X, y, rng):
+    """
+    Function that adds a batch of rows to a reservoir sample, so every row seen so far is kept
+    with the same probability (algorithm R).
+
+    Parameters:
+        reservoir (dict): Reservoir created by create_reservoir.
+        X (numpy.ndarray): Features of the batch.
+        y (numpy.ndarray): Classes of the batch.
+        rng (numpy.random.Generator): Random generator.
+    """
+    if reservoir["X"] is None:
+        reservoir["X"] = np.empty((0, X.shape[1]), dtype=X.dtype)
+        reservoir["y"] = np.empty(0, dtype=y.dtype)
+
+    # fill the free positions first
+    free = min(reservoir["capacity"] - len(reservoir["y"]), len(y))
+    if free > 0:
+        reservoir["X"] = np.concatenate([reservoir["X"], X[:free]])
+        reservoir["y"] = np.concatenate([reservoir["y"], y[:free]])
+    seen = reservoir["seen"] + np.arange(free, len(y))
+
+    # then each row replaces a random kept row with probability capacity / rows seen
+    positions = rng.integers(0, seen + 1) if len(seen) else seen
+    replace = positions < reservoir["capacity"]
+    reservoir["X"][positions[replace]] = X[free:][replace]
+    reservoir["y"][positions[replace]] = y[free:][replace]
+    reservoir["seen"] += len(y)
+
+def submit_table(trainer, client, filename, table):
+    """
+    Function that hands an ingested table to the online trainer. Used as the ingest pipeline callback.
+
+    Parameters:
+        trainer (dict): Online trainer created by create_online_trainer.
+        client (str): Client node identification.
+        filename (str): Filename of the received data.
+        table (pyarrow.Table): Ingested rows.
+    """
+    trainer["queue"].put(table)
+
+def train_on_table(trainer, table):
+    """
+    Function that adds the rows of a table to the reservoirs and grows the forest
+    once enough rows of both classes are available.
+
+    Parameters:
+        trainer (dict): Online trainer created by create_online_trainer.
+        table (pyarrow.Table): Ingested rows.
+    """
+    df = rftf.select_and_transform_data(table.to_pandas(), rftf.SELECTED_COLUMNS)
+    X = df.drop('is_rumour', axis=1)
+    trainer["feature_names"] = list(X.columns)
+    X = X.to_numpy(dtype=np.float64)
+    y = df['is_rumour'].to_numpy()
+
+    # split rows between training and validation reservoirs
+    is_holdout = trainer["rng"].random(len(y)) < trainer["validation"]
+    add_to_reservoir(trainer["train"], X[~is_holdout], y[~is_holdout], trainer["rng"])
+    add_to_reservoir(trainer["holdout"], X[is_holdout], y[is_holdout], trainer["rng"])
+    trainer["pending_rows"] += len(y)
+
+    if trainer["pending_rows"] >= trainer["min_rows"]:
+        grow_forest(trainer)
+
+def grow_forest(trainer):
+    """
+    Function that adds new trees to the forest, fitted on the current training reservoir.
+    Previous trees are kept. Nothing is done until the reservoir holds both classes,
+    nor once the forest has ONLINE_MAX_TREES trees.
+
+    Parameters:
+        trainer (dict): Online trainer created by create_online_trainer.
+    """
+    y_train = trainer["train"]["y"]
+    model = trainer["model"]
+    if y_train is None or len(np.unique(y_train)) < 2 or model.n_estimators >= trainer["max_trees"]:
+        return
+    model.n_estimators = min(model.n_estimators + trainer["trees_per_batch"], trainer["max_trees"])
+    model.fit(pd.DataFrame(trainer["train"]["X"], columns=trainer["feature_names"]), y_train)
+    trainer["pending_rows"] = 0
+
+    X_holdout, y_holdout = online_holdout(trainer)
+    score = model.score(X_holdout, y_holdout) if len(y_holdout) else float("nan")
+    print(f"Server: Online forest grown to {model.n_estimators} trees, "
+          f"validation accuracy {score:.4f} on {len(y_holdout)} rows.")
+
+def online_training_worker(trainer):
+    """
+    Function executed by the online trainer thread. Consumes tables until a None sentinel arrives.
+
+    Parameters:
+        trainer (dict): Online trainer created by create_online_trainer.
+    """
+    while True:
+        table = trainer["queue"].get()
+        if table is None:
+            return
+        try:
+            train_on_table(trainer, table)
+        except Exception as e:
+            print(f"Server: Online training failed for a batch: {e}")
+
+def online_holdout(trainer):
+    """
+    Function that obtains the validation rows kept by the online trainer.
+
+    Parameters:
+        trainer (dict): Online trainer created by create_online_trainer.
+
+    Returns:
+        tuple: pandas.DataFrame of features and numpy.ndarray of classes.
+    """
+    holdout = trainer["holdout"]
+    if holdout["X"] is None:
+        return pd.DataFrame(columns=trainer.get("feature_names", [])), np.empty(0)
+    return pd.DataFrame(holdout["X"], columns=trainer["feature_names"]), holdout["y"]
+
+def close_online_trainer(trainer):
+    """
+    Function that trains on the pending tables and stops the online trainer.
+
+    Parameters:
+        trainer (dict): Online trainer created by create_online_trainer.
+
+    Returns:
+        RandomForestClassifier: Online forest, or None if no tree could be trained.
+    """
+    trainer["queue"].put(None)
+    trainer["thread"].join()
+
+    # rows received after the last growth still add trees
+    if trainer["pending_rows"] > 0:
+        grow_forest(trainer)
+    return trainer["model"] if trainer["model"].n_estimators > 0 else None
@@ -0,0 +1,177 @@
+import os
+import sys
+import cProfile
+import inspect
+import threading
+import tracemalloc
+from collections import Counter
+
+# Profiling of this process: profiled stages (empty when disabled), profiler and output folder
+profiling = {"stages": set(), "profiler": "cprofile", "memory": False, "interval": 0.005, "path": None,
+             "node": "", "active": False, "runs": Counter()}
+
+# Functions whose allocations are reported apart when tracemalloc is enabled (resolved when reporting)
+ALLOCATION_HOTSPOTS = ["modules.data_preparation_functions.extract_data_and_add_to_table",
+                       "modules.graph_creation_analysis_functions.extract_msg_information"]
+
+def configure_profiling(conf, node):
+    """
+    Function that sets which stages are profiled and how. Environment variables with the same
+    name override config.yaml, so a production run can be profiled without editing it:
+        - PROFILE_STAGES: stage names (list, or comma separated in the environment), or "all".
+        - PROFILER: "cprofile" (deterministic, .prof files) or "sampling" (collapsed stack files).
+        - PROFILE_MEMORY: 1 also takes tracemalloc snapshots of the profiled stages.
+        - PROFILE_INTERVAL: seconds between samples of the sampling profiler.
+        - PROFILE_PATH: folder where profiles are saved.
+    With no stage, nothing is profiled and spans do not pay any cost.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        node (str): Node name, used in the profile filenames.
+    """
+    stages = os.environ.get("PROFILE_STAGES", conf.get("PROFILE_STAGES")) or []
+    if isinstance(stages, str):
+        stages = [stage.strip() for stage in stages.split(",") if stage.strip()]
+    profiling["stages"] = set(stages)
+    profiling["profiler"] = os.environ.get("PROFILER", conf.get("PROFILER", "cprofile"))
+    profiling["memory"] = int(os.environ.get("PROFILE_MEMORY", conf.get("PROFILE_MEMORY", 0)) or 0) == 1
+    profiling["interval"] = float(os.environ.get("PROFILE_INTERVAL", conf.get("PROFILE_INTERVAL", 0.005)))
+    profiling["path"] = os.environ.get("PROFILE_PATH", conf.get("PROFILE_PATH", "profiles"))
+    profiling["node"] = node
+    if profiling["stages"]:
+        os.makedirs(profiling["path"], exist_ok=True)
+        print(f"Profiling: stages {sorted(profiling['stages'])} with {profiling['profiler']}"
+              f"{' and tracemalloc' if profiling['memory'] else ''}. Profiles saved in {profiling['path']}.")
+
+def start_stage_profile(stage):
+    """
+    Function that starts profiling a stage if it is selected. Only one stage is profiled at a time,
+    so stages nested in a profiled one are part of its profile.
+
+    Parameters:
+        stage (str): Stage name.
+
+    Returns:
+        dict: Running profile, or None if the stage is not profiled.
+    """
+    if not (stage in profiling["stages"] or "all" in profiling["stages"]) or profiling["active"]:
+        return None
+    profiling["active"] = True
+    profiling["runs"][stage] += 1
+    name = f"{profiling['node']}_{stage}_{profiling['runs'][stage]}"
+    profile = {"stage": stage, "path": os.path.join(profiling["path"], name)}
+
+    if profiling["profiler"] == "sampling":
+        profile["counts"] = Counter()
+        profile["stop"] = threading.Event()
+        profile["thread"] = threading.Thread(target=sample_stacks, args=(profile,), daemon=True)
+        profile["thread"].start()
+    else:
+        # deterministic profile of the thread running the stage
+        profile["profiler"] = cProfile.Profile()
+        profile["profiler"].enable()
+
+    if profiling["memory"] and not tracemalloc.is_tracing():
+        # deep tracebacks, so allocations inside pandas still show the calling pipeline function
+        tracemalloc.start(50)
+        profile["tracemalloc"] = True
+    return profile
+
+def stop_stage_profile(profile):
+    """
+    Function that stops a stage profile and saves it: <node>_<stage>_<run>.prof (cProfile, readable
+    with pstats or snakeviz) or .collapsed (stacks and sample counts, readable with flamegraph.pl
+    or speedscope), plus .tracemalloc snapshot and _allocations.txt report with tracemalloc.
+
+    Parameters:
+        profile (dict): Running profile created by start_stage_profile.
+    """
+    try:
+        if "profiler" in profile:
+            profile["profiler"].disable()
+            profile["profiler"].dump_stats(f"{profile['path']}.prof")
+        else:
+            profile["stop"].set()
+            profile["thread"].join()
+            with open(f"{profile['path']}.collapsed", "w") as file:
+                for stack, count in profile["counts"].most_common():
+                    file.write(f"{stack} {count}\n")
+
+        if profile.get("tracemalloc"):
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            snapshot.dump(f"{profile['path']}.tracemalloc")
+            with open(f"{profile['path']}_allocations.txt", "w") as file:
+                file.write(f"Peak traced memory of the stage: {peak / 1024 ** 2:.1f} MiB\n")
+                file.write(allocation_report(snapshot))
+    finally:
+        profiling["active"] = False
+
+def sample_stacks(profile):
+    """
+    Function run by the sampling profiler thread: every PROFILE_INTERVAL seconds the stack of every
+    other thread is counted as "thread;file:function;...", from the outermost call.
+
+    Parameters:
+        profile (dict): Running profile, where sample counts are added.
+    """
+    own_id = threading.get_ident()
+    names = {}
+    while not profile["stop"].wait(profiling["interval"]):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if thread_id not in names:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            profile["counts"][";".join([names.get(thread_id, str(thread_id))] + stack[::-1])] += 1
+
+def hotspot_ranges():
+    """
+    Function that obtains the file and line range of each allocation hot spot function already imported.
+    """
+    ranges = {}
+    for qualified_name in ALLOCATION_HOTSPOTS:
+        module_name, func_name = qualified_name.rsplit(".", 1)
+        func = getattr(sys.modules.get(module_name), func_name, None)
+        if func is not None:
+            lines, first_line = inspect.getsourcelines(func)
+            ranges[func_name] = (inspect.getsourcefile(func), first_line, first_line + len(lines))
+    return ranges
+
+def allocation_report(snapshot, top=15):
+    """
+    Function that summarizes a tracemalloc snapshot: the lines that allocated most memory still alive
+    at the end of the stage, and the memory allocated under each hot spot function.
+
+    Parameters:
+        snapshot (tracemalloc.Snapshot): Snapshot taken at the end of the stage.
+        top (int): Number of lines reported.
+
+    Returns:
+        str: Text report.
+    """
+    # allocations of the profilers themselves are not reported
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                       tracemalloc.Filter(False, cProfile.__file__)])
+    lines = [f"Top {top} allocation lines:"]
+    for stat in snapshot.statistics("lineno")[:top]:
+        frame = stat.traceback[0]
+        lines.append(f"\t{frame.filename}:{frame.lineno}: {stat.size / 1024:.1f} KiB in {stat.count} blocks")
+
+    for func_name, (filename, first_line, last_line) in hotspot_ranges().items():
+        # traces with a frame inside the function, grouped by their innermost line
+        stats = Counter()
+        for trace in snapshot.traces:
+            if any(frame.filename == filename and first_line <= frame.lineno < last_line for frame in trace.traceback):
+                frame = trace.traceback[-1]
+                stats[f"{frame.filename}:{frame.lineno}"] += trace.size
+        lines.append(f"Allocations under {func_name}: {sum(stats.values()) / 1024:.1f} KiB")
+        for location, size in stats.most_common(top):
+            lines.append(f"\t{location}: {size / 1024:.1f} KiB")
+    return "\n".join(lines) + "\n"
@@ -1,57 +1,143 @@
 import os 
+import json
+import time
 import pandas as pd
-import zipfile
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from natsort import natsorted
 from sklearn import preprocessing
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import GridSearchCV
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+from sklearn.model_selection import GridSearchCV, ParameterGrid, ParameterSampler, cross_val_score
 from sklearn.metrics import classification_report, confusion_matrix, accuracy_score
 from sklearn.tree import export_text, plot_tree
-import matplotlib.pyplot as plt
+from modules import ingest_functions as ingf
+from modules import feature_schema_functions as fsf
+from modules import resource_functions as rsf
 
 
-def join_all_data(path):
+# Columns used to train the model
+SELECTED_COLUMNS = ['msg_hour', 'propagate_to_msg', 'has_mentions', 'mentions','is_reply_message',
+                    'retweets', 'favourites', 'has_link', 'has_hashtag', 'emotion', 'is_rumour']
+
+# Categories of string columns that must be encoded equally by every node
+FIXED_CATEGORIES = fsf.CATEGORIES
+
+def iterate_zip_tables(path):
+    """
+    Read the .zip files of a directory, and of its client folders, one at a time, without extracting them.
+
+    Parameters:
+        path: The directory path containing the .zip files, or client folders with them.
+
+    Output:
+        Yields the pyarrow.Table of each .zip file with data, in natural folder and filename order.
+    """
+    for file in natsorted(os.listdir(path)):
+        file_path = os.path.join(path, file)
+        if os.path.isdir(file_path):
+            # files received by the ingest pipeline are spilled in a folder per client
+            files = [os.path.join(file_path, name) for name in natsorted(os.listdir(file_path))]
+        else:
+            files = [file_path]
+        for zip_path in files:
+            if zip_path.endswith(".zip"):  # Process only .zip files
+                table = ingf.read_zip_payload(zip_path)
+                if table is not None:
+                    yield table
+
+def join_all_data(path, snapshot=False, max_bytes=None, columns=None):
     """
-    Join all data from multiple .zip files containing CSVs into a single DataFrame and save the combined data.
+    Join all data from multiple .zip files containing CSVs into a single Arrow table.
+    Zip members are read in memory, without extracting them, and concatenated once.
 
     Parameters:
         path: The directory path containing the .zip files with CSVs to be processed.
+        snapshot: Whether the combined data is also saved as a parquet snapshot in path/preprocess.
+        max_bytes: Memory the joined table may use (out-of-core mode). The files are read one at a time
+                   and a uniform sample of their rows is kept. None joins every row.
+        columns: Columns kept in the sample of the out-of-core mode. None keeps every column.
 
     Output:
-        Returns the file path of the combined CSV file saved after processing all .zip files.
+        Returns the pyarrow.Table with the rows of every .zip file in natural filename order,
+        or None if there is no data.
     """    
-    # Create an empty DataFrame to store all data
-    master_df = pd.DataFrame()
-
-    # Iterate through each zip file in the directory
-    for file in os.listdir(path):
-        if file.endswith(".zip"):  # Process only .zip files
-            path_to_zip_file = os.path.join(path, file)
-            # Extract the zip file
-            with zipfile.ZipFile(path_to_zip_file, 'r') as zip_ref:
-                zip_ref.extractall(path)
-            
-            # Derive the corresponding CSV filename
-            filename = file.split(".zip")[0] + ".csv"
-            csv_path = os.path.join(path, filename)
-            
-            # Check if the CSV file exists and read its content
-            if os.path.exists(csv_path):
-                df = pd.read_csv(csv_path)
-                # Append to the master dataframe
-                master_df = pd.concat([master_df, df], ignore_index=True)
+    if max_bytes is not None:
+        master_table, total = ingf.sample_tables(iterate_zip_tables(path), max_bytes, columns)
+        if master_table is not None:
+            print(f"{master_table.num_rows} of {total} rows sampled to fit the memory ceiling.")
+            if snapshot:
+                save_combined_snapshot(iterate_zip_tables(path), path)
+        return master_table
+
+    # Read each zip file in the directory
+    tables = list(iterate_zip_tables(path))
+    if not tables:
+        return None
+    master_table = pa.concat_tables(tables, promote_options="default")
+
+    if snapshot:
+        save_combined_snapshot(master_table, path)
+    return master_table
+
+def save_combined_snapshot(table, path):
+    """
+    Save combined data as a columnar parquet snapshot.
+
+    Parameters:
+        table: pyarrow.Table with the combined data, or iterable of pyarrow.Table written one at a time
+               as row groups, so the combined data is never in memory.
+        path: Directory where the preprocess folder with the snapshot is created.
 
+    Output:
+        Returns the file path of the saved snapshot.
+    """
     # create new folder to save the result
     preprocess_folder = os.path.join(path,"preprocess")
     os.makedirs(preprocess_folder, exist_ok=True)
     
     # create filename
-    file_path = os.path.join(preprocess_folder,"combined_data.csv")
-    master_df.to_csv(file_path, index=False)
+    file_path = os.path.join(preprocess_folder,"combined_data.parquet")
+    if isinstance(table, pa.Table):
+        pq.write_table(table, file_path)
+    else:
+        writer = None
+        for part in table:
+            if writer is None:
+                writer = pq.ParquetWriter(file_path, part.schema)
+            elif not part.schema.equals(writer.schema):
+                part = part.select(writer.schema.names).cast(writer.schema)
+            writer.write_table(part)
+        if writer is not None:
+            writer.close()
     
     # returns the file path
     return file_path
 
+def read_training_data(path, columns):
+    """
+    Read the columns used to train a model from a parquet file or folder. In the out-of-core mode
+    the file is read a record batch at a time and a uniform sample of its rows that fits the memory
+    budget is kept.
+
+    Parameters:
+        path: Path of the parquet file or folder.
+        columns: Columns to read.
+
+    Output:
+        Returns a pandas.DataFrame with the columns of every (or every sampled) row.
+    """
+    if not rsf.resources["out_of_core"]:
+        return pd.read_parquet(path, engine="pyarrow", columns=columns)
+    dataset = ds.dataset(path, format="parquet")
+    batches = (pa.Table.from_batches([batch]) for batch in dataset.to_batches(columns=columns))
+    table, total = ingf.sample_tables(batches, rsf.memory_budget())
+    if table is None:
+        return dataset.to_table(columns=columns).to_pandas()
+    print(f"\tOut-of-core: {table.num_rows} of {total} rows sampled to fit the memory ceiling.")
+    return table.to_pandas()
+
 def transform_booleans(df):
     """
     Convert boolean columns in the DataFrame to integer values (0 or 1).
@@ -63,12 +149,13 @@ def transform_booleans(df):
         Returns the DataFrame with boolean columns converted to integers (True becomes 1, False becomes 0).
     """
     bool_cols = df.select_dtypes(include='bool').columns
-    df[bool_cols] = np.multiply(df[bool_cols], 1)
+    df[bool_cols] = df[bool_cols].astype(np.int8)
     return df
 
 def transform_strings(df):
     """
     Transform string columns in the DataFrame to numeric using Label Encoding.
+    Columns in FIXED_CATEGORIES are encoded with their fixed categories.
 
     Parameters:
         df: The input DataFrame containing the dataset with string (object) columns.
@@ -76,10 +163,15 @@ def transform_strings(df):
     Output:
         Returns the DataFrame with string columns transformed into numeric values using Label Encoding.
     """
+    # categorical columns already hold the fixed category codes
+    for col in df.select_dtypes(include='category').columns:
+        df[col] = df[col].cat.codes
+
     str_cols = df.select_dtypes(include='object').columns
     le = preprocessing.LabelEncoder()
     for col in str_cols:
-        le.fit(df[col])
+        # fixed categories keep the same codes in every node and run
+        le.fit(FIXED_CATEGORIES.get(col, df[col]))
         df[col] = le.transform(df[col])
     return df
 
@@ -94,8 +186,8 @@ def select_and_transform_data (df, desired_columns):
     Output:
         Returns a DataFrame with the selected columns, where boolean values are converted to integers and string values are transformed to numeric.
     """  
-    # filter columns
-    df = df[desired_columns]
+    # filter columns, with the declared compact dtypes
+    df = fsf.apply_schema(df[desired_columns])
 
     # convert booleans to int
     df = transform_booleans(df)
@@ -105,40 +197,279 @@ def select_and_transform_data (df, desired_columns):
 
     return df
 
-def tune_random_forest(X_train, y_train):
+# Hyperparameter space explored by every tuning strategy
+PARAM_GRID = {
+    'n_estimators': [100, 200, 300],
+    'max_depth': [None, 10, 20, 30],
+    'min_samples_split': [2, 5, 10],
+    'min_samples_leaf': [1, 2, 4],
+    'max_features': ['sqrt', 'log2', None]
+}
+
+def load_tuning_results(results_path):
+    """
+    Load the hyperparameter combinations evaluated in previous tuning runs.
+
+    Parameters:
+        results_path: JSON file where tuning results are persisted.
+
+    Output:
+        Returns a list of dictionaries with the evaluated params, their score and the strategy used.
+    """
+    if not results_path or not os.path.exists(results_path):
+        return []
+    with open(results_path, "r") as file:
+        return json.load(file)
+
+def save_tuning_results(results_path, results):
+    """
+    Persist evaluated hyperparameter combinations so later runs can warm-start from them.
+
+    Parameters:
+        results_path: JSON file where tuning results are persisted.
+        results: List of dictionaries with the evaluated params, their score and the strategy used.
+    """
+    if not results_path:
+        return
+    os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+    with open(results_path, "w") as file:
+        json.dump(results, file, indent=4)
+
+def narrow_param_grid(param_grid, best_params):
+    """
+    Reduce a parameter grid to the region around previous best parameters:
+    for each parameter only the best value and its neighbours in the grid are kept.
+
+    Parameters:
+        param_grid: Dictionary with the list of values of each parameter.
+        best_params: Best parameters found in a previous run.
+
+    Output:
+        Returns the narrowed parameter grid.
+    """
+    narrowed = {}
+    for param, values in param_grid.items():
+        if best_params.get(param) in values:
+            idx = values.index(best_params[param])
+            narrowed[param] = values[max(0, idx - 1): idx + 2]
+        else:
+            narrowed[param] = values
+    return narrowed
+
+def params_to_vector(params, param_grid):
+    """
+    Encode hyperparameters as the position of each value in the grid, to be used by the surrogate model.
+
+    Parameters:
+        params: Dictionary with the value of each parameter.
+        param_grid: Dictionary with the list of values of each parameter.
+
+    Output:
+        Returns a list with one ordinal value per parameter.
+    """
+    return [param_grid[param].index(params[param]) for param in sorted(param_grid)]
+
+def evaluate_params(params, X_train, y_train, cv, n_jobs):
     """
-    Tune hyperparameters for a Random Forest Classifier using GridSearchCV.
+    Evaluate a hyperparameter combination with cross validation.
 
     Parameters:
+        params: Random Forest parameters to evaluate.
         X_train: Training features
         y_train: Training labels
+        cv: Number of cross validation folds.
+        n_jobs: Number of folds evaluated in parallel.
 
-    Returns:
-        best_model: The best Random Forest model from Grid Search
-        best_params: The best hyperparameters
+    Output:
+        Returns the mean cross validation accuracy.
+    """
+    rf = RandomForestClassifier(random_state=42, **params)
+    return float(np.mean(cross_val_score(rf, X_train, y_train, cv=cv, n_jobs=n_jobs, scoring='accuracy')))
+
+def search_candidates(candidates, X_train, y_train, cv, n_jobs, deadline):
+    """
+    Evaluate hyperparameter combinations with cross validation, in groups that keep every job busy,
+    until every combination is evaluated or the deadline is reached. The first group is always evaluated.
+
+    Parameters:
+        candidates: List of Random Forest parameters to evaluate.
+        X_train: Training features
+        y_train: Training labels
+        cv: Number of cross validation folds.
+        n_jobs: Number of fits run in parallel.
+        deadline: Time after which no new group is started.
+
+    Output:
+        Returns a list of dictionaries with the evaluated params and their score, in candidate order.
     """
-    # Define the parameter grid
-    param_grid = {
-        'n_estimators': [100, 200, 300],
-        'max_depth': [None, 10, 20, 30],
-        'min_samples_split': [2, 5, 10],
-        'min_samples_leaf': [1, 2, 4],
-        'max_features': ['sqrt', 'log2', None]
-    }
+    group_size = max(1, -(-n_jobs // cv))
+    evaluated = []
+    for idx in range(0, len(candidates), group_size):
+        if evaluated and time.time() >= deadline:
+            break
+        group = [{param: [value] for param, value in params.items()} for params in candidates[idx:idx + group_size]]
+        search = GridSearchCV(estimator=RandomForestClassifier(random_state=42), param_grid=group,
+                              cv=cv, n_jobs=n_jobs, scoring='accuracy', refit=False)
+        search.fit(X_train, y_train)
+        for params, score in zip(search.cv_results_["params"], search.cv_results_["mean_test_score"]):
+            evaluated.append({"params": params, "score": float(score)})
+            print(f"\t[{len(evaluated)}] score={score:.4f} params={params}")
+    return evaluated
+
+def successive_halving(candidates, X_train, y_train, cv, n_jobs, deadline, rng, factor=3):
+    """
+    Successive halving: every candidate is evaluated on a random subset of the samples, and the best
+    1/factor of them are evaluated again on factor times more samples, until the last iteration uses
+    every sample. Stops at the deadline, with the candidates evaluated on the most samples so far.
+
+    Parameters:
+        candidates: List of Random Forest parameters to evaluate.
+        X_train: Training features
+        y_train: Training labels
+        cv: Number of cross validation folds.
+        n_jobs: Number of fits run in parallel.
+        deadline: Time after which no new group of candidates is started.
+        rng: numpy random generator.
+        factor: Fraction of candidates dropped, and growth of the samples, of each iteration.
+
+    Output:
+        Returns the evaluated params and scores of the last iteration reached, and whether it used every sample.
+    """
+    n_samples = X_train.shape[0]
+    n_iterations = 1 + int(np.floor(np.log(len(candidates)) / np.log(factor)))
+    # the first iteration needs some samples per fold
+    while n_iterations > 1 and n_samples // factor ** (n_iterations - 1) < 2 * cv:
+        n_iterations -= 1
+    order = rng.permutation(n_samples)
+
+    evaluated = []
+    for iteration in range(n_iterations):
+        n_resources = n_samples if iteration == n_iterations - 1 else n_samples // factor ** (n_iterations - 1 - iteration)
+        rows = np.sort(order[:n_resources])
+        X_iter = X_train.iloc[rows] if hasattr(X_train, "iloc") else X_train[rows]
+        y_iter = y_train.iloc[rows] if hasattr(y_train, "iloc") else y_train[rows]
+        print(f"\tHalving iteration {iteration + 1}/{n_iterations}: {len(candidates)} candidates on {n_resources} samples.")
+        results = search_candidates(candidates, X_iter, y_iter, cv, n_jobs, deadline)
+        if len(results) < len(candidates) or iteration == n_iterations - 1:
+            return results, n_resources == n_samples and len(results) == len(candidates)
+        evaluated = sorted(results, key=lambda result: -result["score"])
+        candidates = [result["params"] for result in evaluated[:max(1, -(-len(candidates) // factor))]]
+        if time.time() >= deadline:
+            print("\tTuning time limit reached, keeping the candidates of the last halving iteration.")
+            return evaluated, False
+
+def propose_sequential_candidate(evaluated, param_grid, rng):
+    """
+    Propose the next combination of a Bayesian-style sequential search: a random forest surrogate
+    is fitted on the evaluated combinations and the unevaluated candidate with the best upper
+    confidence bound (mean plus standard deviation of the surrogate trees) is chosen.
+
+    Parameters:
+        evaluated: List of dictionaries with the evaluated params and their score.
+        param_grid: Dictionary with the list of values of each parameter.
+        rng: numpy random generator.
 
-    # Initialize the Random Forest model
-    rf = RandomForestClassifier(random_state=42)
+    Output:
+        Returns the next parameters to evaluate, or None if every combination was evaluated.
+    """
+    # params are encoded over the full grid, so results of narrowed grids remain comparable
+    seen = [params_to_vector(result["params"], PARAM_GRID) for result in evaluated]
+    pool = [params for params in ParameterSampler(param_grid, n_iter=200, random_state=int(rng.integers(1e9)))
+            if params_to_vector(params, PARAM_GRID) not in seen]
+    if not pool:
+        return None
+
+    surrogate = RandomForestRegressor(n_estimators=50, random_state=0)
+    surrogate.fit(np.array(seen), np.array([result["score"] for result in evaluated]))
+    pool_vectors = np.array([params_to_vector(params, PARAM_GRID) for params in pool])
+    tree_predictions = np.stack([tree.predict(pool_vectors) for tree in surrogate.estimators_])
+    upper_bound = tree_predictions.mean(axis=0) + tree_predictions.std(axis=0)
+    return pool[int(np.argmax(upper_bound))]
+
+def tune_random_forest(X_train, y_train, conf=None):
+    """
+    Tune hyperparameters for a Random Forest Classifier within a budget.
+    Available strategies (TUNING_STRATEGY):
+        - grid: exhaustive search over the grid, until TUNING_MAX_SECONDS is reached.
+        - halving: successive halving over random candidates, as many as TUNING_MAX_FITS allows,
+          until TUNING_MAX_SECONDS is reached.
+        - random: random candidates evaluated until TUNING_MAX_FITS or TUNING_MAX_SECONDS are reached.
+        - sequential: Bayesian-style search where a surrogate model proposes each next candidate,
+          until TUNING_MAX_FITS or TUNING_MAX_SECONDS are reached.
+    Evaluated combinations are persisted in TUNING_RESULTS_PATH. With TUNING_WARM_START the search
+    starts from the best region of previous runs.
 
-    # Perform Grid Search
-    grid_search = GridSearchCV(estimator=rf, param_grid=param_grid, 
-                               cv=5, n_jobs=-1, verbose=2, scoring='accuracy')
+    Parameters:
+        X_train: Training features
+        y_train: Training labels
+        conf: config.yaml's information. None runs the exhaustive grid search.
 
-    # Fit to training data
-    grid_search.fit(X_train, y_train)
+    Returns:
+        best_model: The best Random Forest model found
+        best_params: The best hyperparameters
+    """
+    conf = conf or {}
+    strategy = conf.get("TUNING_STRATEGY", "grid")
+    cv = conf.get("TUNING_CV_FOLDS", 5)
+    max_fits = conf.get("TUNING_MAX_FITS", 200)
+    max_seconds = conf.get("TUNING_MAX_SECONDS", 600)
+    results_path = conf.get("TUNING_RESULTS_PATH")
+    rng = np.random.default_rng(42)
+
+    # parallel fits within the CPU budget of the tuning stage
+    n_jobs = rsf.stage_jobs("tuning")
+
+    # recover previous results to warm start
+    previous = load_tuning_results(results_path)
+    param_grid = PARAM_GRID
+    if previous and conf.get("TUNING_WARM_START", 0) == 1:
+        best_previous = max(previous, key=lambda result: result["score"])
+        param_grid = narrow_param_grid(PARAM_GRID, best_previous["params"])
+        print(f"\tWarm start around previous best params: {best_previous['params']}")
+
+    start_time = time.time()
+    evaluated = []
+    deadline = start_time + max_seconds
+    if strategy == "grid":
+        # every combination, while the time limit allows it
+        evaluated = search_candidates(list(ParameterGrid(param_grid)), X_train, y_train, cv, n_jobs, deadline)
+    elif strategy == "halving":
+        # each halving iteration keeps a third of the candidates: ~1.5 fits per candidate and fold
+        n_candidates = max(3, int(max_fits / (1.5 * cv)))
+        candidates = list(ParameterSampler(param_grid, n_iter=n_candidates, random_state=42))
+        evaluated, complete = successive_halving(candidates, X_train, y_train, cv, n_jobs, deadline, rng)
+    elif strategy in ("random", "sequential"):
+        # previous best combinations are evaluated first
+        seeds = [result["params"] for result in sorted(previous, key=lambda result: -result["score"])[:3]] \
+            if conf.get("TUNING_WARM_START", 0) == 1 else []
+        candidates = iter(seeds + list(ParameterSampler(param_grid, n_iter=max(1, max_fits // cv), random_state=42)))
+        n_init = max(len(seeds), 5)
+
+        while len(evaluated) * cv < max_fits and time.time() - start_time < max_seconds:
+            if strategy == "sequential" and len(evaluated) >= n_init:
+                params = propose_sequential_candidate(evaluated, param_grid, rng)
+            else:
+                params = next(candidates, None)
+            if params is None:
+                break
+            score = evaluate_params(params, X_train, y_train, cv, n_jobs)
+            evaluated.append({"params": params, "score": score})
+            print(f"\t[{len(evaluated)}] score={score:.4f} params={params}")
+    else:
+        raise ValueError(f"Unknown tuning strategy: {strategy}")
+    best_params = max(evaluated, key=lambda result: result["score"])["params"]
+    best_model = RandomForestClassifier(random_state=42, n_jobs=n_jobs, **best_params).fit(X_train, y_train)
+
+    print(f"\tTuning with {strategy} strategy: {len(evaluated)} combinations evaluated "
+          f"in {time.time() - start_time:.1f} seconds.")
+
+    # persist results for later runs, only scores obtained with all the training samples are comparable between runs
+    if strategy == "halving" and not complete:
+        evaluated = []
+    for result in evaluated:
+        result["strategy"] = strategy
+    save_tuning_results(results_path, previous + evaluated)
 
-    # Return best parameters and model
-    best_params = grid_search.best_params_
-    best_model = grid_search.best_estimator_
     return best_model, best_params
 
 def print_model_evaluation(y_test, y_pred):
@@ -168,13 +499,15 @@ def print_feature_importance(best_model, X):
 
     Parameters:
         best_model: The trained Random Forest model whose feature importances are to be extracted.
-        X: The feature dataset used for training the model, which provides the column names.
+        X: The feature dataset used for training the model, which provides the column names,
+           or the list of feature names (e.g. for sparse training matrices).
 
     Output:
         Prints a table displaying the features and their corresponding importance scores, sorted in descending order.
     """
     importance = best_model.feature_importances_
-    feature_importance = pd.DataFrame({'Feature': X.columns, 'Importance': importance})
+    feature_names = X.columns if hasattr(X, "columns") else X
+    feature_importance = pd.DataFrame({'Feature': feature_names, 'Importance': importance})
     print("\n\tFeature Importance:")
     print(feature_importance.sort_values(by='Importance', ascending=False))
 
@@ -189,7 +522,8 @@ def visualize_random_forest(best_model, feature_names):
     # Extract one tree from the Random Forest
     tree = best_model.estimators_[0]  # Use the first tree
     
-    # Plot the decision tree
+    # Plot the decision tree. matplotlib is only imported when a tree is visualized
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(20, 10))
     plot_tree(tree, feature_names=feature_names, filled=True, rounded=True, fontsize=10)
     plt.title("Decision Tree from Random Forest")
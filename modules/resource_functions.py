@@ -0,0 +1,212 @@
+import os
+import time
+import resource
+import contextlib
+from threadpoolctl import threadpool_limits
+
+# CPU budget of the process, shared by every stage, and memory ceiling of the out-of-core mode
+resources = {"cpus": None, "shares": {}, "concurrency": {}, "stages": [], "memory": None, "out_of_core": False}
+
+def cgroup_cpu_quota():
+    """
+    Function that reads the CPU quota of the container from the cgroup filesystem (v2 or v1).
+
+    Returns:
+        float: Number of CPUs allowed by the quota, or None if there is no quota.
+    """
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as file:
+            quota, period = file.read().split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1: quota -1 means no quota
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as file:
+            quota = int(file.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as file:
+            period = int(file.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+def available_cpus():
+    """
+    Function that obtains the CPUs the process can really use: the CPUs it is allowed to run on
+    (affinity), limited by the cgroup CPU quota of the container.
+
+    Returns:
+        int: Number of usable CPUs (at least 1).
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        # a fractional quota is rounded down, so parallel stages are not throttled
+        cpus = min(cpus, max(1, int(quota)))
+    return cpus
+
+def cgroup_memory_limit():
+    """
+    Function that reads the memory limit of the container from the cgroup filesystem (v2 or v1).
+
+    Returns:
+        int: Memory limit in bytes, or None if there is no limit.
+    """
+    for limit_file in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(limit_file) as file:
+                limit = file.read().strip()
+        except OSError:
+            continue
+        # cgroup v1 reports a huge number when there is no limit
+        if limit == "max" or int(limit) >= physical_memory():
+            return None
+        return int(limit)
+    return None
+
+def physical_memory():
+    """
+    Function that obtains the physical memory of the machine in bytes.
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+def configure_resources(conf):
+    """
+    Function that sets the CPU budget of the process and the share of it each stage may use.
+    BLAS and OpenMP pools of the process are limited to the budget too.
+
+    Parameters:
+        conf (dict): config.yaml's information. CPU_LIMIT (None detects the usable CPUs),
+                     STAGE_CPU_SHARES (fraction of the budget of each stage), OUT_OF_CORE and
+                     MEMORY_LIMIT (MB, None uses the container limit or the physical memory) are used.
+
+    Returns:
+        int: CPU budget of the process.
+    """
+    resources["cpus"] = conf.get("CPU_LIMIT") or available_cpus()
+    resources["shares"] = conf.get("STAGE_CPU_SHARES") or {}
+    threadpool_limits(limits=resources["cpus"])
+    print(f"Resources: {resources['cpus']} CPUs available (cgroup quota: {cgroup_cpu_quota()}).")
+
+    resources["out_of_core"] = conf.get("OUT_OF_CORE", 0) == 1
+    memory_limit = conf.get("MEMORY_LIMIT")
+    resources["memory"] = int(memory_limit * 2 ** 20) if memory_limit else cgroup_memory_limit() or physical_memory()
+    if resources["out_of_core"]:
+        print(f"Resources: out-of-core mode with a memory ceiling of {resources['memory'] / 2 ** 20:.0f} MB.")
+    return resources["cpus"]
+
+def memory_budget():
+    """
+    Function that obtains the memory a stage may use for its data in the out-of-core mode: half of
+    the ceiling, the rest is left for the interpreter, the libraries and the copies made while converting data.
+
+    Returns:
+        int: Bytes of data a stage may keep in memory.
+    """
+    if resources["memory"] is None:
+        resources["memory"] = cgroup_memory_limit() or physical_memory()
+    return resources["memory"] // 2
+
+def cpu_budget():
+    """
+    Function that obtains the CPU budget of the process, detected if it was not configured.
+
+    Returns:
+        int: Number of CPUs.
+    """
+    if resources["cpus"] is None:
+        resources["cpus"] = available_cpus()
+    return resources["cpus"]
+
+def set_stage_concurrency(stage, count):
+    """
+    Function that declares how many instances of a stage run at the same time (for example, the same
+    stage of several themes), so they split the share of the stage instead of each using all of it.
+
+    Parameters:
+        stage (str): Stage name, as used in STAGE_CPU_SHARES.
+        count (int): Instances of the stage that run at the same time.
+    """
+    resources["concurrency"][stage] = max(1, count)
+
+def stage_jobs(stage):
+    """
+    Function that obtains the number of workers (n_jobs, threads or processes) a stage may use.
+    Stages that run at the same time should have shares that add up to 1 at most.
+
+    Parameters:
+        stage (str): Stage name, as used in STAGE_CPU_SHARES. Stages without share use the whole budget.
+
+    Returns:
+        int: Number of workers (at least 1).
+    """
+    share = resources["shares"].get(stage, 1.0) / resources["concurrency"].get(stage, 1)
+    return max(1, int(cpu_budget() * share))
+
+def process_cpu_seconds():
+    """
+    Function that obtains the CPU time used by the process and its children, including the
+    running worker processes (read from /proc when available).
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    reaped = resource.getrusage(resource.RUSAGE_CHILDREN)
+    seconds = usage.ru_utime + usage.ru_stime + reaped.ru_utime + reaped.ru_stime
+
+    # running children (e.g. joblib workers) are not counted by getrusage until they finish
+    pid = str(os.getpid())
+    ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # fields after the command name: state, ppid, ... utime (12th), stime (13th)
+        if fields[1] == pid:
+            seconds += (int(fields[11]) + int(fields[12])) / ticks
+    return seconds
+
+@contextlib.contextmanager
+def stage_resources(stage):
+    """
+    Context manager that runs a stage within its CPU budget and records its CPU time.
+    BLAS threads of the process are limited so that workers times BLAS threads fit the budget;
+    joblib process workers already limit their own BLAS threads to their share of the CPUs.
+    The CPU time of the process (and its children) is process-wide: stages that run at the same time
+    are counted in each other's figure. Only the CPU time of the thread running the stage is its own.
+
+    Parameters:
+        stage (str): Stage name, as used in STAGE_CPU_SHARES.
+
+    Returns:
+        int: Number of workers the stage may use.
+    """
+    jobs = stage_jobs(stage)
+    blas_threads = max(1, cpu_budget() // resources["concurrency"].get(stage, 1) // jobs)
+    start_wall = time.time()
+    start_cpu = process_cpu_seconds()
+    start_thread = time.thread_time()
+    try:
+        with threadpool_limits(limits=blas_threads):
+            yield jobs
+    finally:
+        resources["stages"].append({"stage": stage, "jobs": jobs, "blas_threads": blas_threads,
+                                    "wall_s": time.time() - start_wall,
+                                    "thread_cpu_s": time.thread_time() - start_thread,
+                                    "process_cpu_s": process_cpu_seconds() - start_cpu})
+
+def resource_report():
+    """
+    Function that summarizes the budget and the measured CPU time of every recorded stage.
+
+    Returns:
+        pandas.DataFrame: One row per stage run: workers, BLAS threads, wall seconds, CPU seconds of the
+                          thread running the stage and CPU seconds of the whole process while it ran
+                          (shared with any stage that overlapped it).
+    """
+    # pandas is only imported when the report is made
+    import pandas as pd
+    return pd.DataFrame(resources["stages"])
@@ -0,0 +1,304 @@
+import os
+import json
+import pickle
+import hashlib
+import multiprocessing
+import concurrent.futures as cf
+from modules import metrics_functions as mtf
+from modules import resource_functions as rsf
+
+def create_stage_graph(name, conf):
+    """
+    Function that creates an empty stage graph. Stages are added with add_stage and run with
+    run_stage_graph, which starts every stage as soon as the values it needs are available.
+
+    Parameters:
+        name (str): Graph name, used in the cache filenames.
+        conf (dict): config.yaml's information. STAGE_WORKERS (stages run at the same time) and
+                     STAGE_CACHE_PATH (folder of cached stage outputs, None disables caching) are used.
+
+    Returns:
+        dict: Stage graph.
+    """
+    return {"name": name, "stages": {}, "workers": conf.get("STAGE_WORKERS", 4),
+            "cache_path": conf.get("STAGE_CACHE_PATH")}
+
+def add_stage(graph, name, func, inputs=(), outputs=None, after=(), executor="thread", cache=False, items=None,
+              span=None, tags=None):
+    """
+    Function that adds a stage to the graph.
+
+    Parameters:
+        graph (dict): Stage graph.
+        name (str): Stage name, also the name of its metrics span.
+        func (callable): Called with the values of inputs, in order. It returns the value of its
+                         output, a tuple with one value per output, or nothing if it has no outputs.
+        inputs (tuple): Names of the values the stage needs: outputs of other stages or initial values.
+        outputs (tuple): Names of the values the stage produces. Default: the stage name.
+        after (tuple): Stages that must finish before this one, without passing any value.
+        executor (str): "thread", "process" for CPU bound stages (func, inputs and outputs must be picklable),
+                        or "wait" for stages that mostly wait for other nodes: they run in their own
+                        thread and do not take one of the STAGE_WORKERS slots.
+        cache (bool): Whether the outputs are saved and reused by later runs with the same inputs.
+        items (callable): Obtains the number of processed items of the span from the func result.
+        span (str): Name of the metrics span. Default: the stage name. Stages repeated for several
+                    themes share their span name and are told apart by their tags.
+        tags (dict): Extra tags of the metrics span, e.g. node and theme.
+    """
+    if name in graph["stages"]:
+        raise ValueError(f"stage {name} is defined twice")
+    if executor not in ("thread", "process", "wait"):
+        raise ValueError(f"stage {name} has an unknown executor: {executor}")
+    graph["stages"][name] = {"name": name, "func": func, "inputs": tuple(inputs),
+                             "outputs": (name,) if outputs is None else tuple(outputs),
+                             "after": tuple(after), "executor": executor, "cache": cache, "items": items,
+                             "span": span or name, "tags": dict(tags or {})}
+
+def stage_dependencies(graph, values=()):
+    """
+    Function that obtains the stages each stage waits for, checking every input is produced once.
+
+    Parameters:
+        graph (dict): Stage graph.
+        values (iterable): Names of the initial values.
+
+    Returns:
+        dict: Stage name -> set of the stages it depends on.
+    """
+    producers = {}
+    for stage in graph["stages"].values():
+        for output in stage["outputs"]:
+            if output in producers or output in values:
+                raise ValueError(f"value {output} is produced by {producers.get(output, 'the initial values')} "
+                                 f"and by {stage['name']}")
+            producers[output] = stage["name"]
+
+    dependencies = {}
+    for stage in graph["stages"].values():
+        missing = [value for value in stage["inputs"] if value not in producers and value not in values]
+        unknown = [name for name in stage["after"] if name not in graph["stages"]]
+        if missing or unknown:
+            raise ValueError(f"stage {stage['name']} needs values {missing} and stages {unknown} that no stage produces")
+        dependencies[stage["name"]] = {producers[value] for value in stage["inputs"] if value in producers} | set(stage["after"])
+    return dependencies
+
+def plan_stage_graph(graph, values=(), targets=None):
+    """
+    Function that obtains the execution plan of a graph: waves of stages, where every stage of
+    a wave only depends on stages of previous waves, so stages of a wave may run at the same time.
+
+    Parameters:
+        graph (dict): Stage graph.
+        values (iterable): Names of the initial values.
+        targets (list): Stages to run, with the stages they depend on. Default: every stage.
+
+    Returns:
+        list: Waves, each a list of stage names.
+    """
+    dependencies = stage_dependencies(graph, values)
+
+    # stages needed by the targets
+    needed, pending = set(), list(targets or graph["stages"])
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(dependencies[name])
+
+    waves, done = [], set()
+    while len(done) < len(needed):
+        wave = sorted(name for name in needed - done if dependencies[name] <= done)
+        if not wave:
+            raise ValueError(f"stages {sorted(needed - done)} depend on each other")
+        waves.append(wave)
+        done.update(wave)
+    return waves
+
+def print_stage_plan(graph, values=(), targets=None):
+    """
+    Function that prints the execution plan of a graph without running any stage (dry run).
+
+    Parameters:
+        graph (dict): Stage graph.
+        values (iterable): Names of the initial values.
+        targets (list): Stages to run. Default: every stage.
+    """
+    print(f"Stage plan of {graph['name']} ({graph['workers']} stages at a time):")
+    for idx, wave in enumerate(plan_stage_graph(graph, values, targets)):
+        for name in wave:
+            stage = graph["stages"][name]
+            flags = [stage["executor"]] + (["cached"] if stage["cache"] and graph["cache_path"] else [])
+            print(f"\t{idx}: {name}({', '.join(stage['inputs'])}) -> {', '.join(stage['outputs']) or '-'}"
+                  f" [{', '.join(flags)}]" + (f" after {', '.join(stage['after'])}" if stage["after"] else ""))
+
+def cache_file(graph, stage, args):
+    """
+    Function that obtains the cache file of a stage for its input values. Inputs are hashed through
+    their json representation, so cached stages should take paths and configuration, not large objects.
+    """
+    key = hashlib.sha256(json.dumps(args, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(graph["cache_path"], f"{graph['name']}_{stage['name']}_{key}.pkl")
+
+def read_cache(path):
+    """
+    Function that reads cached stage outputs. Outputs that are paths must still exist.
+
+    Returns:
+        tuple: Whether the cache is valid and the cached result.
+    """
+    if not os.path.exists(path):
+        return False, None
+    with open(path, "rb") as file:
+        result = pickle.load(file)
+    values = result if isinstance(result, tuple) else (result,)
+    if any(isinstance(value, str) and os.path.isabs(value) and not os.path.exists(value) for value in values):
+        return False, None
+    return True, result
+
+def run_stage(graph, stage, args, process_pool):
+    """
+    Function that runs a stage inside its metrics span, in a process of the pool if required,
+    reusing its cached outputs when possible.
+
+    Returns:
+        Result of the stage function.
+    """
+    path = cache_file(graph, stage, args) if stage["cache"] and graph["cache_path"] else None
+    with mtf.span(stage["span"], **stage["tags"]) as span:
+        valid, result = read_cache(path) if path else (False, None)
+        span["cached"] = valid
+        if not valid:
+            if stage["executor"] == "process":
+                result, spans, stage_records = process_pool.submit(run_in_worker, stage["func"], args).result()
+                # spans and resource records of the worker are exported by this process
+                for record in spans:
+                    mtf.export_span(record, write_totals=False)
+                rsf.resources["stages"].extend(stage_records)
+            else:
+                result = stage["func"](*args)
+            if path:
+                os.makedirs(graph["cache_path"], exist_ok=True)
+                with open(path, "wb") as file:
+                    pickle.dump(result, file)
+        if stage["items"] is not None:
+            span["items"] = stage["items"](result)
+    return result
+
+# state of the stage process workers
+worker_state = {}
+
+def set_worker_barrier(barrier):
+    """
+    Function that initializes a stage process worker with the barrier shared by the workers of the pool.
+    """
+    worker_state["barrier"] = barrier
+
+def run_in_worker(func, args):
+    """
+    Function that runs a stage function in a process worker, collecting the metrics spans and the
+    resource records it creates, which would otherwise stay in the worker.
+
+    Parameters:
+        func (callable): Stage function.
+        args (list): Input values of the stage.
+
+    Returns:
+        tuple: Result of the stage function, its spans and its resource records.
+    """
+    mtf.metrics["collected"] = []
+    n_records = len(rsf.resources["stages"])
+    try:
+        result = func(*args)
+    finally:
+        spans, mtf.metrics["collected"] = mtf.metrics["collected"], None
+        stage_records = rsf.resources["stages"][n_records:]
+        del rsf.resources["stages"][n_records:]
+    return result, spans, stage_records
+
+def wait_worker_barrier():
+    """
+    Function that waits until every worker of the pool is running.
+    """
+    worker_state["barrier"].wait(timeout=60)
+    return os.getpid()
+
+def start_process_pool(workers):
+    """
+    Function that creates the process pool of the CPU bound stages and forks all its workers at once.
+    A worker forked while another thread holds a lock (e.g. an import lock) would inherit it held and
+    block when acquiring it, so no worker may be forked once stage threads run. Python versions that
+    fork workers on demand are made to fork them all by tasks that wait for each other.
+
+    Parameters:
+        workers (int): Number of worker processes.
+
+    Returns:
+        concurrent.futures.ProcessPoolExecutor: Pool with every worker running.
+    """
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(workers)
+    pool = cf.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                  initializer=set_worker_barrier, initargs=(barrier,))
+    for future in [pool.submit(wait_worker_barrier) for _ in range(workers)]:
+        future.result()
+    return pool
+
+def run_stage_graph(graph, values=None, targets=None):
+    """
+    Function that runs the stages of a graph: every stage starts as soon as the stages it depends
+    on have finished, up to STAGE_WORKERS stages at a time, plus the stages that wait for other nodes,
+    each in its own thread. If a stage fails (or ends the program),
+    stages not started are cancelled, running ones finish and the error is raised.
+
+    Parameters:
+        graph (dict): Stage graph.
+        values (dict): Initial values.
+        targets (list): Stages to run, with the stages they depend on. Default: every stage.
+
+    Returns:
+        dict: Initial values and outputs of every stage run.
+    """
+    values = dict(values or {})
+    waves = plan_stage_graph(graph, values, targets)
+    dependencies = stage_dependencies(graph, values)
+    pending = {name for wave in waves for name in wave}
+    done = set()
+    running = {}
+
+    process_pool = None
+    if any(graph["stages"][name]["executor"] == "process" for name in pending):
+        # CPU bound stages never run in more processes than the CPU budget
+        process_pool = start_process_pool(min(graph["workers"], rsf.cpu_budget()))
+    thread_pool = cf.ThreadPoolExecutor(max_workers=graph["workers"], thread_name_prefix="stage")
+    # waiting stages do not hold the workers of the other stages
+    n_waiting = sum(graph["stages"][name]["executor"] == "wait" for name in pending)
+    wait_pool = cf.ThreadPoolExecutor(max_workers=max(1, n_waiting), thread_name_prefix="stage-wait")
+    try:
+        while pending or running:
+            # start every stage whose dependencies have finished
+            for name in sorted(pending):
+                if dependencies[name] <= done:
+                    stage = graph["stages"][name]
+                    args = [values[value] for value in stage["inputs"]]
+                    pool = wait_pool if stage["executor"] == "wait" else thread_pool
+                    running[pool.submit(run_stage, graph, stage, args, process_pool)] = name
+                    pending.discard(name)
+
+            finished, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                result = future.result()
+                outputs = graph["stages"][name]["outputs"]
+                if len(outputs) == 1:
+                    values[outputs[0]] = result
+                elif outputs:
+                    values.update(zip(outputs, result))
+                done.add(name)
+    finally:
+        for future in running:
+            future.cancel()
+        thread_pool.shutdown(wait=True)
+        wait_pool.shutdown(wait=True)
+        if process_pool is not None:
+            process_pool.shutdown(wait=True)
+    return values
@@ -0,0 +1,183 @@
+import os
+import json
+import numpy as np
+from datetime import datetime, timedelta, timezone
+
+# Words of the synthetic messages. Rumours use more often the first words of RUMOUR_WORDS,
+# so trained models have some signal to learn.
+COMMON_WORDS = ["police", "people", "news", "today", "city", "breaking", "report", "video", "live", "scene",
+                "shooting", "attack", "update", "official", "confirmed", "hostage", "victims", "statement",
+                "just", "now", "here", "still", "more", "after", "says", "think", "know", "really", "good", "sad",
+                "terrible", "great", "thanks", "praying", "love", "hate", "happy", "awful", "safe", "wrong"]
+RUMOUR_WORDS = ["unconfirmed", "reportedly", "apparently", "allegedly", "sources", "claims", "rumour",
+                "heard", "possibly", "maybe"]
+HASHTAGS = ["#breaking", "#news", "#prayfor", "#update", "#live", "#justice", "#police", "#world"]
+
+# Date format of the tweets in the PHEME dataset
+TWEET_DATE_FORMAT = "%a %b %d %H:%M:%S %z %Y"
+
+def synthetic_user(idx):
+    """
+    Function that obtains the author information of a synthetic user.
+
+    Parameters:
+        idx (int): User number.
+
+    Returns:
+        dict: User id, name and screen name, as in the tweets of the PHEME dataset.
+    """
+    return {"id": 100000 + idx, "id_str": str(100000 + idx), "name": f"User {idx}", "screen_name": f"user{idx}"}
+
+def synthetic_text(rng, text_length, mentioned, rumour):
+    """
+    Function that writes the text of a synthetic message: words, mentions of other users and
+    sometimes hashtags and links.
+
+    Parameters:
+        rng (numpy.random.Generator): Random generator.
+        text_length (int): Mean number of words.
+        mentioned (list): Users mentioned in the message.
+        rumour (bool): Whether the message belongs to a rumour thread.
+
+    Returns:
+        str: Message text.
+    """
+    n_words = max(1, rng.poisson(text_length))
+    rumour_share = 0.3 if rumour else 0.05
+    words = [str(rng.choice(RUMOUR_WORDS)) if rng.random() < rumour_share else str(rng.choice(COMMON_WORDS))
+             for _ in range(n_words)]
+    if rng.random() < 0.3:
+        words.append(str(rng.choice(HASHTAGS)))
+    if rng.random() < (0.4 if rumour else 0.2):
+        words.append(f"http://t.co/{rng.integers(1e9):x}")
+    return " ".join([f"@{user['screen_name']}" for user in mentioned] + words)
+
+def synthetic_tweet(rng, tweet_id, parent_id, created_at, author, users, rumour, mention_density, text_length):
+    """
+    Function that creates a synthetic tweet with the fields of the PHEME dataset used by the preprocessing.
+
+    Parameters:
+        rng (numpy.random.Generator): Random generator.
+        tweet_id (int): Tweet id.
+        parent_id (int): Id of the replied tweet, None for source tweets.
+        created_at (datetime): Creation date.
+        author (dict): Author information.
+        users (list): Users that may be mentioned.
+        rumour (bool): Whether the tweet belongs to a rumour thread.
+        mention_density (float): Mean number of mentions per message.
+        text_length (int): Mean number of words per message.
+
+    Returns:
+        dict: Tweet in json format.
+    """
+    n_mentions = min(rng.poisson(mention_density), len(users))
+    mentioned = [users[idx] for idx in rng.choice(len(users), n_mentions, replace=False)] if n_mentions else []
+    return {
+        "id": tweet_id, "id_str": str(tweet_id),
+        "text": synthetic_text(rng, text_length, mentioned, rumour),
+        "in_reply_to_status_id": parent_id,
+        "in_reply_to_status_id_str": None if parent_id is None else str(parent_id),
+        "user": author,
+        "retweet_count": int(rng.poisson(20 if parent_id is None else 1)),
+        "favorite_count": int(rng.poisson(15 if parent_id is None else 1)),
+        "created_at": created_at.strftime(TWEET_DATE_FORMAT),
+        "entities": {"user_mentions": mentioned, "hashtags": [], "urls": []}
+    }
+
+def write_json(data, file_path):
+    """
+    Function that saves data as a json file and returns its size in bytes.
+    """
+    with open(file_path, "w", encoding="utf-8") as file:
+        json.dump(data, file)
+    return os.path.getsize(file_path)
+
+def write_thread(rng, thread_path, tweet_ids, users, rumour, reply_depth, fanout, mention_density, text_length):
+    """
+    Function that writes a synthetic thread: the source tweet, its reply cascade, and the
+    annotation.json and structure.json files of the PHEME dataset.
+
+    Parameters:
+        rng (numpy.random.Generator): Random generator.
+        thread_path (str): Folder of the thread, named after the source tweet id.
+        tweet_ids (iterator): Generator of unique tweet ids.
+        users (list): Synthetic users.
+        rumour (bool): Whether the thread is a rumour.
+        reply_depth (int): Maximum depth of the reply cascade.
+        fanout (float): Mean number of replies of each message.
+        mention_density (float): Mean number of mentions per message.
+        text_length (int): Mean number of words per message.
+
+    Returns:
+        tuple: Number of messages and bytes written.
+    """
+    source_id = int(os.path.basename(thread_path))
+    os.makedirs(os.path.join(thread_path, "source-tweets"), exist_ok=True)
+    os.makedirs(os.path.join(thread_path, "reactions"), exist_ok=True)
+    start = datetime(2015, 1, 7, tzinfo=timezone.utc) + timedelta(minutes=int(rng.integers(60 * 24 * 30)))
+
+    def author():
+        return users[int(rng.integers(len(users)))]
+
+    source = synthetic_tweet(rng, source_id, None, start, author(), users, rumour, mention_density, text_length)
+    n_bytes = write_json(source, os.path.join(thread_path, "source-tweets", f"{source_id}.json"))
+    n_messages = 1
+
+    # breadth first cascade: each message gets Poisson(fanout) replies until reply_depth
+    structure = {str(source_id): {}}
+    frontier = [(source_id, start, structure[str(source_id)])]
+    for _ in range(reply_depth):
+        next_frontier = []
+        for parent_id, parent_date, parent_structure in frontier:
+            for _ in range(rng.poisson(fanout)):
+                reply_id = next(tweet_ids)
+                reply_date = parent_date + timedelta(seconds=int(rng.exponential(600)) + 1)
+                reply = synthetic_tweet(rng, reply_id, parent_id, reply_date, author(), users, rumour,
+                                        mention_density, text_length)
+                n_bytes += write_json(reply, os.path.join(thread_path, "reactions", f"{reply_id}.json"))
+                n_messages += 1
+                parent_structure[str(reply_id)] = {}
+                next_frontier.append((reply_id, reply_date, parent_structure[str(reply_id)]))
+        frontier = next_frontier
+
+    n_bytes += write_json({"is_rumour": "rumour" if rumour else "nonrumour"}, os.path.join(thread_path, "annotation.json"))
+    n_bytes += write_json(structure, os.path.join(thread_path, "structure.json"))
+    return n_messages, n_bytes
+
+def generate_pheme_data(data_path, themes, threads, rumour_ratio=0.5, reply_depth=3, fanout=2.0,
+                        mention_density=0.5, text_length=15, seed=42):
+    """
+    Function that writes a synthetic dataset with the folder layout of the PHEME dataset:
+    all-rnr-annotated-threads/<theme>/{rumours,non-rumours}/<thread>/{source-tweets,reactions}/*.json.
+    It lets every stage be run and measured without downloading the real data.
+
+    Parameters:
+        data_path (str): Folder where all-rnr-annotated-threads is created.
+        themes (list): Theme folder names.
+        threads (int): Threads of each theme.
+        rumour_ratio (float): Share of rumour threads.
+        reply_depth (int): Maximum depth of the reply cascades.
+        fanout (float): Mean number of replies of each message.
+        mention_density (float): Mean number of mentions per message.
+        text_length (int): Mean number of words per message.
+        seed (int): Random seed, so the same parameters write the same data.
+
+    Returns:
+        dict: Number of threads, messages and bytes written.
+    """
+    rng = np.random.default_rng(seed)
+    users = [synthetic_user(idx) for idx in range(max(50, threads * 5))]
+    tweet_ids = iter(range(500000000000000000, 600000000000000000))
+    stats = {"themes": len(themes), "threads": 0, "messages": 0, "bytes": 0}
+
+    for theme in themes:
+        for idx in range(threads):
+            rumour = idx < round(threads * rumour_ratio)
+            thread_path = os.path.join(data_path, "all-rnr-annotated-threads", theme,
+                                       "rumours" if rumour else "non-rumours", str(next(tweet_ids)))
+            n_messages, n_bytes = write_thread(rng, thread_path, tweet_ids, users, rumour, reply_depth, fanout,
+                                               mention_density, text_length)
+            stats["threads"] += 1
+            stats["messages"] += n_messages
+            stats["bytes"] += n_bytes
+    return stats
@@ -0,0 +1,96 @@
+import numpy as np
+import pyarrow as pa
+import scipy.sparse as sp
+
+# Width of the hashed text features, equal in every node so no vocabulary is shared
+TEXT_HASH_FEATURES = 2 ** 14
+
+# Columns with the hashed text features of each message: feature indices and token counts
+TEXT_HASH_COLUMNS = ("text_hash_idx", "text_hash_val")
+
+def hash_text_features(tokens, hashtags):
+    """
+    Function that hashes the tokens and hashtags of each message into a sparse vector of
+    TEXT_HASH_FEATURES positions. Hashtags keep their '#', so they never collide with a token.
+
+    Parameters:
+        tokens (list): Tokens of each message.
+        hashtags (list): Hashtags of each message.
+
+    Returns:
+        scipy.sparse.csr_matrix: One row of token counts per message.
+    """
+    if len(tokens) == 0:
+        # the hasher cannot transform an empty batch
+        return sp.csr_matrix((0, TEXT_HASH_FEATURES), dtype=np.float32)
+    # sklearn is only imported by the nodes that hash messages
+    from sklearn.feature_extraction import FeatureHasher
+    hasher = FeatureHasher(n_features=TEXT_HASH_FEATURES, input_type="string", alternate_sign=False,
+                           dtype=np.float32)
+    return hasher.transform(list(msg_tokens) + list(msg_hashtags) for msg_tokens, msg_hashtags in zip(tokens, hashtags))
+
+def add_text_features(df):
+    """
+    Function that adds the hashed text features of each message as two list columns:
+    the positions with tokens and their counts.
+
+    Parameters:
+        df (pandas.DataFrame): Message information with tokens and hashtags columns.
+
+    Returns:
+        pandas.DataFrame: Message information with text_hash_idx and text_hash_val columns (counts
+                          capped at 255).
+    """
+    matrix = hash_text_features(df["tokens"], df["hashtags"])
+    bounds = matrix.indptr[1:-1]
+    df["text_hash_idx"] = np.split(matrix.indices.astype(np.uint16), bounds) if len(df) else []
+    # counts of tokens repeated more than 255 times saturate instead of wrapping around
+    counts = np.minimum(matrix.data, np.iinfo(np.uint8).max).astype(np.uint8)
+    df["text_hash_val"] = np.split(counts, bounds) if len(df) else []
+    return df
+
+def text_matrix(table):
+    """
+    Function that builds the sparse text feature matrix of received messages straight from the
+    list columns of the arrow table: list offsets are the row pointers and list values the
+    column indices and counts, so the matrix is never densified.
+
+    Parameters:
+        table (pyarrow.Table): Received message information.
+
+    Returns:
+        scipy.sparse.csr_matrix: float32 matrix of TEXT_HASH_FEATURES columns. Messages without
+                                 hashed text features (sent by previous versions) have no tokens.
+    """
+    if any(col not in table.column_names for col in TEXT_HASH_COLUMNS):
+        return sp.csr_matrix((table.num_rows, TEXT_HASH_FEATURES), dtype=np.float32)
+
+    indices = table.column("text_hash_idx").combine_chunks()
+    values = table.column("text_hash_val").combine_chunks()
+    if indices.null_count:
+        indices = indices.fill_null(pa.scalar([], indices.type))
+        values = values.fill_null(pa.scalar([], values.type))
+    offsets = indices.offsets.to_numpy()
+    return sp.csr_matrix((values.flatten().to_numpy().astype(np.float32),
+                          indices.flatten().to_numpy().astype(np.int32), offsets - offsets[0]),
+                         shape=(table.num_rows, TEXT_HASH_FEATURES))
+
+def text_feature_names():
+    """
+    Function that obtains the names of the hashed text features.
+    """
+    return [f"text_hash_{idx}" for idx in range(TEXT_HASH_FEATURES)]
+
+def combine_features(X, table):
+    """
+    Function that appends the sparse text features of the received messages to the scalar features.
+
+    Parameters:
+        X (pandas.DataFrame): Scalar features of the received messages.
+        table (pyarrow.Table): Received message information, in the same order.
+
+    Returns:
+        tuple: scipy.sparse.csr_matrix with every feature and list with the feature names.
+    """
+    dense = sp.csr_matrix(X.to_numpy(dtype=np.float32))
+    return sp.hstack([dense, text_matrix(table)], format="csr"), list(X.columns) + text_feature_names()
@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import shutil
+import uuid
+import queue
+import threading
+import paho.mqtt.client as mqtt
+from modules import mqtt_functions as mqttf
+
+# subscriptions of the in-memory broker shared by every memory transport of the process
+memory_broker = {"lock": threading.Lock(), "subscriptions": [], "share_counters": {}}
+
+def create_transport(conf, backend=None):
+    """
+    Function that creates a transport to publish and receive messages.
+    Available backends are "mqtt" (broker in config.yaml), "spool" (local filesystem folder)
+    and "memory" (queues inside the running process).
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        backend (str): Backend to use. None uses TRANSPORT_BACKEND from the configuration.
+
+    Returns:
+        dict: Transport state used by the other transport functions.
+    """
+    backend = backend or conf.get("TRANSPORT_BACKEND", "mqtt")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown transport backend: {backend}")
+    transport = {"backend": backend, "conf": conf, "listeners": [], "stop": threading.Event()}
+    BACKENDS[backend]["create"](transport)
+    return transport
+
+def transport_publish(transport, topic, message):
+    """
+    Function that publishes a message in a topic.
+
+    Parameters:
+        transport (dict): Transport created by create_transport.
+        topic (str): Topic to publish in.
+        message (str or bytes): Message to publish.
+    """
+    if isinstance(message, str):
+        message = message.encode("utf-8")
+    BACKENDS[transport["backend"]]["publish"](transport, topic, message)
+
+def transport_listen(transport, topic, on_payload):
+    """
+    Function that starts delivering the messages of a topic to a callback in background.
+    Topics accept mqtt wildcards (+ and #) and shared subscriptions ($share/<group>/<filter>)
+    in every backend: each listener receives every message, and each share group receives it once.
+
+    Parameters:
+        transport (dict): Transport created by create_transport.
+        topic (str): Topic to subscribe to.
+        on_payload (function): Function called with each received payload (bytes).
+    """
+    BACKENDS[transport["backend"]]["listen"](transport, topic, on_payload)
+
+def transport_stop(transport):
+    """
+    Function that stops listening and closes the transport.
+
+    Parameters:
+        transport (dict): Transport created by create_transport.
+    """
+    transport["stop"].set()
+    BACKENDS[transport["backend"]]["stop"](transport)
+
+def find_and_send_msg(conf, send_folder, client_id, transport=None, run_id=None):
+    """
+    Function that sends every zip file of a folder through a transport.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        send_folder (str): Folder with the zip files to send.
+        client_id (str): Client node identification.
+        transport (dict): Transport to use. None creates one from the configuration.
+        run_id (int): Identification of the client run. None creates a new one.
+
+    Returns:
+        int: Identification of the client run, to send further messages of the same run.
+    """
+    own_transport = transport is None
+    if own_transport:
+        transport = create_transport(conf)
+    publish = lambda topic, message: transport_publish(transport, topic, message)
+    run_id = mqttf.find_and_send_msg(conf, send_folder, client_id, publish, run_id)
+    if own_transport:
+        transport_stop(transport)
+    return run_id
+
+def wait_messages(inbox, kind, expected, timeout, round_idx=None):
+    """
+    Function that collects messages of a kind (and round) until expected clients are received or the timeout expires.
+    A message pre-aggregated by an aggregator counts as the n_clients clients it represents.
+
+    Parameters:
+        inbox (queue.Queue): Queue with received messages (dict with kind and client fields).
+        kind (str): Message kind to collect.
+        expected (int): Number of clients to wait for. None waits until the timeout.
+        timeout (float): Maximum waiting time in seconds.
+        round_idx (int): Round of the messages. None accepts any round.
+
+    Returns:
+        dict: Last message of each client.
+    """
+    messages = {}
+    deadline = time.time() + timeout
+    clients = lambda: sum(message.get("n_clients", 1) for message in messages.values())
+    while (expected is None or clients() < expected) and time.time() < deadline:
+        try:
+            message = inbox.get(timeout=min(1.0, max(deadline - time.time(), 0.01)))
+        except queue.Empty:
+            continue
+        if message.get("kind") == kind and (round_idx is None or message.get("round") == round_idx):
+            messages[message["client"]] = message
+    return messages
+
+# MQTT BACKEND
+
+def mqtt_create(transport):
+    transport["client"] = mqttf.create_mqtt_client(transport["conf"])
+    transport["client"].loop_start()
+
+def mqtt_publish(transport, topic, message):
+    info = transport["client"].publish(topic, message, qos=transport["conf"].get("MQTT_QOS", 0))
+    info.wait_for_publish()
+
+def mqtt_listen(transport, topic, on_payload):
+    # a callback per topic filter, so each topic of a transport reaches its own handler
+    _, topic_filter = mqttf.split_shared_topic(topic)
+    transport["client"].message_callback_add(topic_filter, lambda client, userdata, message: on_payload(message.payload))
+    transport["client"].subscribe(topic, qos=transport["conf"].get("MQTT_QOS", 0))
+
+def mqtt_stop(transport):
+    transport["client"].disconnect()
+    transport["client"].loop_stop()
+
+# SPOOL BACKEND: each message is a file. Listeners register their topic filter in the .listeners folder and
+# receive a copy of each matching message in their own queue folder (a single one for each share group).
+# Messages without listeners wait in a folder per topic until a listener claims them.
+
+def spool_create(transport):
+    transport["spool_path"] = transport["conf"].get("SPOOL_PATH", "/usr/local/app/spool")
+    transport["subscriptions"] = []
+    transport["registrations"] = (None, [])
+    os.makedirs(os.path.join(transport["spool_path"], ".listeners"), exist_ok=True)
+
+def spool_write(folder, message):
+    """
+    Function that writes a message file in a folder. Returns False if the folder does not exist,
+    because the listener that owned it stopped.
+    """
+    # write with a temporary name and rename, so readers never see partial files
+    file_path = os.path.join(folder, f"{time.time_ns()}-{uuid.uuid4().hex}.msg")
+    try:
+        with open(file_path + ".tmp", "wb") as file:
+            file.write(message)
+    except FileNotFoundError:
+        return False
+    os.replace(file_path + ".tmp", file_path)
+    return True
+
+def spool_registrations(transport):
+    """
+    Function that obtains the registered listeners of the spool, read again only when the .listeners folder changes.
+    """
+    folder = os.path.join(transport["spool_path"], ".listeners")
+    mtime = os.stat(folder).st_mtime_ns
+    if transport["registrations"][0] != mtime:
+        registrations = []
+        for name in os.listdir(folder):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(folder, name)) as file:
+                    registrations.append(json.load(file))
+            except (FileNotFoundError, json.JSONDecodeError):
+                # unregistered, or still being written
+                continue
+        transport["registrations"] = (mtime, registrations)
+    return transport["registrations"][1]
+
+def spool_publish(transport, topic, message):
+    # a copy for every listener whose filter matches, one for each share group
+    queues = {registration["queue"] for registration in spool_registrations(transport)
+              if mqtt.topic_matches_sub(registration["topic"], topic)}
+    delivered = [spool_write(os.path.join(transport["spool_path"], queue_name), message) for queue_name in sorted(queues)]
+    if not any(delivered):
+        topic_folder = os.path.join(transport["spool_path"], *topic.split("/"))
+        os.makedirs(topic_folder, exist_ok=True)
+        spool_write(topic_folder, message)
+
+def spool_poll(transport, subscription, on_payload):
+    """
+    Function executed by the spool listener thread. Claims, reads and removes the message files of its
+    queue folder, and of the topic folders of messages published before any listener, in arrival order.
+    """
+    spool_path = transport["spool_path"]
+    interval = transport["conf"].get("SPOOL_POLL_INTERVAL", 0.05)
+    claim_suffix = f".{uuid.uuid4().hex}"
+    queue_folder = os.path.join(spool_path, subscription["queue"])
+    while True:
+        pending = [os.path.join(queue_folder, file) for file in os.listdir(queue_folder) if file.endswith(".msg")]
+        for folder, folders, files in os.walk(spool_path):
+            # queue and registration folders are not topics
+            folders[:] = [name for name in folders if not name.startswith(".")]
+            msg_topic = os.path.relpath(folder, spool_path).replace(os.sep, "/")
+            if msg_topic != "." and mqtt.topic_matches_sub(subscription["topic"], msg_topic):
+                pending.extend(os.path.join(folder, file) for file in files if file.endswith(".msg"))
+
+        for file_path in sorted(pending, key=os.path.basename):
+            # renaming claims the file, so a share group or an unclaimed message is consumed by a single listener
+            try:
+                os.rename(file_path, file_path + claim_suffix)
+            except FileNotFoundError:
+                continue
+            with open(file_path + claim_suffix, "rb") as file:
+                payload = file.read()
+            os.remove(file_path + claim_suffix)
+            on_payload(payload)
+
+        # once unregistered, finish after the queue is drained
+        if not pending:
+            if subscription["closed"].is_set():
+                return
+            transport["stop"].wait(interval)
+
+def spool_listen(transport, topic, on_payload):
+    group, topic_filter = mqttf.split_shared_topic(topic)
+    listener_id = uuid.uuid4().hex
+    queue_name = os.path.join(".queues", f"share-{group}" if group is not None else listener_id)
+    subscription = {"id": listener_id, "topic": topic_filter, "group": group, "queue": queue_name,
+                    "closed": threading.Event()}
+    os.makedirs(os.path.join(transport["spool_path"], queue_name), exist_ok=True)
+
+    # the queue folder exists before publishers can see the registration
+    registration_path = os.path.join(transport["spool_path"], ".listeners", f"{listener_id}.json")
+    with open(registration_path + ".tmp", "w") as file:
+        json.dump({"topic": topic_filter, "queue": queue_name}, file)
+    os.replace(registration_path + ".tmp", registration_path)
+
+    listener = threading.Thread(target=spool_poll, args=(transport, subscription, on_payload), daemon=True)
+    listener.start()
+    transport["subscriptions"].append(subscription)
+    transport["listeners"].append(listener)
+
+def spool_stop(transport):
+    # unregister first, so the queues stop receiving copies, and drain them
+    for subscription in transport["subscriptions"]:
+        os.remove(os.path.join(transport["spool_path"], ".listeners", f"{subscription['id']}.json"))
+        subscription["closed"].set()
+    for listener in transport["listeners"]:
+        listener.join()
+    # queues of share groups are kept for the other members of the group
+    for subscription in transport["subscriptions"]:
+        if subscription["group"] is None:
+            shutil.rmtree(os.path.join(transport["spool_path"], subscription["queue"]), ignore_errors=True)
+
+# MEMORY BACKEND: in-process broker, every subscription has its own queue and delivery thread
+
+def memory_create(transport):
+    transport["subscriptions"] = []
+
+def memory_publish(transport, topic, message):
+    with memory_broker["lock"]:
+        matching = [sub for sub in memory_broker["subscriptions"] if mqtt.topic_matches_sub(sub["topic"], topic)]
+
+        # every plain subscription receives the message, each share group only once (round robin)
+        targets = [sub for sub in matching if sub["group"] is None]
+        groups = {}
+        for sub in matching:
+            if sub["group"] is not None:
+                groups.setdefault(sub["group"], []).append(sub)
+        for group, members in groups.items():
+            counter = memory_broker["share_counters"].get(group, 0)
+            targets.append(members[counter % len(members)])
+            memory_broker["share_counters"][group] = counter + 1
+
+    for sub in targets:
+        sub["queue"].put(message)
+
+def memory_deliver(transport, subscription, on_payload):
+    """
+    Function executed by each memory subscription thread. Delivers queued payloads until a None sentinel arrives.
+    """
+    while True:
+        payload = subscription["queue"].get()
+        if payload is None:
+            return
+        on_payload(payload)
+
+def memory_listen(transport, topic, on_payload):
+    group, topic_filter = mqttf.split_shared_topic(topic)
+    subscription = {"topic": topic_filter, "group": group, "queue": queue.Queue()}
+    with memory_broker["lock"]:
+        memory_broker["subscriptions"].append(subscription)
+    listener = threading.Thread(target=memory_deliver, args=(transport, subscription, on_payload), daemon=True)
+    listener.start()
+    transport["subscriptions"].append(subscription)
+    transport["listeners"].append(listener)
+
+def memory_stop(transport):
+    with memory_broker["lock"]:
+        for subscription in transport["subscriptions"]:
+            memory_broker["subscriptions"].remove(subscription)
+    # deliver already queued payloads before stopping
+    for subscription in transport["subscriptions"]:
+        subscription["queue"].put(None)
+    for listener in transport["listeners"]:
+        listener.join()
+
+BACKENDS = {
+    "mqtt": {"create": mqtt_create, "publish": mqtt_publish, "listen": mqtt_listen, "stop": mqtt_stop},
+    "spool": {"create": spool_create, "publish": spool_publish, "listen": spool_listen, "stop": spool_stop},
+    "memory": {"create": memory_create, "publish": memory_publish, "listen": memory_listen, "stop": memory_stop}
+}
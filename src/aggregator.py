@@ -0,0 +1,84 @@
+import sys
+import os
+from pathlib import Path
+import yaml
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Import the module
+from modules import aggregator_functions as aggf
+from modules import resource_functions as rsf
+from modules import metrics_functions as mtf
+from modules import profiling_functions as pf
+from modules import stage_graph_functions as sgf
+
+# create corresponding paths
+root_path = "/usr/local/app/"
+tmp_path = os.path.join(root_path, "tmp")
+
+# READ DATA FROM CONFIG.YAML (by main)
+conf = {}
+
+def create_aggregator(node_id):
+    """
+    Stage that starts receiving from the children of the aggregator.
+    """
+    return aggf.create_aggregator(conf, node_id)
+
+def relay(node_id, aggregator):
+    """
+    Stage that merges and forwards the messages of the children for AGGREGATOR_TIME_LISTENING seconds
+    (TIME_LISTENING_MESSAGES if not set), and forwards every pending message at the end.
+    """
+    seconds = conf.get("AGGREGATOR_TIME_LISTENING") or conf["TIME_LISTENING_MESSAGES"]
+    print(f"{node_id}: Relaying messages for {seconds} seconds...")
+    aggf.run_aggregator(aggregator, seconds)
+    return aggf.close_aggregator(aggregator)
+
+def aggregator_stage_graph(conf):
+    """
+    Function that defines the aggregator stages.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+
+    Returns:
+        dict: Stage graph.
+    """
+    stages = sgf.create_stage_graph("aggregator", conf)
+    sgf.add_stage(stages, "create_aggregator", create_aggregator, ("node_id",), ("aggregator",))
+    sgf.add_stage(stages, "relay", relay, ("node_id", "aggregator"), ("stats",), executor="wait",
+                  items=lambda stats: stats["forwarded"]["messages"])
+    return stages
+
+def main():
+    """
+    Function that runs the aggregator: reads its role and configuration and runs its stages.
+    """
+    # read role file
+    with open(os.path.join(tmp_path, "role.txt"), "r") as role_file:
+        role = role_file.read().strip()
+    node_id = aggf.aggregator_id(role)
+
+    conf.update(yaml.safe_load(Path(os.path.join(root_path, "config.yaml")).read_text()))
+
+    # CPU budget shared by the stages, so parallel pools do not oversubscribe the container
+    rsf.configure_resources(conf)
+
+    # stage spans are exported as JSON lines and Prometheus text
+    mtf.configure_metrics(conf, node_id)
+
+    # stages selected in PROFILE_STAGES (config.yaml or environment) are profiled
+    pf.configure_profiling(conf, node_id)
+
+    stages = aggregator_stage_graph(conf)
+    values = {"node_id": node_id}
+    if "--dry-run" in sys.argv or os.environ.get("STAGE_DRY_RUN") == "1":
+        sgf.print_stage_plan(stages, values)
+        return
+    sgf.run_stage_graph(stages, values)
+    print(f"{node_id}: END.")
+
+if __name__ == "__main__":
+    main()
@@ -3,90 +3,435 @@ import yaml
 from pathlib import Path
 import sys
 import pickle
+import asyncio
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # Import the module
-from modules import mqtt_functions as mqttf
+from modules import transport_functions as tf
 from modules import data_preparation_functions as dpf
 from modules import graph_creation_analysis_functions as gcaf
+from modules import resource_functions as rsf
+from modules import metrics_functions as mtf
+from modules import profiling_functions as pf
+from modules import stage_graph_functions as sgf
+
+# Modules only used by some training modes (federated, histogram, model broadcast, async mqtt) and
+# their sklearn dependencies are imported by the stages that use them, so the client starts faster.
 
 # create corresponding paths
 root_path = "/usr/local/app/"
 tmp_path = os.path.join(root_path, "tmp")
 
-# read role file
-role_file = open(os.path.join(tmp_path,"role.txt"), "r") 
-role = role_file.read().strip()
-role_file.close() 
-
-# read data_config file
-data_conf = yaml.safe_load(Path(os.path.join(root_path,"data_config.yaml")).read_text())
-
-# read config file
-conf = yaml.safe_load(Path(os.path.join(root_path,"config.yaml")).read_text())
-
-# obtain id and execute code
-id = None
-if "_" in role:
-    id = role.split("_")[1]
-    if id:
-
-        # select corresponding theme 
-        theme = data_conf["THEMES"][id]  
-        print(f"Client{id}: Selected theme is: {theme}.")        
-        
-        # create destination folder to save data to analyze.
-        data_path = os.path.join(root_path, data_conf["DATA_PATH"])
-        os.makedirs(data_path, exist_ok=True)
- 
-        # create folder to save preprocess data
-        main_folder = "all-rnr-annotated-threads"
-        theme_path = os.path.join(os.path.join(data_path, main_folder),theme)
-        out_folder = os.path.join(theme_path, "preprocess")
-        os.makedirs(out_folder, exist_ok=True)
-
-        # create json save folder
-        json_out_folder = os.path.join(out_folder, "jsons")
-        os.makedirs(json_out_folder, exist_ok=True)
-
-        # create graph save folder
-        graph_folder = os.path.join(out_folder, "graph")
-        os.makedirs(graph_folder, exist_ok=True)
-
-        # download and prepare data
-        print(f"Client{id}: Download and prepare data for analysis.")
-        dpf.download_clean_preprocess_and_structure(data_conf, data_path, theme,
-                                            theme_path, out_folder,json_out_folder)
-        
-        # create message relation graph
-        print(f"Client{id}: Creating graph from structure jsons...")
-        gcaf.create_and_save_graph(json_out_folder, graph_folder, False)
-
-        # analyze graph to obtain patterns
-        print(f"Client{id}: Analysing graph to obtain patterns...")       
-        # recover graph
-        with open(os.path.join(graph_folder, 'graph.pkl'), 'rb') as f:
-               graph = pickle.load(f)
-
-        # get information and save in a big file
-        file_path = gcaf.get_msg_information(graph, data_path)
-
-        # split and zip file in smaller data batches
-        print(f"Client{id}: Preparing data to be send to the server...")
-
-        # create send_folder to save splitted folder
-        send_folder = os.path.join(data_path, "files_to_send")
-        os.makedirs(send_folder, exist_ok=True)
-
-        # split data and save zipped to be send
-        dpf.split_and_zip_files(file_path, send_folder, theme)
- 
-        # Send splitted and zipped data to the server
-        print(f"Client{id}: Sending data to the server...")
-        mqttf.find_and_send_msg(conf, send_folder, f"Client_{id}")        
-        print(f"Client{id}: END.")
-        
-       
+# data_config.yaml and config.yaml information, read by main
+data_conf = {}
+conf = {}
+
+async def extract_and_send(graph, data_path, send_folder, theme, client_id):
+    """
+    Coroutine that overlaps message information extraction with sending: each batch of 100 messages
+    is zipped by a worker thread and published while the following messages are analyzed.
+    The complete summary is saved in data_path at the end.
+    """
+    import pandas as pd
+    from modules import async_mqtt_functions as amqttf
+    loop = asyncio.get_running_loop()
+    file_queue = asyncio.Queue()
+
+    def extract_and_zip():
+        chunks = []
+        try:
+            for idx, chunk in enumerate(gcaf.iterate_msg_information(graph, 100, conf)):
+                zip_path = dpf.zip_chunk(chunk, send_folder, theme, idx)
+                loop.call_soon_threadsafe(file_queue.put_nowait, zip_path)
+                chunks.append(chunk)
+        finally:
+            loop.call_soon_threadsafe(file_queue.put_nowait, None)
+        return chunks
+
+    aclient = await amqttf.create_async_mqtt_client(conf)
+    producer = loop.run_in_executor(None, extract_and_zip)
+    await amqttf.async_find_and_send_msg(conf, aclient, file_queue, client_id)
+    chunks = await producer
+    await amqttf.close_async_mqtt_client(aclient)
+    gcaf.save_msg_summary(pd.concat(chunks, ignore_index=True), data_path)
+
+def download_data(data_path, themes):
+    """
+    Stage that downloads the data archive once and extracts and cleans the folders of every theme of the client.
+    """
+    print(f"Client: Download data of {len(themes)} theme(s) for analysis.")
+    return dpf.download_and_clean_data(data_conf, data_path, list(themes))
+
+def prepare_data(client_id, theme_path, out_folder, json_out_folder):
+    """
+    Stage that cleans the theme data into its normalized tables and creates the message structure jsons.
+    """
+    print(f"{client_id}: Prepare data for analysis.")
+    return dpf.preprocess_and_structure(theme_path, out_folder, json_out_folder)
+
+def create_graph(client_id, tables_folder, graph_folder):
+    """
+    Stage that creates the message relation graph from the normalized tables and saves it.
+    """
+    print(f"{client_id}: Creating graph from normalized tables...")
+    graph = gcaf.create_graph_from_tables(tables_folder)
+    with open(os.path.join(graph_folder, 'graph.pkl'), 'wb') as f:
+        pickle.dump(graph, f)
+    return graph
+
+def clean_send_folder(send_folder):
+    """
+    Stage that creates the folder of the files to send and removes the files of previous runs.
+    """
+    os.makedirs(send_folder, exist_ok=True)
+    dpf.remove_files(send_folder, os.listdir(send_folder), False)
+    return send_folder
+
+def get_msg_information(client_id, graph, work_path):
+    """
+    Stage that analyzes the graph to obtain the information of each message, saved in a big file.
+    """
+    print(f"{client_id}: Analysing graph to obtain patterns...")
+    return gcaf.get_msg_information(graph, work_path, conf)
+
+def stream_msg_information(client_id, tables_folder, work_path, group_bytes):
+    """
+    Stage that creates the graph in groups of threads and spills the information of each message
+    to the msg_summary dataset, so the graph of the whole theme is never in memory (out-of-core mode).
+    """
+    print(f"{client_id}: Analysing graph in groups of threads to obtain patterns...")
+    return gcaf.stream_msg_information(tables_folder, work_path, group_bytes, conf)
+
+def train_local_forest(client_id, summary_path, work_path):
+    """
+    Stage that trains the local forest: only its trees and the held-out rows are sent.
+    """
+    from modules import federated_functions as fedf
+    print(f"{client_id}: Training local forest...")
+    with rsf.stage_resources("local_training"):
+        model, n_samples, holdout_df = fedf.train_local_forest(summary_path, conf)
+    holdout_path = os.path.join(work_path, "holdout_summary.parquet")
+    holdout_df.to_parquet(holdout_path, engine="pyarrow")
+    return model, n_samples, holdout_path
+
+def split_and_zip_files(client_id, file_path, send_folder, theme):
+    """
+    Stage that splits the data in smaller batches, zipped to be sent.
+    """
+    print(f"{client_id}: Preparing data to be send to the server...")
+    dpf.split_and_zip_files(file_path, send_folder, theme)
+    return sorted(os.listdir(send_folder))
+
+def prepare_delta(client_id, summary_path, send_folder, theme, sync_path):
+    """
+    Stage that zips only the rows inserted or updated since the last delta acknowledged by the server.
+    """
+    from modules import delta_sync_functions as dsf
+    print(f"{client_id}: Preparing rows changed since the last acknowledged delta...")
+    delta = dsf.prepare_delta(summary_path, send_folder, theme, sync_path)
+    return sorted(os.listdir(send_folder)), delta
+
+def send_files(client_id, send_folder, zip_files, transport):
+    """
+    Stage that sends the zipped data batches to the server.
+    """
+    print(f"{client_id}: Sending data to the server...")
+    return tf.find_and_send_msg(conf, send_folder, client_id, transport)
+
+def send_local_forest(client_id, theme, model, n_samples, run_id, transport):
+    """
+    Stage that sends the local forest to the server, in the same run as the held-out rows.
+    """
+    from modules import federated_functions as fedf
+    if model is not None:
+        print(f"{client_id}: Sending local forest to the server...")
+        fedf.send_local_forest(conf, model, n_samples, client_id, theme, run_id, transport)
+
+def start_ack_listener(client_id):
+    """
+    Stage that starts listening to the acknowledgement of the delta of the theme.
+    """
+    from modules import delta_sync_functions as dsf
+    return dsf.start_ack_listener(conf, client_id)
+
+def send_delta_commit(client_id, delta, run_id, transport):
+    """
+    Stage that sends the commit of the delta after its files, with the deleted rows.
+    """
+    from modules import delta_sync_functions as dsf
+    dsf.send_delta_commit(conf, delta, client_id, run_id, transport)
+
+def wait_delta_ack(client_id, ack_listener, run_id, sync_path):
+    """
+    Stage that waits for the server to acknowledge the delta, so the next run sends the rows changed since this one.
+    """
+    from modules import delta_sync_functions as dsf
+    print(f"{client_id}: Waiting for the delta acknowledgement...")
+    return dsf.wait_delta_ack(conf, ack_listener, run_id, sync_path)
+
+def histogram_training(client_id, summary_path):
+    """
+    Stage that takes part in the histogram-based forest growth: only feature histograms are sent.
+    """
+    from modules import federated_histogram_functions as histf
+    histf.run_histogram_client(conf, summary_path, client_id)
+
+def start_model_listener():
+    """
+    Stage that starts listening to the model broadcast.
+    """
+    from modules import model_broadcast_functions as mbf
+    return mbf.start_model_listener(conf)
+
+def receive_model(listener):
+    """
+    Stage that waits for the model trained by the server, shared by every theme of the client.
+    """
+    from modules import model_broadcast_functions as mbf
+    print("Client: Waiting for the trained model...")
+    return mbf.receive_model(conf, listener)
+
+def score_and_report(client_id, artifact, summary_path, transport):
+    """
+    Stage that scores the own messages with the trained model and reports only aggregates.
+    """
+    from modules import model_broadcast_functions as mbf
+    if artifact is None:
+        return None
+    scores = mbf.score_and_report(conf, artifact, summary_path, client_id, transport)
+    print(f"{client_id}: {len(scores)} messages scored with model version {artifact['metadata']['version']}.")
+    return scores
+
+# values shared by the stages of every theme, the other values are of a single theme
+SHARED_VALUES = ("data_path", "themes", "theme_paths", "transport", "listener", "artifact", "group_bytes")
+
+def add_theme_stage(stages, client_id, theme, name, func, inputs=(), outputs=None, after=(), **kwargs):
+    """
+    Function that adds the stage of a theme to the graph. Stage and value names get the client id,
+    so the stages of several themes do not collide, and its span is tagged with the client and theme.
+    Stages in after are stages shared by every theme.
+    """
+    theme_name = lambda value: value if value in SHARED_VALUES else f"{value}@{client_id}"
+    outputs = (name,) if outputs is None else outputs
+    sgf.add_stage(stages, theme_name(name), func, [theme_name(value) for value in inputs],
+                  [theme_name(value) for value in outputs], after,
+                  span=name, tags={"node": client_id, "theme": theme}, **kwargs)
+    return theme_name(name)
+
+def add_theme_stages(stages, conf, client_id, theme, executor):
+    """
+    Function that adds the stages of a theme for the configured training mode and transport.
+
+    Parameters:
+        stages (dict): Stage graph.
+        conf (dict): config.yaml's information.
+        client_id (str): Client node identification of the theme.
+        theme (str): Theme name.
+        executor (str): Executor of the CPU bound stages.
+
+    Returns:
+        str: Name of the last stage that sends data to the server.
+    """
+    mode = conf.get("TRAINING_MODE", "central")
+    add = lambda *args, **kwargs: add_theme_stage(stages, client_id, theme, *args, **kwargs)
+    add("prepare_data", prepare_data, ("client_id", "theme_path", "out_folder", "json_out_folder"),
+        ("json_folder", "tables_folder"), after=("download_data",), executor=executor, cache=True,
+        items=lambda folders: len(os.listdir(folders[0])))
+    summary_rows = dpf.parquet_rows
+    # federated held-out rows are sent whole: only central and online summaries are synchronized by deltas
+    delta_sync = conf.get("DELTA_SYNC", 0) == 1 and mode in ("central", "online")
+    async_send = conf.get("ASYNC_TRANSPORT", 0) == 1 and conf.get("TRANSPORT_BACKEND", "mqtt") == "mqtt" \
+        and mode not in ("federated", "histogram") and not rsf.resources["out_of_core"] and not delta_sync
+    if rsf.resources["out_of_core"]:
+        # groups of threads are analysed and spilled one at a time
+        add("stream_msg_information", stream_msg_information, ("client_id", "tables_folder", "work_path", "group_bytes"),
+            ("summary_path",), executor=executor, items=summary_rows)
+    else:
+        add("create_graph", create_graph, ("client_id", "tables_folder", "graph_folder"), ("graph",),
+            executor=executor, items=lambda graph: graph.number_of_nodes())
+        if not async_send:
+            add("get_msg_information", get_msg_information, ("client_id", "graph", "work_path"), ("summary_path",),
+                executor=executor, items=summary_rows)
+    add("clean_send_folder", clean_send_folder, ("send_folder_path",), ("send_folder",))
+
+    # listen to the model broadcast before sending, so it is not missed
+    listener_started = ("start_model_listener",) if conf.get("MODEL_BROADCAST", 0) == 1 else ()
+    if mode == "histogram":
+        # only feature histograms are sent: messages never leave the client
+        return add("histogram_training", histogram_training, ("client_id", "summary_path"), (), after=listener_started,
+                   executor="wait")
+    if async_send:
+        # extract information in batches and send each batch while the next ones are extracted
+        def extract_and_send_stage(client_id, graph, work_path, send_folder, theme):
+            print(f"{client_id}: Extracting information and sending data to the server...")
+            asyncio.run(extract_and_send(graph, work_path, send_folder, theme, client_id))
+            return os.path.join(work_path, "msg_summary.parquet")
+        return add("extract_and_send", extract_and_send_stage, ("client_id", "graph", "work_path", "send_folder", "theme"),
+                   ("summary_path",), after=listener_started, items=summary_rows)
+
+    file_to_send = "summary_path"
+    if mode == "federated":
+        add("local_training", train_local_forest, ("client_id", "summary_path", "work_path"),
+            ("model", "n_samples", "holdout_path"), executor=executor, items=lambda result: result[1])
+        file_to_send = "holdout_path"
+    if delta_sync:
+        # only rows changed since the last acknowledged delta are sent, the acknowledgement is listened to before
+        listener_started += (add("start_ack_listener", start_ack_listener, ("client_id",), ("ack_listener",)),)
+        add("prepare_delta", prepare_delta, ("client_id", "summary_path", "send_folder", "theme", "sync_path"),
+            ("zip_files", "delta"), items=lambda result: result[1]["n_upserts"])
+    else:
+        add("split_and_zip_files", split_and_zip_files, ("client_id", file_to_send, "send_folder", "theme"),
+            ("zip_files",), items=len)
+    last_sent = add("send", send_files, ("client_id", "send_folder", "zip_files", "transport"), ("run_id",),
+                    after=listener_started)
+    if delta_sync:
+        committed = add("send_delta_commit", send_delta_commit, ("client_id", "delta", "run_id", "transport"), ())
+        last_sent = add("wait_delta_ack", wait_delta_ack, ("client_id", "ack_listener", "run_id", "sync_path"),
+                        ("ack",), after=(committed,), executor="wait")
+    if mode == "federated":
+        last_sent = add("send_local_forest", send_local_forest,
+                        ("client_id", "theme", "model", "n_samples", "run_id", "transport"), ())
+    return last_sent
+
+def client_stage_graph(conf, clients):
+    """
+    Function that defines the client stages for the configured training mode and transport.
+    Independent stages, like cleaning the send folder or listening to the model broadcast,
+    run while the data is being prepared. With several themes, the archive is downloaded once,
+    the CPU bound stages of each theme run in parallel processes, and every theme publishes
+    through the same transport connection with its own client id.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+        clients (dict): Client id -> theme of every theme processed by the client.
+
+    Returns:
+        dict: Stage graph.
+    """
+    stages = sgf.create_stage_graph("client", conf)
+    executor = "process" if len(clients) > 1 else "thread"
+    sgf.add_stage(stages, "download_data", download_data, ("data_path", "themes"), ("theme_paths",),
+                  cache=True, items=len)
+    sgf.add_stage(stages, "open_transport", lambda: tf.create_transport(conf), (), ("transport",))
+    if conf.get("MODEL_BROADCAST", 0) == 1:
+        sgf.add_stage(stages, "start_model_listener", start_model_listener, (), ("listener",))
+
+    last_sent = {client_id: add_theme_stages(stages, conf, client_id, theme, executor)
+                 for client_id, theme in clients.items()}
+
+    if conf.get("MODEL_BROADCAST", 0) == 1:
+        # a single model for every theme: score own messages with it and report only aggregates
+        sgf.add_stage(stages, "receive_model", receive_model, ("listener",), ("artifact",),
+                      after=tuple(last_sent.values()), executor="wait")
+        for client_id, theme in clients.items():
+            add_theme_stage(stages, client_id, theme, "score_and_report", score_and_report,
+                            ("client_id", "artifact", "summary_path", "transport"), ("scores",),
+                            items=lambda scores: 0 if scores is None else len(scores))
+
+    # the shared connection is closed once every stage publishing through it has finished
+    publishers = tuple(name for name, stage in stages["stages"].items() if "transport" in stage["inputs"])
+    sgf.add_stage(stages, "close_transport", tf.transport_stop, ("transport",), (), after=publishers)
+    return stages
+
+def theme_values(data_path, client_id, theme, multiple):
+    """
+    Function that creates the folders of a theme and obtains the values its stages use.
+
+    Parameters:
+        data_path (str): Folder where data is downloaded.
+        client_id (str): Client node identification of the theme.
+        theme (str): Theme name.
+        multiple (bool): Whether the client processes several themes. Then the summaries and files
+                         to send of each theme are saved in its own folder.
+
+    Returns:
+        dict: Values of the theme stages.
+    """
+    # create folder to save preprocess data
+    theme_path = os.path.join(data_path, "all-rnr-annotated-threads", theme)
+    out_folder = os.path.join(theme_path, "preprocess")
+
+    # create json and graph save folders
+    json_out_folder = os.path.join(out_folder, "jsons")
+    graph_folder = os.path.join(out_folder, "graph")
+    work_path = os.path.join(data_path, client_id) if multiple else data_path
+    for folder in (json_out_folder, graph_folder, work_path):
+        os.makedirs(folder, exist_ok=True)
+
+    values = {"client_id": client_id, "theme": theme, "theme_path": theme_path, "out_folder": out_folder,
+              "json_out_folder": json_out_folder, "graph_folder": graph_folder, "work_path": work_path,
+              "send_folder_path": os.path.join(work_path, "files_to_send"), "sync_path": os.path.join(work_path, "sync")}
+    return {f"{name}@{client_id}": value for name, value in values.items()}
+
+def client_themes(role, data_conf):
+    """
+    Function that obtains the themes of the client from its role: CLIENT_<id>, several ids
+    (CLIENT_1,3,5) or every theme (CLIENT_all).
+
+    Parameters:
+        role (str): Role of the node.
+        data_conf (dict): data_config.yaml's information.
+
+    Returns:
+        dict: Client id -> theme of every theme processed by the client.
+    """
+    if "_" not in role:
+        return {}
+    ids_text = role.split("_", 1)[1]
+    ids = list(data_conf["THEMES"]) if ids_text.lower() == "all" else [id.strip() for id in ids_text.split(",") if id.strip()]
+    return {f"Client_{id}": data_conf["THEMES"][id] for id in ids}
+
+def main():
+    """
+    Function that runs the client: reads its role and configuration and runs its stages.
+    """
+    # read role file
+    with open(os.path.join(tmp_path, "role.txt"), "r") as role_file:
+        role = role_file.read().strip()
+
+    # read data_config and config files
+    data_conf.update(yaml.safe_load(Path(os.path.join(root_path, "data_config.yaml")).read_text()))
+    conf.update(yaml.safe_load(Path(os.path.join(root_path, "config.yaml")).read_text()))
+
+    # CPU budget shared by the stages, so parallel pools do not oversubscribe the container
+    rsf.configure_resources(conf)
+
+    # select corresponding themes
+    clients = client_themes(role, data_conf)
+    if not clients:
+        return
+    node = "Client_" + "_".join(client_id.split("_", 1)[1] for client_id in clients)
+    for client_id, theme in clients.items():
+        print(f"{client_id}: Selected theme is: {theme}.")
+
+    # stage spans are exported as JSON lines and Prometheus text, tagged by client and theme
+    mtf.configure_metrics(conf, node, clients[node] if node in clients else None)
+
+    # stages selected in PROFILE_STAGES (config.yaml or environment) are profiled
+    pf.configure_profiling(conf, node)
+
+    # create destination folder to save data to analyze.
+    data_path = os.path.join(root_path, data_conf["DATA_PATH"])
+    os.makedirs(data_path, exist_ok=True)
+
+    # values every stage may use
+    values = {"data_path": data_path, "themes": list(clients.values())}
+    for client_id, theme in clients.items():
+        values.update(theme_values(data_path, client_id, theme, len(clients) > 1))
+    if rsf.resources["out_of_core"]:
+        # memory of a group of threads, shared by the themes analysed at the same time
+        values["group_bytes"] = rsf.memory_budget() // min(len(clients), conf.get("STAGE_WORKERS", 4))
+    # the local forests of the themes trained at the same time share the CPU budget of the stage
+    rsf.set_stage_concurrency("local_training", min(len(clients), conf.get("STAGE_WORKERS", 4), rsf.cpu_budget()))
+
+    stages = client_stage_graph(conf, clients)
+    if "--dry-run" in sys.argv or os.environ.get("STAGE_DRY_RUN") == "1":
+        sgf.print_stage_plan(stages, values)
+        return
+    sgf.run_stage_graph(stages, values)
+    print(f"{node}: END.")
 
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,30 @@
-
-import subprocess
 import os
 
 # create corresponding paths
 root_path = "/usr/local/app/"
 tmp_path = os.path.join(root_path, "tmp")
-src_path = os.path.join(root_path, "src")
 
-# read role file
-role_file = open(os.path.join(tmp_path,"role.txt"), "r") 
-role = role_file.read().strip()
-role_file.close() 
+def main():
+    """
+    Function that runs the server, an aggregator or the client according to the role of the node. The role script
+    is imported and run in this same interpreter, so only the modules of that role are imported once.
+    """
+    # read role file
+    with open(os.path.join(tmp_path, "role.txt"), "r") as role_file:
+        role = role_file.read().strip()
+
+    print("Distpatcher:: ROLE:", role)
 
-print("Distpatcher:: ROLE:", role)
+    # dispatch tasks according to role
+    if role and "SERVER" in role:
+        import server
+        server.main()
+    elif role and "AGGREGATOR" in role:
+        import aggregator
+        aggregator.main()
+    else:
+        import client
+        client.main()
 
-# dispatch tasks according to role
-if role and "SERVER" in role:
-    subprocess.call(["python", os.path.join(src_path, "server.py")])
-else:
-    subprocess.call(["python", os.path.join(src_path, "client.py")])
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import sys
+import os
+import time
+import argparse
+from pathlib import Path
+import yaml
+import pyarrow.dataset as ds
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Import the module
+from modules import model_artifact_functions as maf
+
+# READ DATA FROM CONFIG.YAML
+root_path = "/usr/local/app/"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Score a msg_summary.parquet file with a saved model.")
+    parser.add_argument("summary", help="Path of the msg_summary.parquet file to score.")
+    parser.add_argument("--model-path", default=None,
+                        help="Folder with the model versions. Default: MODEL_PATH of config.yaml.")
+    parser.add_argument("--version", type=int, default=None, help="Model version. Default: latest.")
+    parser.add_argument("--output", default=None,
+                        help="Parquet file to write the scores. Default: <summary folder>/msg_scores.parquet.")
+    parser.add_argument("--config", default=os.path.join(root_path, "config.yaml"), help="config.yaml path.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    model_path = args.model_path
+    if model_path is None:
+        conf = yaml.safe_load(Path(args.config).read_text())
+        model_path = conf.get("MODEL_PATH", os.path.join(root_path, "models"))
+
+    artifact = maf.load_model_artifact(model_path, args.version)
+    metadata = artifact["metadata"]
+    print(f"Score: Model version {metadata['version']} ({metadata['training_mode']}, "
+          f"{metadata['n_trees']} trees) loaded.")
+
+    # only the columns of the summary are read: summaries without hashed text features have no tokens,
+    # and missing model features are reported when the features are prepared
+    dataset = ds.dataset(args.summary, format="parquet")
+    columns = ["msg_id"] + metadata["features"]
+    if metadata.get("text_features", 0):
+        columns += ["text_hash_idx", "text_hash_val"]
+    columns = [col for col in columns if col in dataset.schema.names]
+    df = dataset.to_table(columns=columns).to_pandas()
+    start_time = time.perf_counter()
+    scores = maf.score_messages(df, artifact)
+    elapsed = time.perf_counter() - start_time
+    print(f"Score: {len(scores)} messages scored in {elapsed * 1000:.1f} ms "
+          f"({elapsed * 1e6 / max(len(scores), 1):.1f} ms per 1000 messages).")
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(args.summary)), "msg_scores.parquet")
+    scores.to_parquet(output, engine="pyarrow", index=False)
+    print(f"Score: Scores saved in {output}. {int((scores['prediction'] == 1).sum())} messages predicted as rumour.")
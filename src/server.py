@@ -3,76 +3,331 @@ import os
 from pathlib import Path
 import yaml
 import time
-import pandas as pd
-from sklearn.model_selection import train_test_split
+import asyncio
+import functools
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # Import the module
 from modules import mqtt_functions as mqttf
+from modules import transport_functions as tf
 from modules import random_forest_train_functions as rftf
+from modules import ingest_functions as ingf
+from modules import model_artifact_functions as maf
+from modules import resource_functions as rsf
+from modules import metrics_functions as mtf
+from modules import profiling_functions as pf
+from modules import stage_graph_functions as sgf
 
-# READ DATA FROM CONFIG.YAML
+# Modules only used by some training modes (federated, histogram, online, model broadcast, text features,
+# async mqtt) are imported by the stages that use them, so the server starts faster.
+
+# READ DATA FROM CONFIG.YAML (by main)
 root_path = "/usr/local/app/"
-conf = yaml.safe_load(Path(os.path.join(root_path,"config.yaml")).read_text())
+conf = {}
 
-# CREATE CLIENT AND CONNECT TO PUBLIC BROKER
-mqttc = mqttf.create_mqtt_client(conf)
+# columns used to train the model
+selected_columns = rftf.SELECTED_COLUMNS
+save_path = os.path.join(root_path,"received_data")
 
-# Record the start time
-start_time = time.time()
+def histogram_training():
+    """
+    Stage that grows the forest with the clients from their histograms: no message row is received.
+    """
+    from modules import federated_histogram_functions as histf
+    print("Server: waiting for clients to grow the forest from their histograms...")
+    trees, confusion = histf.run_histogram_server(conf)
+    if not trees:
+        print("Server: No client took part. END.")
+        sys.exit(0)
 
-# SUSCRIBE AND START LISTENING MESSAGES FOR A TIME
-print("Server: waiting for messages...")
-while time.time() - start_time < conf["TIME_LISTENING_MESSAGES"]:
-    mqttc.loop_start()
-    mqttc.subscribe(conf["MQTT_TOPIC"])
-    mqttc.on_message = mqttf.on_message
-    mqttc.loop_stop()
+    if confusion is not None:
+        print("Server: Print forest evaluation on client held-out rows...")
+        print("Confusion Matrix:")
+        print(confusion)
+        print(f"Accuracy Score: {confusion.trace() / max(confusion.sum(), 1):.4f}")
 
-# After the loop ends, you can manage receiving messages here
-print("Server: Time's up! Starting to manage receiving messages...")
+    print("Server: Print forest feature importance...")
+    importances = histf.histogram_feature_importance(trees, len(selected_columns) - 1)
+    feature_names = [col for col in selected_columns if col != 'is_rumour']
+    for name, importance in sorted(zip(feature_names, importances), key=lambda item: -item[1]):
+        print(f"{name}: {importance:.4f}")
 
-# Join all data in a single datafarme
-print("Server: Joining all data into single file ...")
-save_path = os.path.join(root_path,"received_data")
-file_path = rftf.join_all_data(save_path)
+    metrics = {"accuracy": float(confusion.trace() / max(confusion.sum(), 1))} if confusion is not None else None
+    return maf.create_artifact(trees, [0, 1], feature_names, "histogram", metrics)
+
+def create_online_trainer():
+    """
+    Stage that creates the online trainer in online mode, so the forest grows while files are received.
+    """
+    if conf.get("TRAINING_MODE", "central") != "online":
+        return None
+    from modules import online_training_functions as otf
+    return otf.create_online_trainer(conf)
+
+def create_ingest_pipeline(trainer):
+    """
+    Stage that creates the ingest pipeline: received files are decoded into memory as they arrive,
+    and handed to the online trainer in online mode.
+    """
+    on_table = None
+    if trainer is not None:
+        from modules import online_training_functions as otf
+        on_table = functools.partial(otf.submit_table, trainer)
+    return ingf.create_ingest_pipeline(conf, save_path, selected_columns, on_table)
+
+async def receive_into_pipeline(pipeline):
+    """
+    Coroutine that receives messages for a while with the asyncio transport and hands each
+    payload to the ingest pipeline, so receiving overlaps with decoding.
+    """
+    from modules import async_mqtt_functions as amqttf
+    loop = asyncio.get_running_loop()
+    aclient = await amqttf.create_async_mqtt_client(conf)
+    async for payload in amqttf.receive_payloads(aclient, mqttf.subscription_topic(conf, 1),
+                                                conf["TIME_LISTENING_MESSAGES"]):
+        await loop.run_in_executor(None, ingf.submit_payload, pipeline, payload)
+    await amqttf.close_async_mqtt_client(aclient)
+
+def receive(pipeline):
+    """
+    Stage that subscribes and listens to messages for TIME_LISTENING_MESSAGES seconds.
+    """
+    print("Server: waiting for messages...")
+    if conf.get("ASYNC_TRANSPORT", 0) == 1 and conf.get("TRANSPORT_BACKEND", "mqtt") == "mqtt":
+        asyncio.run(receive_into_pipeline(pipeline))
+    else:
+        # CREATE CONSUMER TRANSPORTS (BY DEFAULT CONNECTED TO PUBLIC BROKER)
+        # with several consumers every shard topic is received through a shared subscription
+        consumers = conf.get("SERVER_CONSUMERS", 1)
+        topic = mqttf.subscription_topic(conf, consumers)
+        transports = [tf.create_transport(conf) for _ in range(consumers)]
+
+        # Record the start time
+        start_time = time.time()
+
+        for transport in transports:
+            tf.transport_listen(transport, topic, functools.partial(ingf.submit_payload, pipeline))
+        while time.time() - start_time < conf["TIME_LISTENING_MESSAGES"]:
+            time.sleep(1)
+        for transport in transports:
+            tf.transport_stop(transport)
+    print("Server: Time's up! Starting to manage receiving messages...")
+    return len(pipeline["ledger"])
+
+def join(pipeline, trainer):
+    """
+    Stage that joins all data: pending messages are decoded and batches concatenated once.
+    In the out-of-core mode the training table is a uniform sample of the data that fits the
+    memory ceiling, and the data is read again a file at a time for the online trainer and the snapshot.
+    """
+    print("Server: Joining all received data ...")
+    out_of_core = rsf.resources["out_of_core"]
+    columns = selected_columns + (["text_hash_idx", "text_hash_val"] if conf.get("TEXT_FEATURES", 0) == 1 else [])
+    table = ingf.close_ingest_pipeline(pipeline, columns)
+    received = table is not None
+    if not received:
+        # nothing received in this run: use files previously saved in received_data
+        print("Server: No data received, joining files saved in received data folder...")
+        max_bytes = rsf.memory_budget() if out_of_core else None
+        table = rftf.join_all_data(save_path, max_bytes=max_bytes, columns=columns) if os.path.isdir(save_path) else None
+        if table is None:
+            print("Server: No data to train. END.")
+            sys.exit(0)
+        if trainer is not None:
+            # the online forest grows in chunks with every row, not only with the sample
+            from modules import online_training_functions as otf
+            for chunk in rftf.iterate_zip_tables(save_path) if out_of_core else [table]:
+                otf.submit_table(trainer, None, None, chunk)
+
+    # save combined data snapshot if required
+    if conf.get("COMBINED_SNAPSHOT", 0) == 1:
+        if out_of_core:
+            snapshot = ingf.ingested_tables(pipeline) if received else rftf.iterate_zip_tables(save_path)
+        else:
+            snapshot = table
+        print(f"Server: Combined data snapshot saved in {rftf.save_combined_snapshot(snapshot, save_path)}")
+    return table
+
+def select_and_transform(table):
+    """
+    Stage that selects and transforms the columns to train the model, split into features (X) and target (y).
+    """
+    print("Server: Selecting columns and transforming to train the model...")
+    df = rftf.select_and_transform_data(table.to_pandas(), selected_columns)
+    X = df.drop('is_rumour', axis=1)
+    return X, df['is_rumour']
 
-print("Server: Selecting columns and transforming to train the model...")
+def federated_merge(pipeline, X, y):
+    """
+    Stage that merges the client forests: received rows are their held-out sets.
+    """
+    from modules import federated_functions as fedf
+    models = list(pipeline["models"].values())
+    if not models:
+        print("Server: No client model received. END.")
+        sys.exit(0)
+    print(f"Server: Merging {len(models)} client forests weighted by their samples...")
+    model = fedf.merge_client_forests(models, conf.get("FEDERATED_MERGED_TREES", 300))
+    if model is None:
+        print("Server: No valid client model received. END.")
+        sys.exit(0)
+    return model, X, y, list(X.columns)
 
-# recover data, select data and transform
-df = pd.read_csv(file_path) 
-selected_columns = ['msg_hour', 'propagate_to_msg', 'has_mentions', 'mentions','is_reply_message',
-           'retweets', 'favourites', 'has_link', 'has_hashtag', 'emotion', 'is_rumour']
-df = rftf.select_and_transform_data(df, selected_columns) # transform data
+def online_training_close(trainer, X):
+    """
+    Stage that finishes the forest grown during the receive window, evaluated on its validation reservoir.
+    """
+    from modules import online_training_functions as otf
+    model = otf.close_online_trainer(trainer)
+    if model is None:
+        print("Server: Not enough data of both classes to grow the online forest. END.")
+        sys.exit(0)
+    X_test, y_test = otf.online_holdout(trainer)
+    return model, X_test, y_test, list(X.columns)
 
-print("Server: Split data into taining and test...")
+def tuning(trainer, table, X, y):
+    """
+    Stage that tunes the random forest model on a training split and keeps the test split.
+    """
+    if trainer is not None:
+        # final tuning replaces the online forest
+        from modules import online_training_functions as otf
+        otf.close_online_trainer(trainer)
+    feature_names = list(X.columns)
+    if conf.get("TEXT_FEATURES", 0) == 1:
+        # hashed tokens and hashtags are appended as sparse columns, never densified
+        from modules import text_feature_functions as tff
+        print("Server: Adding sparse hashed text features...")
+        X, feature_names = tff.combine_features(X, table)
 
-# Split the data into features (X) and target (y)
-X = df.drop('is_rumour', axis=1)
-y = df['is_rumour']
+    print("Server: Split data into taining and test...")
+    from sklearn.model_selection import train_test_split
 
-# Train-test split (80% training, 20% testing)
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+    # Train-test split (80% training, 20% testing)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
 
-print("Server: Tune random forest model and obtain best model and parameters...")
-best_model, best_params = rftf.tune_random_forest(X_train, y_train)
+    print("Server: Tune random forest model and obtain best model and parameters...")
+    with rsf.stage_resources("tuning"):
+        model, best_params = rftf.tune_random_forest(X_train, y_train, conf)
+    return model, X_test, y_test, feature_names
 
-print("Server: Print best model evaluation...")
-# print evaluation results of prediction: confusion matrix, classification report and accuracy score
-y_pred = best_model.predict(X_test)
-rftf.print_model_evaluation(y_test, y_pred)
+def evaluation(model, X_test, y_test, feature_names):
+    """
+    Stage that prints the evaluation results of prediction (confusion matrix, classification report and
+    accuracy score) and the feature importance of the best model.
+    """
+    print("Server: Print best model evaluation...")
+    y_pred = model.predict(X_test)
+    rftf.print_model_evaluation(y_test, y_pred)
 
-print("Server: Print best model feature importance...")
-rftf.print_feature_importance(best_model, X)
+    print("Server: Print best model feature importance...")
+    rftf.print_feature_importance(model, feature_names)
+    return float((y_pred == y_test).mean())
 
-# Print tree and rules if correspond
-if conf["VISUALIZE_TREE"] == 1:
+def create_artifact(model, accuracy, feature_names):
+    """
+    Stage that converts the best model into an artifact to score new messages.
+    """
+    return maf.forest_artifact(model, conf.get("TRAINING_MODE", "central"), {"accuracy": accuracy}, feature_names)
+
+def save_model(artifact):
+    """
+    Stage that saves the model artifact as a new version.
+    """
+    version = maf.save_model_artifact(artifact, conf.get("MODEL_PATH", os.path.join(root_path, "models")))
+    print(f"Server: Model saved as version {version}.")
+    return version
+
+def broadcast(artifact, clients):
+    """
+    Stage that broadcasts the model: clients score their own messages and report only aggregates.
+    """
+    from modules import model_broadcast_functions as mbf
+    print("Server: Broadcasting model to clients and waiting for their scores...")
+    reports = mbf.broadcast_model(conf, artifact, clients or None)
+    print(reports.to_string(index=False))
+    return reports
+
+def visualize(model, feature_names):
+    """
+    Stage that plots the best model tree and shows its rules.
+    """
     print("Server: Plot best model tree and show its rules...")
-    train_columns = X_train.columns 
-    rftf.visualize_random_forest(best_model, feature_names= train_columns)
+    rftf.visualize_random_forest(model, feature_names= feature_names)
+
+def server_stage_graph(conf):
+    """
+    Function that defines the server stages for the configured training mode.
+
+    Parameters:
+        conf (dict): config.yaml's information.
+
+    Returns:
+        dict: Stage graph.
+    """
+    stages = sgf.create_stage_graph("server", conf)
+    mode = conf.get("TRAINING_MODE", "central")
+    if mode == "histogram":
+        sgf.add_stage(stages, "histogram_training", histogram_training, (), ("artifact",), executor="wait",
+                      items=lambda artifact: artifact["metadata"]["n_trees"])
+    else:
+        # in online mode the forest grows while files are received
+        sgf.add_stage(stages, "create_online_trainer", create_online_trainer, (), ("trainer",))
+        sgf.add_stage(stages, "create_ingest_pipeline", create_ingest_pipeline, ("trainer",), ("pipeline",))
+        sgf.add_stage(stages, "receive", receive, ("pipeline",), ("clients",), executor="wait",
+                      items=lambda clients: clients)
+        sgf.add_stage(stages, "join", join, ("pipeline", "trainer"), ("table",), after=("receive",),
+                      items=lambda table: table.num_rows)
+        sgf.add_stage(stages, "select_and_transform", select_and_transform, ("table",), ("X", "y"),
+                      items=lambda result: len(result[1]))
+
+        outputs = ("model", "X_test", "y_test", "feature_names")
+        if mode == "federated":
+            sgf.add_stage(stages, "federated_merge", federated_merge, ("pipeline", "X", "y"), outputs)
+        elif mode == "online" and conf.get("ONLINE_FINAL_TUNING", 0) != 1:
+            sgf.add_stage(stages, "online_training_close", online_training_close, ("trainer", "X"), outputs)
+        else:
+            sgf.add_stage(stages, "tuning", tuning, ("trainer", "table", "X", "y"), outputs)
+        sgf.add_stage(stages, "evaluation", evaluation, ("model", "X_test", "y_test", "feature_names"), ("accuracy",))
+        sgf.add_stage(stages, "create_artifact", create_artifact, ("model", "accuracy", "feature_names"), ("artifact",))
+        if conf["VISUALIZE_TREE"] == 1:
+            sgf.add_stage(stages, "visualize", visualize, ("model", "feature_names"), (),
+                          after=("save_model", "broadcast") if conf.get("MODEL_BROADCAST", 0) == 1 else ("save_model",))
+
+    sgf.add_stage(stages, "save_model", save_model, ("artifact",), ("version",))
+    if conf.get("MODEL_BROADCAST", 0) == 1:
+        sgf.add_stage(stages, "broadcast", broadcast, ("artifact", "clients"), ("reports",), after=("save_model",),
+                      executor="wait", items=len)
+    return stages
+
+def main():
+    """
+    Function that runs the server: reads its configuration and runs its stages.
+    """
+    conf.update(yaml.safe_load(Path(os.path.join(root_path,"config.yaml")).read_text()))
+
+    # CPU budget shared by the stages, so parallel pools do not oversubscribe the container
+    rsf.configure_resources(conf)
+
+    # stage spans are exported as JSON lines and Prometheus text
+    mtf.configure_metrics(conf, "Server")
+
+    # stages selected in PROFILE_STAGES (config.yaml or environment) are profiled
+    pf.configure_profiling(conf, "Server")
 
+    stages = server_stage_graph(conf)
 
+    # clients taking part in histogram mode are known in advance, otherwise they are counted while receiving
+    values = {"clients": conf.get("HIST_CLIENTS")} if conf.get("TRAINING_MODE", "central") == "histogram" else {}
+    if "--dry-run" in sys.argv or os.environ.get("STAGE_DRY_RUN") == "1":
+        sgf.print_stage_plan(stages, values)
+        return
+    sgf.run_stage_graph(stages, values)
 
+    print("Server: CPU time of the stages (process CPU is shared by overlapping stages):")
+    print(rsf.resource_report().to_string(index=False))
 
+if __name__ == "__main__":
+    main()
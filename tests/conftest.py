@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Add the parent directory to the Python path, as the scripts in src do
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,63 @@
+import os
+import json
+import pandas as pd
+from modules import delta_sync_functions as dsf
+from modules import ingest_functions as ingf
+
+def write_summary(path, rows):
+    pd.DataFrame(rows, columns=["msg_id", "retweets", "text"]).to_parquet(path, engine="pyarrow", index=False)
+
+def acknowledge(sync_path, version):
+    """
+    Function that makes the pending manifest the acknowledged one, as an applied delta does.
+    """
+    manifest_path, version_path, pending_path = dsf.manifest_paths(sync_path)
+    os.replace(pending_path, manifest_path)
+    with open(version_path, "w") as file:
+        json.dump({"version": version}, file)
+
+def sent_rows(send_folder):
+    """
+    Function that reads the rows of every zip file of a delta.
+    """
+    tables = [ingf.read_zip_payload(os.path.join(send_folder, name)).to_pandas()
+              for name in sorted(os.listdir(send_folder))]
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=["msg_id"])
+
+def test_prepare_delta_sends_every_row_first(tmp_path):
+    summary_path, send_folder, sync_path = tmp_path / "msg_summary.parquet", tmp_path / "send", tmp_path / "sync"
+    send_folder.mkdir()
+    write_summary(summary_path, [("1", 0, "a"), ("2", 3, "b")])
+    delta = dsf.prepare_delta(str(summary_path), str(send_folder), "charliehebdo-all", str(sync_path))
+    assert delta == {"base_version": 0, "tombstones": [], "n_upserts": 2, "n_files": 1}
+    assert sorted(sent_rows(send_folder)["msg_id"]) == ["1", "2"]
+
+def test_prepare_delta_inserts_updates_and_tombstones(tmp_path):
+    summary_path, send_folder, sync_path = tmp_path / "msg_summary.parquet", tmp_path / "send", tmp_path / "sync"
+    send_folder.mkdir()
+    write_summary(summary_path, [("1", 0, "a"), ("2", 3, "b"), ("3", 5, "c")])
+    dsf.prepare_delta(str(summary_path), str(send_folder), "charliehebdo-all", str(sync_path))
+    acknowledge(str(sync_path), 1)
+    for name in os.listdir(send_folder):
+        os.remove(send_folder / name)
+
+    # message 2 is updated, 3 deleted and 4 inserted; message 1 is unchanged
+    write_summary(summary_path, [("1", 0, "a"), ("2", 4, "b"), ("4", 1, "d")])
+    delta = dsf.prepare_delta(str(summary_path), str(send_folder), "charliehebdo-all", str(sync_path))
+    assert delta == {"base_version": 1, "tombstones": ["3"], "n_upserts": 2, "n_files": 1}
+    rows = sent_rows(send_folder).sort_values("msg_id")
+    assert rows["msg_id"].tolist() == ["2", "4"]
+    assert rows["retweets"].tolist() == [4, 1]
+
+def test_prepare_delta_without_changes(tmp_path):
+    summary_path, send_folder, sync_path = tmp_path / "msg_summary.parquet", tmp_path / "send", tmp_path / "sync"
+    send_folder.mkdir()
+    write_summary(summary_path, [("1", 0, "a")])
+    dsf.prepare_delta(str(summary_path), str(send_folder), "charliehebdo-all", str(sync_path))
+    acknowledge(str(sync_path), 1)
+    for name in os.listdir(send_folder):
+        os.remove(send_folder / name)
+
+    delta = dsf.prepare_delta(str(summary_path), str(send_folder), "charliehebdo-all", str(sync_path))
+    assert delta == {"base_version": 1, "tombstones": [], "n_upserts": 0, "n_files": 0}
+    assert os.listdir(send_folder) == []
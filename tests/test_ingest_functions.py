@@ -0,0 +1,33 @@
+import pytest
+from modules import ingest_functions as ingf
+
+@pytest.fixture
+def pipeline(tmp_path):
+    pipeline = ingf.create_ingest_pipeline({"INGEST_WORKERS": 1}, str(tmp_path))
+    yield pipeline
+    ingf.close_ingest_pipeline(pipeline)
+
+def test_register_in_ledger_discards_duplicates(pipeline):
+    assert ingf.register_in_ledger(pipeline, "Client_1", 1, 0, "hash0", "charliehebdo_0.zip")
+    assert ingf.register_in_ledger(pipeline, "Client_1", 1, 1, "hash1", "charliehebdo_1.zip")
+    # a retransmission of the same payload is discarded
+    assert not ingf.register_in_ledger(pipeline, "Client_1", 1, 0, "hash0", "charliehebdo_0.zip")
+    assert pipeline["duplicates"] == 1
+    assert pipeline["ledger"]["Client_1"]["seqs"] == {0: "hash0", 1: "hash1"}
+
+def test_register_in_ledger_redelivery_of_other_clients(pipeline):
+    # equal sequences and contents of different clients are different payloads
+    assert ingf.register_in_ledger(pipeline, "Client_1", 1, 0, "hash0", "charliehebdo_0.zip")
+    assert ingf.register_in_ledger(pipeline, "Client_2", 1, 0, "hash0", "charliehebdo_0.zip")
+    assert not ingf.register_in_ledger(pipeline, "Client_2", 1, 0, "hash0", "charliehebdo_0.zip")
+    assert pipeline["duplicates"] == 1
+
+def test_register_in_ledger_new_run_replaces_previous(pipeline):
+    assert ingf.register_in_ledger(pipeline, "Client_1", 1, 0, "hash0", "charliehebdo_0.zip")
+    # a newer run is ingested from scratch, even with the same payload
+    assert ingf.register_in_ledger(pipeline, "Client_1", 2, 0, "hash0", "charliehebdo_0.zip")
+    assert pipeline["ledger"]["Client_1"]["run_id"] == 2
+    # payloads of an older run delivered late are discarded
+    assert not ingf.register_in_ledger(pipeline, "Client_1", 1, 1, "hash1", "charliehebdo_1.zip")
+    assert pipeline["ledger"]["Client_1"]["seqs"] == {0: "hash0"}
+    assert pipeline["duplicates"] == 1
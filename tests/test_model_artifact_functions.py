@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from modules import model_artifact_functions as maf
+
+@pytest.fixture
+def training_data():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"retweets": rng.integers(0, 50, 600), "favourites": rng.integers(0, 50, 600),
+                       "msg_hour": rng.integers(0, 24, 600),
+                       "emotion": rng.choice(["Negative", "Neutral", "Positive"], 600)})
+    codes = df["emotion"].map({"Negative": 0, "Neutral": 1, "Positive": 2})
+    y = ((df["retweets"] + 10 * codes + rng.normal(0, 10, 600)) > 35).astype(int)
+    X = df.assign(emotion=codes)
+    return df, X, y
+
+@pytest.mark.parametrize("max_depth", [3, None])
+def test_score_batch_matches_predict_proba(training_data, max_depth):
+    df, X, y = training_data
+    model = RandomForestClassifier(n_estimators=25, max_depth=max_depth, random_state=0).fit(X, y)
+    artifact = maf.forest_artifact(model, "central")
+    # small blocks so several of them are scored
+    proba = maf.score_batch(artifact, maf.prepare_features(df, artifact), block_size=97)
+    np.testing.assert_allclose(proba, model.predict_proba(X), atol=1e-6)
+
+def test_score_messages_predicts_the_most_probable_class(training_data):
+    df, X, y = training_data
+    model = RandomForestClassifier(n_estimators=10, random_state=0).fit(X, y)
+    artifact = maf.forest_artifact(model, "central")
+    scores = maf.score_messages(df.assign(msg_id=[str(idx) for idx in range(len(df))]), artifact)
+    assert scores["prediction"].tolist() == model.predict(X).tolist()
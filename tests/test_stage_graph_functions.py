@@ -0,0 +1,44 @@
+import pytest
+from modules import stage_graph_functions as sgf
+
+def identity(value):
+    return value
+
+def test_plan_stage_graph_waves():
+    graph = sgf.create_stage_graph("test", {})
+    sgf.add_stage(graph, "load", identity, ("path",), ("data",))
+    sgf.add_stage(graph, "features", identity, ("data",), ("X",))
+    sgf.add_stage(graph, "labels", identity, ("data",), ("y",))
+    sgf.add_stage(graph, "train", lambda X, y: X, ("X", "y"), ("model",))
+    sgf.add_stage(graph, "report", identity, ("path",), (), after=("train",))
+    assert sgf.plan_stage_graph(graph, {"path"}) == [["load"], ["features", "labels"], ["train"], ["report"]]
+    # only the stages needed by the targets are planned
+    assert sgf.plan_stage_graph(graph, {"path"}, ["features"]) == [["load"], ["features"]]
+
+def test_plan_stage_graph_cycle():
+    graph = sgf.create_stage_graph("test", {})
+    sgf.add_stage(graph, "first", identity, ("b",), ("a",))
+    sgf.add_stage(graph, "second", identity, ("a",), ("b",))
+    with pytest.raises(ValueError, match="depend on each other"):
+        sgf.plan_stage_graph(graph)
+
+def test_plan_stage_graph_missing_input():
+    graph = sgf.create_stage_graph("test", {})
+    sgf.add_stage(graph, "train", identity, ("X",), ("model",))
+    with pytest.raises(ValueError, match="needs values \\['X'\\]"):
+        sgf.plan_stage_graph(graph)
+    # the input is available as an initial value
+    assert sgf.plan_stage_graph(graph, {"X"}) == [["train"]]
+
+def test_plan_stage_graph_missing_after_stage():
+    graph = sgf.create_stage_graph("test", {})
+    sgf.add_stage(graph, "report", identity, ("X",), (), after=("train",))
+    with pytest.raises(ValueError, match="stages \\['train'\\]"):
+        sgf.plan_stage_graph(graph, {"X"})
+
+def test_plan_stage_graph_value_produced_twice():
+    graph = sgf.create_stage_graph("test", {})
+    sgf.add_stage(graph, "first", identity, ("X",), ("model",))
+    sgf.add_stage(graph, "second", identity, ("X",), ("model",))
+    with pytest.raises(ValueError, match="produced by first and by second"):
+        sgf.plan_stage_graph(graph, {"X"})